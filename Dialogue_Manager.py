@@ -4,12 +4,25 @@ from __future__ import print_function
 import argparse
 import sys
 import re
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from six.moves import queue
+import six
 from ontology import databaseAPI
+from ontology.cassette import Cassette
 from rnn_nlu import data_utils, test_multi_task_rnn
 from rule_based_NLU import *
 from userSimulator import Simulator
 from policy_network import policy_network
 from nlg import rule_based
+from belief_state import BeliefState, INTENT_INDEX
+from utils.tracing import Tracer, TracedCalls, traced
+from utils.executor import BoundedExecutor, completed
+from transcript import RecordingCalls, TranscriptWriter
+from state_store import StaleStateError
 
 import numpy as np
 
@@ -33,86 +46,413 @@ def optParser():
     parser.add_argument('--auto_test',default=False,action='store_true',help='auto test, enter user goal')
     parser.add_argument('--train_policy',default=False,action='store_true',help='train policy network')
     parser.add_argument('-v',dest='verbose',default=False,action='store_true',help='verbose')
+    parser.add_argument('--transcript',default='',type=str,help='append the stdin test turns to this transcript log')
+    parser.add_argument('--cassette',default='',type=str,help='record or replay the spotify calls in this sqlite file')
+    parser.add_argument('--cassette_mode',default='replay',type=str,help='record|replay')
     args = parser.parse_args()
     return args
 
 
-class Manager():
-    def __init__(self,data_dir,train_dir, genre_map,spotify_playlist, spotify_account, verbose=False,user_name='default_user'):
-        self.DB = databaseAPI.Database(genre_map,spotify_playlist, spotify_account,verbose=verbose)
+def open_cassette(args):
+    return Cassette(args.cassette,args.cassette_mode) if args.cassette else None
+
+
+def _run_stage(results,name,stage,sentence):
+    start_time = time.time()
+    try:
+        results.put((name,stage(sentence),None,time.time()-start_time))
+    except Exception:
+        results.put((name,None,sys.exc_info(),time.time()-start_time))
+
+
+class DialogueServices(object):
+    """ Heavyweight components shared by every dialogue session: the NLU
+        model, the rule based NLU, the database and the NLG.
+        None of them keeps per-conversation state, a TF session can be run
+        from several threads and the others only read their tables, so one
+        instance serves all the sessions of a process.
+
+        The NLU stages of a turn (the NLU model, the rule based NLU and any
+        stage added with add_nlu_stage) are independent and run concurrently
+        on a shared thread pool.
+        tracer collects the stage latencies of every turn, its debug flag
+        turns on the per-turn debug prints.
+        actions runs the API calls answering the end of the async_final dialogues,
+        prefetches the speculative ones of Manager.prefetch_final, on their own
+        smaller budget so they never take the place of a real answer.
+        DB replaces the spotify database, e.g. by a transcript.ReplayDatabase,
+        cassette records or replays the spotify calls of the database.
+    """
+    def __init__(self,data_dir,train_dir,genre_map,spotify_playlist,spotify_account,verbose=False,
+                 nlu_workers=4,debug=False,action_workers=4,max_pending_actions=64,DB=None,cassette=None,
+                 prefetch_workers=2,max_pending_prefetches=8):
+        if DB is None:
+            DB = databaseAPI.Database(genre_map,spotify_playlist, spotify_account,verbose=verbose,cassette=cassette)
+        self.DB = DB
         self.NLUModel = test_multi_task_rnn.test_model(data_dir,train_dir)
         self.RULENLU = rule_based_NLU()
         self.NLG = rule_based.NLG('./nlg/NLG.txt')
+        self.nlu_stages = OrderedDict([('NLU',self.NLUModel.feed_sentence),
+                                       ('RULE',self.RULENLU.feed_sentence)])
+        #batched version of a stage, stage(sentences) -> [result], see run_nlu_batch
+        self.nlu_batch_stages = {}
+        if hasattr(self.NLUModel,'feed_sentences'):
+            self.nlu_batch_stages['NLU'] = self.NLUModel.feed_sentences
+        self.executor = ThreadPool(nlu_workers)
+        self.tracer = Tracer(debug=debug)
+        self.actions = BoundedExecutor(action_workers,max_pending_actions)
+        self.prefetches = BoundedExecutor(prefetch_workers,max_pending_prefetches)
+
+    def add_nlu_stage(self,name,stage,batch_stage=None):
+        """ Run stage(sentence) with the NLU stages of every turn.
+            It returns {slot_name:{slot_value:score}} like the rule based NLU,
+            and is merged into the state the same way.
+            batch_stage(sentences) returns the results of several sentences at once.
+        """
+        self.nlu_stages[name] = stage
+        if batch_stage is not None:
+            self.nlu_batch_stages[name] = batch_stage
+
+    def run_nlu(self,sentence,trace=None):
+        """ Run the NLU stages on sentence concurrently, yield (name, result)
+            in completion order. The first stage runs on the calling thread.
+            Each stage is timed as 'nlu.<name>'.
+        """
+        stages = list(self.nlu_stages.items())
+        results = queue.Queue()
+        for name, stage in stages[1:]:
+            self.executor.apply_async(_run_stage,(results,name,stage,sentence))
+        if stages:
+            name, stage = stages[0]
+            with self.tracer.span('nlu.'+name,trace):
+                result = stage(sentence)
+            yield name, result
+        for _ in stages[1:]:
+            name, result, exc_info, seconds = results.get()
+            self.tracer.observe('nlu.'+name,seconds,trace)
+            if exc_info is not None:
+                six.reraise(*exc_info)
+            yield name, result
+
+    def run_nlu_batch(self,sentences):
+        """ NLU stage results of several sentences, [{name: result}] in order.
+            Stages with a batch version run once on all the sentences, timed
+            as 'nlu_batch.<name>', the others per sentence on the thread pool.
+        """
+        results = [{} for _ in sentences]
+        if not sentences:
+            return results
+        pending = [(name,self.executor.map_async(stage,sentences))
+                   for name, stage in self.nlu_stages.items() if name not in self.nlu_batch_stages]
+        for name in self.nlu_stages:
+            if name in self.nlu_batch_stages:
+                with self.tracer.span('nlu_batch.'+name):
+                    stage_results = self.nlu_batch_stages[name](sentences)
+                for result, stage_result in zip(results,stage_results):
+                    result[name] = stage_result
+        for name, async_result in pending:
+            for result, stage_result in zip(results,async_result.get()):
+                result[name] = stage_result
+        return results
+
+    def close(self):
+        self.executor.close()
+        self.executor.join()
+        self.actions.close()
+        self.prefetches.close()
+
+
+class DialogueState(object):
+    """ Everything one conversation reads and writes between turns """
+    VERSION = 1
+    # kept across turns, the other fields are recomputed by every turn
+    PERSISTENT = ('user_name','in_sent','confirmed_state','action_history','dialogue_end',
+                  'cycle_num','rec_in_sent','last_track','last_artist',
+                  'dialogue_end_track_url','dialogue_end_type','dialogue_end_sentence',
+                  'last_access')
+    __slots__ = ('user_name','in_sent','in_sent_seg','NLU_result','RULE_result','stage_results',
+                 'state','confirmed_state','action_history','dialogue_end','cycle_num',
+                 'rec_in_sent','last_track','last_artist',
+                 'max_intent','max_intent_prob','max_slot',
+                 'dialogue_end_track_url','dialogue_end_type','dialogue_end_sentence',
+                 'last_access','prefetch')
+
+    def __init__(self,user_name='default_user'):
+        self.user_name = user_name
         self.in_sent = ''
         self.in_sent_seg = []
-        self.user_name = user_name
-
-        #slot to fill for each action
-        self.intent_slot_dict = {'search':['artist','track'],
-                                 'recommend':['artist','track','genre'],
-                                 'info':['track','artist'],
-                                 'playlistCreate':['playlist'],
-                                 'playlistAdd':['track','artist',
-                                 'playlist'],'playlistPlay':['playlist'],
-                                 'playlistShow':[],
-                                 'playlistTrack':['playlist'],
-                                 'all':['artist','track','genre','playlist','spotify_playlist'],
-                                 None:[],'empty':[]}
-        self.slot_prob_map = ['PAD','UNK',None,'track','playlist','artist','genre']
-        self.positive_response = [u'是的',u'對',u'對啊',u'恩',u'沒錯',u'是啊',u'就是這樣',u'你真聰明',u'是',u'有',u'好啊']
-        self.negative_response = [u'不是',u'錯了',u'不對',u'不用',u'沒有',u'算了',u'不需要',u'不',u'不要',u'否',u'不知道']
-        self.recommend_keyword = [u'相似',u'類似',u'推薦',u'像是',u'相關',u'風格']
-        self.last_track_keyword = [u'剛剛',u'上一首',u'正在',u'上首',u'剛才',u'再播']
-        #action threshold:
-        self.intent_upper_threshold = 0.84
-        self.intent_lower_threshold = 0.8
-        self.slot_uppser_threshold = 1.15
-        self.slot_lower_threshold = 0.9
-
-        #if cycle_num > max_cycle_num, end the dialogue
-        self.max_cycle_num = 10
-
+        self.NLU_result = None
+        self.RULE_result = None
+        self.stage_results = {}
+        self.max_intent = ''
+        self.max_intent_prob = 0.0
+        self.max_slot = {}
         self.dialogue_end_track_url = ''
         self.dialogue_end_type = ''
         self.dialogue_end_sentence = ''
-        self.state_init()
+        self.last_access = time.time()
+        self.confirmed_state = None
+        self.prefetch = None
+        self.reset()
 
+    def reset(self,flag=0):
+        """ initialize state: state is depending on state and action and dialogue_end
+            flag!=0 keeps the last confirmed track and artist for the next dialogue
+        """
+        self.last_track = None
+        self.last_artist = None
+        self.state = BeliefState()
+        if flag!=0 and self.confirmed_state['slot']['track'] is not None and self.confirmed_state['slot']['track'] != -1:
+            self.last_track = self.confirmed_state['slot']['track']
+            if self.confirmed_state['slot']['artist'] is not None:
+                self.last_artist = self.confirmed_state['slot']['artist']
 
 
-    def get_input(self,sentence,rule_based_action=True):
+        #'slot' = {'slot_name':{'slot_value':[prob]}}
+        self.confirmed_state = {'intent':None,'slot':{'artist':None,'track':None,'genre':None,'playlist':None,'spotify_playlist':None}}
+        self.action_history = []
+        self.dialogue_end = False
+        self.cycle_num = 0
+        self.rec_in_sent = False
+        #(intent, slots, Future) of the speculative final query, see Manager.prefetch_final
+        self.prefetch = None
+
+    def to_dict(self):
+        """ Versioned json-able snapshot of the state kept between turns """
+        d = dict((name,getattr(self,name)) for name in self.PERSISTENT)
+        d['state'] = self.state.to_dict()
+        d['version'] = self.VERSION
+        return d
+
+    @classmethod
+    def from_dict(cls,d):
+        if d.get('version') != cls.VERSION:
+            raise ValueError('Unsupported dialogue state version %s' % d.get('version'))
+        dialogue_state = cls(d['user_name'])
+        for name in cls.PERSISTENT:
+            setattr(dialogue_state,name,d[name])
+        dialogue_state.state = BeliefState.from_dict(d['state'])
+        return dialogue_state
+
+
+class SessionStore(object):
+    """ DialogueState of every live session, least recently used first.
+        Sessions idle for more than idle_timeout seconds are dropped, and the
+        least recently used ones are dropped beyond max_sessions, which caps
+        the memory held by the states. A session in the middle of a turn is
+        never dropped, and the turns of one session are serialized by a lock
+        kept apart from the cached states.
+        With a backend (see state_store), a session missing from memory is
+        loaded from it and written back after every turn, so sessions
+        survive eviction and restarts and can move between workers. Workers
+        sharing a backend should use max_sessions=0 to always reload, with a
+        backend having revisions (SqliteStateStore): a turn saved over a
+        newer revision written by another worker raises StaleStateError.
+    """
+    def __init__(self,services,max_sessions=10000,idle_timeout=1800,backend=None):
+        self.services = services
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.backend = backend
+        self.__sessions = OrderedDict() # key -> DialogueState
+        self.__revisions = {} # key -> backend revision of the cached state
+        self.__locks = {} # key -> [lock, number of turns holding or waiting for it]
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__sessions)
+
+    def get(self,key,user_name='default_user'):
+        """ Return the state of the session, created if missing """
+        now = time.time()
+        with self.__lock:
+            state = self.__sessions.pop(key,None)
+        if state is None:
+            state, revision = self.__load(key,user_name)
+            with self.__lock:
+                self.__revisions[key] = revision
+        state.last_access = now
+        with self.__lock:
+            self.__sessions[key] = state
+            self.__evict(now)
+        return state
+
+    def __load(self,key,user_name):
+        snapshot, revision = None, None
+        if hasattr(self.backend,'load_revision'):
+            snapshot, revision = self.backend.load_revision(key)
+        elif self.backend is not None:
+            snapshot = self.backend.load(key)
+        if snapshot is not None:
+            return DialogueState.from_dict(snapshot), revision
+        return DialogueState(user_name), revision
+
+    def remove(self,key):
+        with self.__lock:
+            self.__sessions.pop(key,None)
+            self.__revisions.pop(key,None)
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    @contextmanager
+    def manager(self,key,user_name=None,**kwargs):
+        """ Manager bound to the session of key, turns of one session are serialized """
+        with self.__lock:
+            entry = self.__locks.setdefault(key,[threading.Lock(),0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                state = self.get(key,user_name or 'default_user')
+                if user_name is not None:
+                    state.user_name = user_name
+                yield Manager(services=self.services,session=state,**kwargs)
+                if self.backend is not None:
+                    self.__save(key,state)
+        finally:
+            with self.__lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.__locks[key]
+
+    def __save(self,key,state):
+        if not hasattr(self.backend,'load_revision'):
+            self.backend.save(key,state.to_dict())
+            return
+        with self.__lock:
+            revision = self.__revisions.get(key)
+        try:
+            revision = self.backend.save(key,state.to_dict(),revision)
+        except StaleStateError:
+            # reloaded by the next turn
+            with self.__lock:
+                self.__sessions.pop(key,None)
+                self.__revisions.pop(key,None)
+            raise
+        with self.__lock:
+            self.__revisions[key] = revision
+
+    def __evict(self,now):
+        for key in list(self.__sessions):
+            if len(self.__sessions)<=self.max_sessions and now-self.__sessions[key].last_access<=self.idle_timeout:
+                break
+            if key in self.__locks: # in a turn
+                continue
+            del self.__sessions[key]
+            self.__revisions.pop(key,None)
+
+
+class Manager(object):
+    """ Dialogue manager: runs the turns of one session (a DialogueState)
+        on the shared DialogueServices. Per session fields such as state,
+        confirmed_state or dialogue_end are read and written through to
+        the session.
+        When a turn ends the dialogue, final_result is a Future of the
+        (sentence, url) answer. With async_final the turn returns without
+        waiting for it and dialogue_end_sentence/url are left empty,
+        otherwise they are filled from it before get_input returns.
+        A policy (e.g. dialogue_policy.PolicyAgent) called as policy(DM,rule_action)
+        picks the confirm/question action of the turns that do not end the dialogue.
+    """
+    #slot to fill for each action
+    intent_slot_dict = {'search':['artist','track'],
+                        'recommend':['artist','track','genre'],
+                        'info':['track','artist'],
+                        'playlistCreate':['playlist'],
+                        'playlistAdd':['track','artist',
+                        'playlist'],'playlistPlay':['playlist'],
+                        'playlistShow':[],
+                        'playlistTrack':['playlist'],
+                        'all':['artist','track','genre','playlist','spotify_playlist'],
+                        None:[],'empty':[]}
+    slot_prob_map = ['PAD','UNK',None,'track','playlist','artist','genre']
+    positive_response = [u'是的',u'對',u'對啊',u'恩',u'沒錯',u'是啊',u'就是這樣',u'你真聰明',u'是',u'有',u'好啊']
+    negative_response = [u'不是',u'錯了',u'不對',u'不用',u'沒有',u'算了',u'不需要',u'不',u'不要',u'否',u'不知道']
+    recommend_keyword = [u'相似',u'類似',u'推薦',u'像是',u'相關',u'風格']
+    last_track_keyword = [u'剛剛',u'上一首',u'正在',u'上首',u'剛才',u'再播']
+    #action threshold:
+    intent_upper_threshold = 0.84
+    intent_lower_threshold = 0.8
+    slot_uppser_threshold = 1.15
+    slot_lower_threshold = 0.9
+
+    #if cycle_num > max_cycle_num, end the dialogue
+    max_cycle_num = 10
+    #final queries started while the user is asked to confirm their slots
+    prefetch_intents = ('search','recommend','info')
+
+    def __init__(self,data_dir=None,train_dir=None, genre_map=None,spotify_playlist=None, spotify_account=None,
+                 verbose=False,user_name='default_user',services=None,session=None,async_final=False,policy=None):
+        if services is None:
+            services = DialogueServices(data_dir,train_dir,genre_map,spotify_playlist,spotify_account,verbose=verbose)
+        self.services = services
+        self.tracer = services.tracer
+        #(stage, seconds) of the current turn, every DB call is a 'db.<method>' stage
+        self.turn_trace = []
+        #[method, args, result] of the DB checks of the current turn, for the transcript log
+        self.db_calls = []
+        self.DB = TracedCalls(RecordingCalls(services.DB,self.db_calls),self.tracer,'db.',self.turn_trace)
+        self.NLUModel = services.NLUModel
+        self.RULENLU = services.RULENLU
+        self.NLG = services.NLG
+        self.session = session if session is not None else DialogueState(user_name)
+        self.async_final = async_final
+        self.final_result = None
+        self.policy = policy
+
+
+
+    @staticmethod
+    def nlu_input(sentence):
+        """ The sentence given to the NLU stages, without its leading yes/no """
+        return re.sub(u'就這樣|是的|對啊|對|恩|沒錯|不是|錯了|不對|不要|不知道','',sentence[:3]) + sentence[3:]
+
+    def get_input(self,sentence,rule_based_action=True,stage_results=None):
+        """ Run one turn on the user sentence and return the action.
+            stage_results are the NLU results of nlu_input(sentence) when
+            already computed, e.g. by DialogueServices.run_nlu_batch.
+        """
         self.in_sent = sentence
 
-        sentence = re.sub(u'就這樣|是的|對啊|對|恩|沒錯|不是|錯了|不對|不要|不知道','',sentence[:3]) + sentence[3:]
+        sentence = self.nlu_input(sentence)
         """
         print("CURRENT TURN START!!!!!!")
         print('input:',self.in_sent)
         print('NLU_input:',sentence)
         """
 
-        self.NLU_result = self.NLUModel.feed_sentence(sentence)
-        self.RULE_result = self.RULENLU.feed_sentence(sentence)
-        print('NLU_RESULT:',self.NLU_result)
-        print('RULE_RESULT:',self.RULE_result)
-
-
-        self.state_tracking()
-        action = self.action_maker()
+        del self.turn_trace[:]
+        del self.db_calls[:]
+        with self.tracer.span('turn',self.turn_trace):
+            if stage_results is not None:
+                self.stage_results = dict(stage_results)
+            else:
+                self.stage_results = {}
+                for name, result in self.services.run_nlu(sentence,self.turn_trace):
+                    self.stage_results[name] = result
+            self.NLU_result = self.stage_results.get('NLU')
+            self.RULE_result = self.stage_results.get('RULE',{})
+            if self.tracer.debug:
+                print('NLU_RESULT:',self.NLU_result)
+                print('RULE_RESULT:',self.RULE_result)
+
+            self.state_tracking()
+            action = self.action_maker()
         return action
 
 
 
+    @traced('update_state_with_NLU')
     def update_state_with_NLU(self,target=None,last_action_delete=None):
         """ Use the NLU result to update current state
             if target is provided, 
         """
         if target=='intent':
             if 'intent' in last_action_delete:
-                self.state['intent'][last_action_delete['intent']] = 0.0
+                self.state.set_intent(last_action_delete['intent'],0.0)
         elif target=='slot':
             for slot_name in last_action_delete['slot']:
-                #self.state['slot'][slot_name][last_action_delete['slot'][slot_name]] = 0.0
                 if 'slot' in last_action_delete:
-                    self.state['slot'][slot_name][last_action_delete['slot'][slot_name]] = 0.0
+                    self.state.set_slot(slot_name,last_action_delete['slot'][slot_name],0.0)
 
         if self.NLU_result is None:
             return
@@ -124,38 +464,31 @@ class Manager():
                 if i>=3 and p>max_prob:
                     slot_name = self.slot_prob_map[i]
                     max_prob = p
-            if e in self.state['slot'][slot_name]:
-                self.state['slot'][slot_name][e] += max_prob
-            else:
-                self.state['slot'][slot_name][e] = max_prob
+            self.state.add_slot(slot_name,e,max_prob)
 
         total_intent_prob = 0.0
         for intent in self.NLU_result['intent']:
             if intent in self.intent_slot_dict:
                 total_intent_prob += self.NLU_result['intent'][intent]
-                if intent in self.state['intent']:
-                    self.state['intent'][intent] += self.NLU_result['intent'][intent]
-                else:
-                    self.state['intent'][intent] = self.NLU_result['intent'][intent]
+                if intent in INTENT_INDEX:
+                    self.state.add_intent(intent,self.NLU_result['intent'][intent])
         
-        for slot_name in self.RULE_result:
-            if slot_name=='track' and total_intent_prob<0.9 and self.confirmed_state['intent'] is None:
-                continue
-            for e in self.RULE_result[slot_name]:
-                for slot_name2 in self.state['slot']:
-                    if slot_name != slot_name2:
-                        for slot_value in self.state['slot'][slot_name2]:
-                            if slot_value == e:
-                                self.state['slot'][slot_name2][slot_value] = -1.0
-                if e in self.state['slot'][slot_name]:
-                    self.state['slot'][slot_name][e] += self.RULE_result[slot_name][e]
-                else:
-                    self.state['slot'][slot_name][e] = self.RULE_result[slot_name][e]
-        if len(self.state['slot']['spotify_playlist'])>0:
+        #rule based NLU, then the added NLU stages
+        rule_results = [self.RULE_result] + [self.stage_results[name] for name in self.services.nlu_stages
+                                             if name not in ('NLU','RULE') and name in self.stage_results]
+        for rule_result in rule_results:
+            for slot_name in rule_result:
+                if slot_name=='track' and total_intent_prob<0.9 and self.confirmed_state['intent'] is None:
+                    continue
+                for e in rule_result[slot_name]:
+                    self.state.suppress_other_slots(slot_name,e,-1.0)
+                    self.state.add_slot(slot_name,e,rule_result[slot_name][e])
+        if self.state.has_values('spotify_playlist'):
             self.confirmed_state['intent'] = 'empty'
 
 
 
+    @traced('action_maker')
     def action_maker(self):
         #based on state, make action
         cur_action = {}
@@ -194,6 +527,8 @@ class Manager():
 
         if len(cur_action)==0:
             self.dialogue_end = True
+        elif self.policy is not None and not self.dialogue_end:
+            cur_action = self.policy(self,cur_action)
 
         """ make action when the current turn ended
             API response should be wrote here
@@ -210,36 +545,51 @@ class Manager():
                 if self.confirmed_state['slot'][slot_name] != None and self.confirmed_state['slot'][slot_name] != -1:
                     s[slot_name] = self.confirmed_state['slot'][slot_name]
 
+            #the API call answering the dialogue, run by the action executor
+            DB = self.DB
+            user_name = self.user_name
+            final_call = None
             if spotify_playlist is not None and not self.rec_in_sent:
                 cur_action['action'] = 'response'
-                sentence,url = self.DB.playlistSpotify(spotify_playlist)
+                final_call = lambda: DB.playlistSpotify(spotify_playlist)
                 self.confirmed_state['intent'] = 'playlistSpotify'
             elif self.confirmed_state['intent']=='playlistShow':
                 cur_action['action']='playlistShow'
-                sentence,playlistIDs = self.DB.playlistShow(self.user_name)
+                final_call = lambda: (DB.playlistShow(user_name)[0],'')
             elif self.confirmed_state['intent']=='playlistTrack':
                 cur_action['action']='playlistTrack'
-                sentence,url = self.DB.playlistTrack(self.user_name,playlist)
+                final_call = lambda: DB.playlistTrack(user_name,playlist)
             elif self.confirmed_state['intent']=='playlistPlay':
                 cur_action['action']='playlistPlay'
-                sentence, url = self.DB.playlistPlay(self.user_name,playlist)
+                final_call = lambda: DB.playlistPlay(user_name,playlist)
             elif self.confirmed_state['intent']=='playlistCreate':
                 cur_action['action']='playlistCreate'
-                sentence,url = self.DB.playlistCreate(self.user_name,playlist)
+                final_call = lambda: DB.playlistCreate(user_name,playlist)
             elif self.confirmed_state['intent']=='playlistAdd':
                 cur_action['action'] = 'playlistAdd'
-                sentence,url = self.DB.playlistAdd(self.user_name,playlist,s)
+                final_call = lambda: DB.playlistAdd(user_name,playlist,s)
             elif self.confirmed_state['intent']=='search':
                 cur_action['action'] = 'response'
-                _,sentence, url = self.DB.search(s)
-                self.dialogue_end_track_url = url
+                final_call = self._query_call('search',s)
             elif self.confirmed_state['intent']=='info':
                 cur_action['action'] = 'info'
-                _,sentence = self.DB.info(s)
+                final_call = self._query_call('info',s)
             elif self.confirmed_state['intent']=='recommend':
                 cur_action['action'] = 'info'
-                _,sentence,url = self.DB.recommend(s)
-
+                final_call = self._query_call('recommend',s)
+
+            prefetched = self._take_prefetch(self.confirmed_state['intent'],s)
+            if final_call is None:
+                self.final_result = completed((sentence,url))
+            elif prefetched is not None:
+                self.final_result = prefetched
+            elif not self.async_final:
+                #the turn waits for the answer, run it here rather than queue it behind other sessions
+                self.final_result = completed(final_call())
+            else:
+                self.final_result = self.services.actions.submit(final_call)
+            if not self.async_final:
+                sentence, url = self.final_result.result()
             self.dialogue_end_track_url = url
             self.dialogue_end_sentence = sentence
             self.dialogue_end_type = self.confirmed_state['intent']
@@ -252,34 +602,67 @@ class Manager():
             self.action_history.append(cur_action)
             return cur_action
 
+        if cur_action.get('action')=='confirm' and 'slot' in cur_action:
+            self.prefetch_final(cur_action['slot'])
         self.action_history.append(cur_action)
 
         return cur_action
 
 
-    def state_init(self,flag=0):
-        """ initialize state: state is depending on state and action and dialogue_end
-            state_intent:
+    def _query_call(self,intent,s):
+        """ Final DB query of a search, info or recommend dialogue, returning (sentence, url) """
+        DB = self.DB
+        if intent=='search':
+            return lambda: DB.search(s)[1:]
+        elif intent=='info':
+            return lambda: (DB.info(s)[1],'')
+        elif intent=='recommend':
+            return lambda: DB.recommend(s)[1:]
+
+
+    def prefetch_final(self,confirm_slot):
+        """ Start the final query the user's yes to confirm_slot would lead to,
+            while waiting for the answer. The result is used by action_maker
+            only if the dialogue ends with the same intent and slots.
         """
-        self.last_track = None
-        self.last_artist = None
-        self.state = {'intent':{'search':0.0,'recommend':0.0,'info':0.0,'playlistCreate':0.0,
-                                 'playlistAdd':0.0,'playlistPlay':0.0,'playlistShow':0.0,'playlistTrack':0.0},
-                      'slot':{'track':{},'artist':{},'genre':{},'playlist':{},'spotify_playlist':{}}}
-        if flag!=0 and self.confirmed_state['slot']['track'] is not None and self.confirmed_state['slot']['track'] != -1:
-            self.last_track = self.confirmed_state['slot']['track']
-            if self.confirmed_state['slot']['artist'] is not None:
-                self.last_artist = self.confirmed_state['slot']['artist']
+        intent = self.confirmed_state['intent']
+        if intent not in self.prefetch_intents:
+            return
+        s = {}
+        for slot_name in self.confirmed_state['slot']:
+            if self.confirmed_state['slot'][slot_name] != None and self.confirmed_state['slot'][slot_name] != -1:
+                s[slot_name] = self.confirmed_state['slot'][slot_name]
+        s.update(confirm_slot)
+        if self.prefetch is not None:
+            self.tracer.count('prefetch.discarded')
+            self.prefetch = None
+        future = self.services.prefetches.submit(self._query_call(intent,s))
+        if future.failed():
+            #prefetch budget used up, the final query runs when the dialogue ends
+            self.tracer.count('prefetch.skipped')
+            return
+        self.prefetch = (intent,s,future)
+        self.tracer.count('prefetch.issued')
 
 
-        #'slot' = {'slot_name':{'slot_value':[prob]}}
-        self.confirmed_state = {'intent':None,'slot':{'artist':None,'track':None,'genre':None,'playlist':None,'spotify_playlist':None}}
-        self.action_history = []
-        self.dialogue_end = False
-        self.cycle_num = 0
-        self.rec_in_sent = False
+    def _take_prefetch(self,intent,s):
+        """ Return the prefetched Future if it answers intent with slots s """
+        prefetch, self.prefetch = self.prefetch, None
+        if prefetch is None:
+            return None
+        prefetch_intent, prefetch_slots, future = prefetch
+        if prefetch_intent==intent and prefetch_slots==s and not future.failed():
+            self.tracer.count('prefetch.hit')
+            return future
+        self.tracer.count('prefetch.miss')
+        return None
 
 
+    def state_init(self,flag=0):
+        self.session.reset(flag)
+
+
+    @traced('state_tracking')
     def state_tracking(self):
         """ Update current state given response
             Based on this state, action maker will make appropriate action!!
@@ -334,43 +717,40 @@ class Manager():
             elif last_action['action'] == 'question':
                 if any(e in self.in_sent[:3] for e in self.negative_response):
                     if 'intent' in last_action:
-                        self.state['intent'][last_action['intent']] = -100.0
+                        self.state.set_intent(last_action['intent'],-100.0)
                 else:
                     self.update_state_with_NLU()
 
         if any(e in self.in_sent for e in self.recommend_keyword):
             self.rec_in_sent = True
 
-        self.max_intent_prob = 0.0
-        self.max_intent = ''
         #put it to max slot if it's not confirmed(state_confirm!=-1 or prob<upper) if all confirmed end_turn=True 
         self.max_slot ={'track':None,'artist':None,'genre':None,'playlist':None}
 
+        self.max_intent, self.max_intent_prob = '', 0.0
         if self.confirmed_state['intent'] is None:
-            for e in self.state['intent']:
-                if self.state['intent'][e] > self.max_intent_prob:
-                    self.max_intent_prob = self.state['intent'][e]
-                    self.max_intent = e
+            self.max_intent, self.max_intent_prob = self.state.best_intent()
 
             if self.max_intent_prob>self.intent_upper_threshold:
                 self.confirmed_state['intent'] = self.max_intent            
 
         all_slot_filled = True
         for slot_name in self.intent_slot_dict['all']:
-            if not self.confirmed_state['slot'][slot_name] and len(self.state['slot'][slot_name])>0:
+            if not self.confirmed_state['slot'][slot_name] and self.state.has_values(slot_name):
                 max_prob = 0.0
                 max_slot = ''
-                for s in self.state['slot'][slot_name]:
-                    if self.state['slot'][slot_name][s]>max_prob:
-                        check = 1
-                        if slot_name=='artist':
-                            check = self.DB.check_artist(s)
-                        elif slot_name=='track':
-                            check = self.DB.check_track(s)
-                        if check == 0:
-                            continue
-                        max_prob = self.state['slot'][slot_name][s]
-                        max_slot = s
+                #best value first, only the ones above a value missing from the DB are checked
+                for s, prob in self.state.ranked_values(slot_name):
+                    check = 1
+                    if slot_name=='artist':
+                        check = self.DB.check_artist(s)
+                    elif slot_name=='track':
+                        check = self.DB.check_track(s)
+                    if check == 0:
+                        continue
+                    max_prob = prob
+                    max_slot = s
+                    break
                 if max_prob>self.slot_uppser_threshold:
                     self.confirmed_state['slot'][slot_name] = max_slot
                 else:
@@ -386,21 +766,22 @@ class Manager():
     
 
     def print_current_state(self):
+        state = self.state.as_dict()
         print('distribution state:')
         print('distribution intent: ',end='')
-        for e in self.state['intent']:
+        for e in state['intent']:
             print(' ',end='')
             print(e,end='')
-            print(': ',self.state['intent'][e],end='')
+            print(': ',state['intent'][e],end='')
         print()
         print('distribution slot: ',end='')
-        for e in self.state['slot']:
-            if len(self.state['slot'][e])!=0:
+        for e in state['slot']:
+            if len(state['slot'][e])!=0:
                 print(e,end='')
-                for e2 in self.state['slot'][e]:
+                for e2 in state['slot'][e]:
                     print(' ',end='')
                     print(e2,end='')
-                    print(':',self.state['slot'][e][e2],end='')
+                    print(':',state['slot'][e][e2],end='')
                     print(' ',end='')
         print('\n')
         print('confirmed state:')
@@ -424,7 +805,10 @@ class Manager():
         print('\n\n\n')
 
  
+    @traced('action_to_sentence')
     def action_to_sentence(self,action):
+        if 'action' not in action: # the dialogue ended without an answer
+            return ''
         if action['action'] == 'question' and 'slot' in action and 'playlist' in action['slot']:
             sent = u'可以跟我說歌單的名稱嗎?(填歌單名稱就好)'
             return sent
@@ -469,6 +853,14 @@ class Manager():
 
 
 
+def _session_property(name):
+    return property(lambda self: getattr(self.session,name),
+                    lambda self,value: setattr(self.session,name,value))
+
+for _name in DialogueState.__slots__:
+    setattr(Manager,_name,_session_property(_name))
+
+
 def test(args):
     
     DM = Manager(args.nlu_data , args.model, args.genre_map, verbose=args.verbose)
@@ -535,15 +927,20 @@ def auto_test(args):
 
 def stdin_test(args):
 
-    DM = Manager(args.nlu_data , args.model, args.genre_map, args.spotify_playlist,
-                 args.spotify_account, verbose=args.verbose)
+    services = DialogueServices(args.nlu_data , args.model, args.genre_map, args.spotify_playlist,
+                                args.spotify_account, verbose=args.verbose, cassette=open_cassette(args))
+    DM = Manager(services=services)
+    transcripts = TranscriptWriter(args.transcript) if args.transcript else None
 
     turn = 0
     while True:
         print('\n>',end='')
         sentence = sys.stdin.readline()
         sentence = sentence.decode('utf-8').strip()
+        start_time = time.time()
         action = DM.get_input(sentence)
+        if transcripts is not None:
+            transcripts.record('stdin',DM,sentence,action,time.time()-start_time)
         DM.print_current_state()
         print(DM.action_to_sentence(action))
         if DM.dialogue_end:
@@ -7,7 +7,9 @@ import time
 import sys
 sys.path.append('./')
 from userSimulator import Simulator
-from Dialogue_Manager import Manager
+from Dialogue_Manager import Manager, DialogueServices, SessionStore, open_cassette
+from state_store import open_state_store
+from transcript import TranscriptWriter
 import argparse
 
 def optParser():
@@ -27,13 +29,48 @@ def optParser():
     parser.add_argument('spotify_account', help='your spotify account')
     parser.add_argument('--random',action='store_true',help='whether to random user goal')
     parser.add_argument('-v',dest='verbose',default=False,action='store_true',help='verbose')
+    parser.add_argument('--state_store',default='',type=str,\
+            help='keep dialogue states in memory|<file>.db|<directory>, default: process memory only')
+    parser.add_argument('--debug',default=False,action='store_true',help='print NLU results and state of every turn')
+    parser.add_argument('--transcript',default='',type=str,\
+            help='append every turn to this transcript log, see replay_transcripts.py')
+    parser.add_argument('--cassette',default='',type=str,help='record or replay the spotify calls in this sqlite file')
+    parser.add_argument('--cassette_mode',default='replay',type=str,help='record|replay')
     args = parser.parse_args()
     return args
 
+def session_key():
+    ''' One dialogue per user and room '''
+    return (session.get('room'), session.get('name'))
+
 args = optParser()
 simulator = Simulator('./data/template/','./data/chinese_artist.json','./data/genres.json', './data/genre_map.json')
-DM = Manager(args.nlu_data, args.model, args.genre_map, args.spotify_playlist, args.spotify_account, verbose=args.verbose)
+services = DialogueServices(args.nlu_data, args.model, args.genre_map, args.spotify_playlist, args.spotify_account, verbose=args.verbose,
+                            debug=args.debug, cassette=open_cassette(args))
+sessions = SessionStore(services, backend=open_state_store(args.state_store) if args.state_store else None)
+transcripts = TranscriptWriter(args.transcript) if args.transcript else None
 PLAY_TYPES = ['search', 'playlistPlay', 'playlistSpotify']
+FINAL_ACTION_TIMEOUT = 10.0
+FINAL_ACTION_FALLBACK = u'抱歉，音樂服務目前沒有回應，請稍後再試一次'
+
+def push_final_result(future, end_type, room):
+    """Emit the answer of an ended dialogue once its API call finished.
+    Polls with socketio.sleep so the event loop keeps serving meanwhile."""
+    deadline = time.time() + FINAL_ACTION_TIMEOUT
+    while not future.done() and time.time() < deadline:
+        socketio.sleep(0.05)
+    try:
+        sentence, url = future.result(timeout=0)
+    except Exception as e:
+        print('final action failed: %r' % (e,))
+        socketio.emit('message', {'u_name':'Music Bot', 'msg': FINAL_ACTION_FALLBACK}, room=room, namespace='/chat')
+        return
+    socketio.emit('message', {'u_name':'Music Bot', 'msg': sentence}, room=room, namespace='/chat')
+    if end_type in PLAY_TYPES:
+        socketio.emit('message', {'u_name':'Music Bot', 'toPlay':1, 'url':url}, room=room, namespace='/chat')
+    if end_type == 'recommend':
+        for u in url[:3]:
+            socketio.emit('message', {'u_name':'Music Bot', 'toPlay':1, 'url':u}, room=room, namespace='/chat')
 
 @socketio.on('joined', namespace='/chat')
 def joined(message):
@@ -41,8 +78,10 @@ def joined(message):
     A status message is broadcast to all people in the room."""
     room = session.get('room')
     join_room(room)
-    DM.state_init()
-    DM.user_name = session.get('name')
+    with sessions.manager(session_key(), session.get('name')) as DM:
+        DM.state_init()
+    if transcripts is not None:
+        transcripts.reset(session_key(), session.get('name'))
     emit('status', {'msg': session.get('name') + ' has entered the room.'}, room=room)
     emit('message', {'u_name':'Music Bot', 'msg': '你好，請問需要什麼服務？'}, room=room)
     emit('message', {'u_name':'Music Bot', 'msg': 'MusicBot提供的服務有：(1)聽歌：依據歌手及歌曲名稱找到你想要聽的歌 (2)推薦歌曲：依據歌手、歌曲名稱及曲風(古典、爵士、金屬、搖滾、吉他⋯⋯)推薦類似歌曲 (3)詢問歌手或歌曲資訊 (4)建立播放清單及新增歌曲 (5)播放自訂或公共播放清單'}, room=room)
@@ -57,26 +96,22 @@ def text(message):
     sent = message['msg']
     emit('message', {'u_name':name,'msg':sent}, room=room)
 
-    
-    action = DM.get_input(sent)
-    DM.print_current_state() # Debug
 
-    DM_response = DM.action_to_sentence(action)
-    if len(DM_response) > 0:
-        emit('message', {'u_name':'Music Bot', 'msg': DM.action_to_sentence(action)}, room=room)
-    if DM.dialogue_end:
-        emit('message', {'u_name':'Music Bot', 'msg': DM.dialogue_end_sentence}, room=room)
-        if DM.dialogue_end_type in PLAY_TYPES  :
-            emit('message',{'u_name':'Music Bot', 'toPlay':1, 'url':DM.dialogue_end_track_url})
-        if DM.dialogue_end_type == 'recommend':
-            emit('message',{'u_name':'Music Bot', 'toPlay':1, 'url':DM.dialogue_end_track_url[0]})
-            emit('message',{'u_name':'Music Bot', 'toPlay':1, 'url':DM.dialogue_end_track_url[1]})
-            emit('message',{'u_name':'Music Bot', 'toPlay':1, 'url':DM.dialogue_end_track_url[2]})
+    with sessions.manager(session_key(), name, async_final=True) as DM:
+        start_time = time.time()
+        action = DM.get_input(sent)
+        if transcripts is not None:
+            transcripts.record(session_key(), DM, sent, action, time.time() - start_time)
+        if DM.tracer.debug:
+            DM.print_current_state()
 
-        print('\nCongratulation!!! You have ended one dialogue successfully\n')
-        DM.state_init(1) # soft init
-    
-    
+        DM_response = DM.action_to_sentence(action)
+        if len(DM_response) > 0:
+            emit('message', {'u_name':'Music Bot', 'msg': DM.action_to_sentence(action)}, room=room)
+        if DM.dialogue_end:
+            socketio.start_background_task(push_final_result, DM.final_result, DM.dialogue_end_type, room)
+            print('\nCongratulation!!! You have ended one dialogue successfully\n')
+            DM.state_init(1) # soft init
 
 
 @socketio.on('slot', namespace='/chat')
@@ -92,9 +127,11 @@ def slot(message):
     emit('message', {'msg': session.get('name') + ': ' + sent}, room=room)
     
     
+    DM = Manager(services=services, user_name=session.get('name'))
     while True:
         action = DM.get_input(sent)
-        DM.print_current_state()
+        if DM.tracer.debug:
+            DM.print_current_state()
         DM_response = DM.action_to_sentence(action)
         if DM_response is not None:
             emit('message', {'msg': 'Music Bot: ' + DM_response}, room=room)
@@ -113,4 +150,7 @@ def left(message):
     A status message is broadcast to all people in the room."""
     room = session.get('room')
     leave_room(room)
+    sessions.remove(session_key())
+    if transcripts is not None:
+        transcripts.reset(session_key(), session.get('name'))
     emit('status', {'msg': session.get('name') + ' has left the room.'}, room=room)
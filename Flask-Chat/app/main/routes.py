@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from flask import session, redirect, url_for, render_template, request
+from flask import session, redirect, url_for, render_template, request, Response
 from . import main
 from .forms import LoginForm
 
@@ -26,4 +26,11 @@ def chat():
     room = session.get('room', '')
     if name == '' or room == '':
         return redirect(url_for('.index'))
-    return render_template('chat.html', name=name, room=room)
\ No newline at end of file
+    return render_template('chat.html', name=name, room=room)
+
+
+@main.route('/metrics')
+def metrics():
+    """Latency histograms of the dialogue turn stages, Prometheus text format."""
+    from .events import services
+    return Response(services.tracer.prometheus(), mimetype='text/plain')
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+'''
+Array-backed belief state of the dialogue manager.
+
+Intent scores are a vector indexed by the fixed INTENTS table. Slot values
+are interned into one value table shared by every slot, and slot scores are
+a (slot x value) matrix with a mask telling which slot holds which value;
+the mask column of a value is its value -> slots inverted index. Adding a
+score is O(1), and suppressing a value in the other slots or ranking the
+values of a slot are array operations.
+'''
+import numpy as np
+
+INTENTS = ('search','recommend','info','playlistCreate','playlistAdd','playlistPlay',
+           'playlistShow','playlistTrack')
+SLOTS = ('track','artist','genre','playlist','spotify_playlist')
+INTENT_INDEX = dict((e,i) for i,e in enumerate(INTENTS))
+SLOT_INDEX = dict((e,i) for i,e in enumerate(SLOTS))
+
+
+class BeliefState(object):
+    __slots__ = ('intent_scores','slot_scores','slot_mask','values','value_index')
+
+    def __init__(self,capacity=16):
+        self.intent_scores = np.zeros(len(INTENTS))
+        self.slot_scores = np.zeros((len(SLOTS),capacity))
+        self.slot_mask = np.zeros((len(SLOTS),capacity),dtype=bool)
+        self.values = []
+        self.value_index = {}
+
+    def intern(self,value):
+        ''' Return the id of value in the value table, added if new '''
+        vid = self.value_index.get(value)
+        if vid is None:
+            vid = len(self.values)
+            if vid == self.slot_scores.shape[1]:
+                self.slot_scores = np.hstack([self.slot_scores,np.zeros_like(self.slot_scores)])
+                self.slot_mask = np.hstack([self.slot_mask,np.zeros_like(self.slot_mask)])
+            self.values.append(value)
+            self.value_index[value] = vid
+        return vid
+
+    def add_intent(self,intent,score):
+        self.intent_scores[INTENT_INDEX[intent]] += score
+
+    def set_intent(self,intent,score):
+        ''' Intents outside INTENTS (e.g. the empty intent of a question) are ignored '''
+        if intent in INTENT_INDEX:
+            self.intent_scores[INTENT_INDEX[intent]] = score
+
+    def add_slot(self,slot,value,score):
+        s, v = SLOT_INDEX[slot], self.intern(value)
+        if self.slot_mask[s,v]:
+            self.slot_scores[s,v] += score
+        else:
+            self.slot_mask[s,v] = True
+            self.slot_scores[s,v] = score
+
+    def set_slot(self,slot,value,score):
+        s, v = SLOT_INDEX[slot], self.intern(value)
+        self.slot_mask[s,v] = True
+        self.slot_scores[s,v] = score
+
+    def suppress_other_slots(self,slot,value,score=-1.0):
+        ''' Set the score of value in every slot holding it except slot '''
+        v = self.value_index.get(value)
+        if v is None:
+            return
+        holders = self.slot_mask[:,v].copy()
+        holders[SLOT_INDEX[slot]] = False
+        self.slot_scores[holders,v] = score
+
+    def has_values(self,slot):
+        return bool(self.slot_mask[SLOT_INDEX[slot],:len(self.values)].any())
+
+    def best_intent(self):
+        ''' Return (intent, score) of the best positive intent, ('', 0.0) if none '''
+        i = int(np.argmax(self.intent_scores))
+        if self.intent_scores[i] > 0.0:
+            return INTENTS[i], float(self.intent_scores[i])
+        return '', 0.0
+
+    def ranked_values(self,slot):
+        ''' Return [(value, score)] of the slot with a positive score, best first '''
+        s, n = SLOT_INDEX[slot], len(self.values)
+        scores = np.where(self.slot_mask[s,:n],self.slot_scores[s,:n],0.0)
+        ids = np.flatnonzero(scores > 0.0)
+        ids = ids[np.argsort(-scores[ids],kind='mergesort')]
+        return [(self.values[v],float(scores[v])) for v in ids]
+
+    def as_dict(self):
+        ''' The state in the {'intent':{..}, 'slot':{slot:{value:score}}} layout '''
+        n = len(self.values)
+        slot = {}
+        for s, name in enumerate(SLOTS):
+            slot[name] = dict((self.values[v],float(self.slot_scores[s,v]))
+                              for v in np.flatnonzero(self.slot_mask[s,:n]))
+        return {'intent':dict(zip(INTENTS,self.intent_scores.tolist())),'slot':slot}
+
+    def to_dict(self):
+        ''' Compact json-able form, see from_dict '''
+        n = len(self.values)
+        slot = {}
+        for s, name in enumerate(SLOTS):
+            ids = np.flatnonzero(self.slot_mask[s,:n])
+            if len(ids):
+                slot[name] = [[int(v),float(self.slot_scores[s,v])] for v in ids]
+        return {'intent':dict(zip(INTENTS,self.intent_scores.tolist())),
+                'values':list(self.values),'slot':slot}
+
+    @classmethod
+    def from_dict(cls,d):
+        belief = cls(capacity=max(16,len(d['values'])))
+        for intent, score in d['intent'].items():
+            belief.set_intent(intent,score)
+        for value in d['values']:
+            belief.intern(value)
+        for name, scores in d['slot'].items():
+            s = SLOT_INDEX[name]
+            for v, score in scores:
+                belief.slot_mask[s,v] = True
+                belief.slot_scores[s,v] = score
+        return belief
+
+    def __repr__(self):
+        return repr(self.as_dict())
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+'''
+Simulation benchmark of the whole dialogue stack.
+
+A fixed-seed set of user goals is simulated against the dialogue manager,
+once per DB backend: 'local' (ontology.localDatabase) and 'recorded'
+(ontology.recordedDatabase, the responses of the local run served from a
+json file, recorded first if missing). Every run reports dialogues/sec,
+turns/sec, the per-turn latency of each stage (simulator, NLU, rule NLU,
+DST, policy, DB, NLG), the tracer histograms, the resident memory after the
+run and its growth during it, and the simulation accuracy. The peak
+memory is the one of the whole process. The results are written as json
+and compared against a baseline file, and the exit status is 1 on a
+regression, 2 when the baseline was run with another --nb_dialogue or
+--seed.
+
+No baseline is committed, the timings only compare on the same machine:
+it is written with --save_baseline on the reference machine and kept
+there, e.g. as a CI artifact, and CI passes it back with --baseline and
+--require_baseline. Without a baseline the results are only printed and
+the exit status is 0, unless --require_baseline is given (status 2).
+
+e.g.
+    python benchmark.py --output bench.json
+    python benchmark.py --output bench.json --save_baseline  # on the reference machine
+    python benchmark.py --baseline /path/to/baseline.json --require_baseline  # in CI
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+import numpy as np
+
+from Dialogue_Manager import Manager, DialogueServices, DialogueState
+from userSimulator import Simulator, intents
+from ontology.localDatabase import LocalDatabase
+from ontology.recordedDatabase import RecordingDatabase, RecordedDatabase
+
+# per turn latency breakdown: name -> tracer stages (prefixes ending with '.')
+# the DB checks are made by the state tracking, so they are also part of dst
+STAGE_GROUPS = [('simulator',['simulator']),
+                ('nlu',['nlu.NLU']),
+                ('rule_nlu',['nlu.RULE']),
+                ('dst',['state_tracking']),
+                ('policy',['action_maker']),
+                ('db',['db.']),
+                ('nlg',['action_to_sentence'])]
+# metric -> +1 if higher is better, -1 if lower is better
+COMPARED = {'dialogues_per_sec':1,'turns_per_sec':1}
+
+
+def optParser():
+    parser = argparse.ArgumentParser(description='Simulation benchmark of the dialogue stack')
+    parser.add_argument('--template_dir',default='./data/template/',help='sentence template directory')
+    parser.add_argument('--data',default='./data/chinese_artist.json',help='artist-album-track json data')
+    parser.add_argument('--genre',default='./data/genres.json',help='genres')
+    parser.add_argument('--genre_map',default='./data/genre_map.json',type=str,help='genre_map.json path')
+    parser.add_argument('--spotify_playlist',default='./data/spotify_playlist.json',\
+            type=str,help='spotify_playlist.json path')
+    parser.add_argument('--nlu_data', default='./data/nlu_data/',type=str, help='data dir')
+    parser.add_argument('--model',default='./model_tmp/',type=str,help='model dir')
+    parser.add_argument('--nb_dialogue',default=200,type=int,help='dialogues per backend')
+    parser.add_argument('--seed',default=0,type=int,help='seed of the goal set and of the simulation')
+    parser.add_argument('--backends',default='local,recorded',type=str,help='comma separated: local,recorded')
+    parser.add_argument('--recording',default='./benchmarks/db_responses.json',type=str,\
+            help='responses of the recorded backend, recorded with the local one if missing')
+    parser.add_argument('--output',default='',type=str,help='write the results to this json file')
+    parser.add_argument('--baseline',default='./benchmarks/baseline.json',type=str,help='baseline results')
+    parser.add_argument('--save_baseline',default=False,action='store_true',help='write the results as the baseline')
+    parser.add_argument('--require_baseline',default=False,action='store_true',\
+            help='exit with 2 when there is no baseline instead of only printing the results')
+    parser.add_argument('--tolerance',default=0.2,type=float,help='allowed relative slowdown against the baseline')
+    parser.add_argument('--min_ms',default=0.1,type=float,\
+            help='stage latency increases below this many ms per turn are never regressions')
+    args = parser.parse_args()
+    return args
+
+
+def goal_set(simulator, nb_dialogue, seed):
+    ''' nb_dialogue random goals (intent, artist, track, genre), the same for a seed '''
+    random.seed(seed)
+    goals = []
+    for _ in range(nb_dialogue):
+        simulator.set_user_goal(random_init=True)
+        slot = simulator.cur_slot
+        goals.append((simulator.cur_intent, slot['artist'], slot['track'], slot['genre']))
+    return goals
+
+
+def peak_memory_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0*1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def current_rss_mb():
+    ''' Resident set size of this process in MB (peak RSS if /proc is unavailable) '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return peak_memory_mb()
+
+
+def simulate(services, simulator, goals, seed):
+    ''' Simulate the goals against a fresh Manager, return the results of the run '''
+    tracer = services.tracer
+    tracer.reset()
+    random.seed(seed)
+    np.random.seed(seed)
+    DM = Manager(services=services,session=DialogueState())
+    turns = 0
+    success = 0
+    start_time = time.time()
+    for intent, artist, track, genre in goals:
+        DM.state_init()
+        simulator.set_user_goal(intent=intent,artist=artist,track=track,genre=genre)
+        with tracer.span('simulator'):
+            user_sent = simulator.user_response(start=True)
+        while True:
+            action = DM.get_input(user_sent)
+            DM.action_to_sentence(action)
+            turns += 1
+            with tracer.span('simulator'):
+                user_sent = simulator.user_response(action)
+            if DM.dialogue_end:
+                break
+        if simulator.cur_success:
+            success += 1
+    seconds = time.time()-start_time
+
+    stages = tracer.snapshot()
+    breakdown = {}
+    for group, names in STAGE_GROUPS:
+        total = sum(h['sum'] for stage, h in stages.items()
+                    if any(stage == n or (n.endswith('.') and stage.startswith(n)) for n in names))
+        breakdown[group] = 1000.0*total/max(1,turns)
+    return {'dialogues':len(goals),'turns':turns,'seconds':seconds,
+            'dialogues_per_sec':len(goals)/seconds,'turns_per_sec':turns/seconds,
+            'acc_final':success/float(max(1,len(goals))),
+            'ms_per_turn':breakdown,'stages':stages}
+
+
+def compare(results, baseline, tolerance, min_ms):
+    ''' Print the changes against the baseline, return the regressions '''
+    regressions = []
+    for backend in sorted(results):
+        if backend not in baseline:
+            continue
+        new, old = results[backend], baseline[backend]
+        for metric, direction in sorted(COMPARED.items()):
+            change = (new[metric]-old[metric])/old[metric] if old[metric] else 0.0
+            print('%-9s %-18s %10.2f -> %10.2f (%+.1f%%)' % (backend,metric,old[metric],new[metric],100*change))
+            if direction*change < -tolerance:
+                regressions.append('%s %s' % (backend,metric))
+        for group, _ in STAGE_GROUPS:
+            old_ms, new_ms = old['ms_per_turn'].get(group,0.0), new['ms_per_turn'][group]
+            print('%-9s %-18s %8.3fms -> %8.3fms' % (backend,group,old_ms,new_ms))
+            if new_ms-old_ms > max(tolerance*old_ms,min_ms):
+                regressions.append('%s %s latency' % (backend,group))
+        if new['acc_final'] != old['acc_final']:
+            print('%-9s acc_final changed %f -> %f' % (backend,old['acc_final'],new['acc_final']))
+    return regressions
+
+
+def main(args):
+    backends = args.backends.split(',')
+    local_db = LocalDatabase(args.data,args.genre_map,args.spotify_playlist,seed=args.seed)
+    services = DialogueServices(args.nlu_data,args.model,None,None,None,DB=local_db)
+    simulator = Simulator(args.template_dir,args.data,args.genre,args.genre_map,intents)
+    goals = goal_set(simulator,args.nb_dialogue,args.seed)
+
+    results = {}
+    for backend in backends:
+        # ru_maxrss never goes down, each backend reports its own growth instead
+        rss_before = current_rss_mb()
+        if backend == 'local':
+            local_db.rng.seed(args.seed)
+            services.DB = local_db
+        elif backend == 'recorded':
+            if not os.path.exists(args.recording):
+                print('Recording the DB responses to %s' % args.recording)
+                local_db.rng.seed(args.seed)
+                services.DB = RecordingDatabase(local_db)
+                simulate(services,simulator,goals,args.seed)
+                if not os.path.isdir(os.path.dirname(args.recording)):
+                    os.makedirs(os.path.dirname(args.recording))
+                services.DB.save(args.recording)
+            services.DB = RecordedDatabase(args.recording)
+        else:
+            raise ValueError('Unknown backend %s' % backend)
+        results[backend] = simulate(services,simulator,goals,args.seed)
+        r = results[backend]
+        r['rss_mb'] = current_rss_mb()
+        r['rss_delta_mb'] = r['rss_mb']-rss_before
+        print('%s: %d dialogues %d turns in %.1fs, %.1f dialogues/sec %.1f turns/sec, acc %.3f, memory %.0fMB (%+.0fMB)' %
+              (backend,r['dialogues'],r['turns'],r['seconds'],r['dialogues_per_sec'],r['turns_per_sec'],
+               r['acc_final'],r['rss_mb'],r['rss_delta_mb']))
+        print('  ms/turn: ' + ' '.join('%s %.3f' % (g,r['ms_per_turn'][g]) for g, _ in STAGE_GROUPS))
+    services.close()
+
+    report = {'nb_dialogue':args.nb_dialogue,'seed':args.seed,'results':results,
+              'peak_memory_mb':peak_memory_mb()}
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(report,f,indent=1,sort_keys=True)
+    if args.save_baseline:
+        if not os.path.isdir(os.path.dirname(args.baseline)):
+            os.makedirs(os.path.dirname(args.baseline))
+        with open(args.baseline,'w') as f:
+            json.dump(report,f,indent=1,sort_keys=True)
+        print('Baseline written to %s' % args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s, nothing compared (--save_baseline creates it on the reference machine)' % args.baseline)
+        return 2 if args.require_baseline else 0
+    with open(args.baseline,'r') as f:
+        baseline = json.load(f)
+    if (baseline['nb_dialogue'], baseline['seed']) != (args.nb_dialogue, args.seed):
+        print('Baseline ran %d dialogues with seed %d, not comparable' % (baseline['nb_dialogue'],baseline['seed']))
+        return 2
+    regressions = compare(results,baseline['results'],args.tolerance,args.min_ms)
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(optParser()))
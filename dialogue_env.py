@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+'''
+Lockstep environment of simulated users talking to the dialogue manager.
+
+LockstepEnv holds nb_envs user simulators and as many dialogue sessions on
+one DialogueServices. Every step collects the current user sentence of all
+of them, runs the NLU once on the whole batch (run_nlu_batch), advances each
+session with its results and lets each simulator answer. A finished episode
+is recorded and its slot restarts with a new random goal, so every step
+keeps nb_envs dialogues in flight.
+'''
+from __future__ import print_function
+
+import copy
+
+from Dialogue_Manager import Manager, DialogueState
+
+
+class LockstepEnv(object):
+    def __init__(self,services,simulator,nb_envs):
+        ''' simulator is shallow copied for every slot, the copies share its
+            loaded templates and catalog '''
+        self.services = services
+        self.simulators = [copy.copy(simulator) for _ in range(nb_envs)]
+        self.managers = [Manager(services=services,session=DialogueState()) for _ in range(nb_envs)]
+        self.sentences = [None]*nb_envs
+        self.turns = [0]*nb_envs
+        self.correct_turns = [0]*nb_envs
+
+    def start(self,i):
+        ''' Start a new episode with a random goal in slot i '''
+        self.managers[i].state_init()
+        self.simulators[i].set_user_goal(random_init=True)
+        self.sentences[i] = self.simulators[i].user_response(start=True)
+        self.turns[i] = 0
+        self.correct_turns[i] = 0
+
+    def step(self,active=None):
+        ''' Run one turn of the slots in active (default: all) with a batched NLU.
+            Return the episodes finished by this turn, as
+            (slot, {'intent','success','reward','turns','correct_turns'}).
+        '''
+        if active is None:
+            active = range(len(self.managers))
+        batch = self.services.run_nlu_batch([Manager.nlu_input(self.sentences[i]) for i in active])
+        finished = []
+        for i, stage_results in zip(active,batch):
+            US, DM = self.simulators[i], self.managers[i]
+            action = DM.get_input(self.sentences[i],stage_results=stage_results)
+            self.turns[i] += 1
+            if US.dst_cur_state_check(copy.deepcopy(DM.confirmed_state)):
+                self.correct_turns[i] += 1
+            self.sentences[i] = US.user_response(action)
+            if DM.dialogue_end:
+                finished.append((i,{'intent':US.cur_intent,'success':US.cur_success,
+                                    'reward':US.cur_reward,'turns':self.turns[i],
+                                    'correct_turns':self.correct_turns[i]}))
+        return finished
+
+    def run(self,nb_dialogue):
+        ''' Simulate nb_dialogue episodes, return their results in completion order '''
+        episodes = []
+        active = []
+        for i in range(min(nb_dialogue,len(self.managers))):
+            self.start(i)
+            active.append(i)
+        started = len(active)
+        while active:
+            for i, episode in self.step(active):
+                episodes.append(episode)
+                if started < nb_dialogue:
+                    self.start(i)
+                    started += 1
+                else:
+                    active.remove(i)
+        return episodes
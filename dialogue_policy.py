@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+'''
+policy_network as the action maker of the dialogue manager.
+
+A PolicyAgent is given to Manager(policy=...). On every turn that does not
+end the dialogue it replaces the rule-based confirm/question action by one of
+POLICY_ACTIONS, drawn from the network output over the valid actions given
+the state features of policy_state (10 values, the network input). The
+(state, action) of each decision are kept in the trajectory until finish
+turns them into (state, action one-hot, return) samples for training.
+'''
+import numpy as np
+
+POLICY_SLOTS = ['artist','track','genre','playlist']
+POLICY_ACTIONS = ['confirm_intent','question_intent','confirm_slot'] + ['question_' + s for s in POLICY_SLOTS]
+
+
+def policy_state(DM):
+    ''' [best intent prob, intent confirmed] + best prob and confirmed flag of each POLICY_SLOTS '''
+    state = [DM.max_intent_prob, float(DM.confirmed_state['intent'] is not None)]
+    for slot_name in POLICY_SLOTS:
+        state.append(DM.max_slot[slot_name][1] if DM.max_slot[slot_name] else 0.)
+    for slot_name in POLICY_SLOTS:
+        state.append(float(bool(DM.confirmed_state['slot'][slot_name])))
+    return np.array(state, dtype=np.float32)
+
+
+def _slots_to_confirm(DM):
+    intent = DM.confirmed_state['intent']
+    return dict((slot_name, DM.max_slot[slot_name][0]) for slot_name in DM.intent_slot_dict[intent]
+                if DM.max_slot.get(slot_name) and DM.confirmed_state['slot'][slot_name] != -1)
+
+
+def valid_actions(DM):
+    ''' Mask of the POLICY_ACTIONS that can be taken in the current state '''
+    intent = DM.confirmed_state['intent']
+    if intent is None:
+        return np.array([bool(DM.max_intent), True] + [False]*(len(POLICY_ACTIONS)-2))
+    mask = [False, False, len(_slots_to_confirm(DM)) > 0]
+    for slot_name in POLICY_SLOTS:
+        mask.append(slot_name in DM.intent_slot_dict[intent] and not DM.confirmed_state['slot'][slot_name])
+    return np.array(mask)
+
+
+def make_action(DM, index):
+    name = POLICY_ACTIONS[index]
+    if name == 'confirm_intent':
+        return {'action':'confirm','intent':DM.max_intent}
+    if name == 'question_intent':
+        return {'action':'question','intent':''}
+    if name == 'confirm_slot':
+        return {'action':'confirm','slot':_slots_to_confirm(DM)}
+    return {'action':'question','slot':{name[len('question_'):]:''}}
+
+
+class PolicyAgent(object):
+    def __init__(self, network, explore=True, seed=None):
+        ''' explore: sample the actions, otherwise take the most probable one '''
+        self.network = network
+        self.explore = explore
+        self.rng = np.random.RandomState(seed)
+        self.trajectory = []
+
+    def __call__(self, DM, rule_action):
+        ''' The action of the current turn, rule_action when no policy action is valid '''
+        mask = valid_actions(DM)
+        if not mask.any():
+            return rule_action
+        state = policy_state(DM)
+        p = self.network.get_action_distribution(state[None])[0] * mask
+        if p.sum() <= 0:
+            p = mask.astype(np.float64)
+        p = p / p.sum()
+        index = self.rng.choice(len(p), p=p) if self.explore else int(np.argmax(p))
+        self.trajectory.append((state, index))
+        return make_action(DM, index)
+
+    def finish(self, rewards, gamma=0.95):
+        ''' rewards: one per decision of the episode.
+            Return the (state, action one-hot, discounted return) samples and clear the trajectory.
+        '''
+        samples = []
+        ret = 0.
+        for (state, index), reward in reversed(list(zip(self.trajectory, rewards))):
+            ret = reward + gamma*ret
+            action = np.zeros(len(POLICY_ACTIONS), dtype=np.float32)
+            action[index] = 1.
+            samples.append((state, action, ret))
+        self.trajectory = []
+        return samples[::-1]
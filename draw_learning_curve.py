@@ -35,6 +35,57 @@ def load_performance_file(path):
             numbers['ave_rewards'].append(data['ave_reward'][str(key)])
     return numbers
 
+def load_telemetry_file(path):
+    """ load the NLU training telemetry (.jsonl) file, one record per checkpoint """
+    
+    records = [json.loads(line) for line in open(path, 'rb') if line.strip()]
+    if not records:
+        raise ValueError('No telemetry records in %s' % path)
+    # a run resumed from an earlier checkpoint logs its steps again, keep the latest record
+    records = sorted(dict((r['global_step'], r) for r in records).values(),
+                     key=lambda r: r['global_step'])
+    keys = set()
+    for r in records:
+        keys.update(r.keys())
+    numbers = dict((key, [r.get(key) for r in records]) for key in keys)
+    numbers['x'] = numbers['global_step']
+    return numbers
+
+def draw_training_telemetry(numbers):
+    """ draw throughput, time breakdown and eval metrics of a training run """
+    
+    fig, axes = plt.subplots(3, 1, sharex=True)
+    axes[0].set_ylabel('Examples/sec')
+    axes[0].plot(numbers['x'], numbers['examples_per_sec'], 'b', lw=1)
+    axes[0].grid(True)
+
+    axes[1].set_ylabel('Seconds')
+    for key in ['data_wait_sec', 'compute_sec', 'checkpoint_sec', 'eval_sec']:
+        if key in numbers:
+            axes[1].plot(numbers['x'], numbers[key], lw=1, label=key)
+    axes[1].legend(loc='best')
+    axes[1].grid(True)
+
+    axes[2].set_ylabel('Valid')
+    for key in ['valid_accuracy', 'valid_f1']:
+        if key in numbers:
+            axes[2].plot(numbers['x'], numbers[key], lw=1, label=key)
+    axes[2].legend(loc='best')
+    axes[2].grid(True)
+    axes[2].set_xlabel('Global Step')
+    plt.show()
+
+def read_telemetry_records(path):
+    """ print the NLU training telemetry (.jsonl) file """
+    
+    numbers = load_telemetry_file(path)
+    print("step\texamples/s\ttokens/s\tdata_wait\tcompute\tcheckpoint\teval\trss_mb\tvalid_acc\tvalid_f1")
+    for i, step in enumerate(numbers['x']):
+        print("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % tuple(
+            [step] + [numbers.get(key, [None]*len(numbers['x']))[i] for key in
+                      ['examples_per_sec', 'tokens_per_sec', 'data_wait_sec', 'compute_sec',
+                       'checkpoint_sec', 'eval_sec', 'rss_mb', 'valid_accuracy', 'valid_f1']]))
+
 def draw_learning_curve(numbers):
     """ draw the learning curve """
     
@@ -56,12 +107,17 @@ def main(params):
         draw_learning_curve(numbers)
     elif cmd == 1:
         read_performance_records(params['result_file'])
+    elif cmd == 2:
+        numbers = load_telemetry_file(params['result_file'])
+        draw_training_telemetry(numbers)
+    elif cmd == 3:
+        read_telemetry_records(params['result_file'])
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     
-    parser.add_argument('--cmd', dest='cmd', type=int, default=1, help='cmd')
+    parser.add_argument('--cmd', dest='cmd', type=int, default=1, help='cmd: 0 draw, 1 print performance records; 2 draw, 3 print NLU training telemetry')
     
     parser.add_argument('--result_file', dest='result_file', type=str, default='./deep_dialog/checkpoints/rl_agent/11142016/noe2e/agt_9_performance_records.json', help='path to the result file')
     
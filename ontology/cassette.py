@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''
+Record/replay of the spotipy calls made by databaseAPI.Database.
+
+A Cassette wraps the spotipy client. In 'record' mode every call goes to
+Spotify and its response (or SpotifyException) is appended to a sqlite file
+indexed by the request. In 'replay' mode the file is loaded into memory and
+the calls are answered from it without any network or token: the n-th call
+of a request gets its n-th recorded response, the last one once they are
+exhausted, so a recorded session replays exactly. Several processes may
+record into the same file.
+'''
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+
+from spotipy.client import SpotifyException
+
+MODES = ('record', 'replay')
+
+# paging calls take the whole previous page, only its url matters
+KEY_ARGS = {'next': lambda page: [page['next']],
+            'previous': lambda page: [page['previous']]}
+
+
+class CassetteMiss(KeyError):
+    ''' A replayed request that was never recorded '''
+
+
+def request_key(name, args, kwargs):
+    if name in KEY_ARGS:
+        args = KEY_ARGS[name](*args)
+    request = json.dumps([name, list(args), kwargs], sort_keys=True)
+    return hashlib.md5(request.encode('utf-8')).hexdigest(), request
+
+
+class Cassette(object):
+    def __init__(self, path, mode='replay'):
+        if mode not in MODES:
+            raise ValueError('Cassette mode must be one of %s' % ', '.join(MODES))
+        if mode == 'replay' and not os.path.isfile(path):
+            raise IOError('No cassette to replay at %s' % path)
+        self.path = path
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.__lock, self.__conn:
+            self.__conn.execute('CREATE TABLE IF NOT EXISTS spotify_call '
+                                '(key TEXT NOT NULL, seq INTEGER NOT NULL, request TEXT NOT NULL, '
+                                'response TEXT NOT NULL, PRIMARY KEY (key, seq))')
+        # replay: key -> [response json] in call order, and the number of calls made
+        self.__responses = {}
+        self.__calls = {}
+        if not self.replaying:
+            return
+        with self.__lock:
+            for key, response in self.__conn.execute('SELECT key, response FROM spotify_call ORDER BY key, seq'):
+                self.__responses.setdefault(key, []).append(response)
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def wrap(self, client):
+        ''' Client whose calls go through the cassette, client is not used when replaying '''
+        return CassetteClient(client, self)
+
+    def call(self, name, method, args, kwargs):
+        key, request = request_key(name, args, kwargs)
+        if self.replaying:
+            return self.__replay(key, request)
+        try:
+            result = method(*args, **kwargs)
+        except SpotifyException as e:
+            self.__record(key, request, {'error': {'http_status': e.http_status, 'code': e.code, 'msg': e.msg}})
+            raise
+        self.__record(key, request, {'result': result})
+        return result
+
+    def __replay(self, key, request):
+        with self.__lock:
+            responses = self.__responses.get(key)
+            if not responses:
+                self.misses += 1
+                raise CassetteMiss(request)
+            n = self.__calls.get(key, 0)
+            self.__calls[key] = n + 1
+            self.hits += 1
+            response = json.loads(responses[min(n, len(responses) - 1)])
+        if 'error' in response:
+            error = response['error']
+            raise SpotifyException(error['http_status'], error['code'], error['msg'])
+        return response['result']
+
+    def __record(self, key, request, response):
+        data = json.dumps(response, sort_keys=True)
+        # seq is taken in the database, other processes may record the same request
+        with self.__lock, self.__conn:
+            self.__conn.execute('INSERT INTO spotify_call (key, seq, request, response) '
+                                'SELECT ?, COALESCE(MAX(seq)+1, 0), ?, ? FROM spotify_call WHERE key=?',
+                                (key, request, data, key))
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()
+
+
+class CassetteClient(object):
+    ''' spotipy.Spotify proxy routing the method calls through a Cassette '''
+    def __init__(self, client, cassette):
+        self.__client = client
+        self.__cassette = cassette
+
+    def __getattr__(self, name):
+        if self.__cassette.replaying:
+            method = None
+        else:
+            method = getattr(self.__client, name)
+            if not callable(method):
+                return method
+        cassette = self.__cassette
+        def call(*args, **kwargs):
+            return cassette.call(name, method, args, kwargs)
+        return call
@@ -7,27 +7,33 @@ import json
 
 from random import randrange
 from operator import itemgetter
-from spotipy.oauth2 import SpotifyClientCredentials
 
 SCOPE = ('playlist-modify-private playlist-read-private playlist-modify-public '
          'playlist-read-collaborative')
 SPOTIFY_EMBED_PREFIX = 'https://open.spotify.com/embed?uri='
 
 class Database():
-    def __init__(self, genre_map_path, spotify_playlist_map_path, spotify_id,verbose=False):
-        client_credentials_manager = SpotifyClientCredentials()
-        self.__sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
-        token = spotipy.util.prompt_for_user_token(spotify_id, SCOPE)
-        self.__sp = spotipy.Spotify(auth=token)
-        
+    def __init__(self, genre_map_path, spotify_playlist_map_path, spotify_id,verbose=False,cassette=None):
+        ''' cassette: ontology.cassette.Cassette recording or replaying the spotify calls '''
         self.spotify_id = spotify_id
-        self.__sp.trace = verbose #NOTE dubug
+        self.verbose = verbose #NOTE dubug
+        self.cassette = cassette
+        self.__connect()
 
         with open(genre_map_path,'r') as f:
             self.genre_map = json.load(f)
         with open(spotify_playlist_map_path) as f:
             self.spotifyPL2uri = json.load(f)
 
+    def __connect(self):
+        ''' (Re)connect with a fresh user token, no token is needed to replay a cassette '''
+        sp = None
+        if self.cassette is None or not self.cassette.replaying:
+            token = spotipy.util.prompt_for_user_token(self.spotify_id, SCOPE)
+            sp = spotipy.Spotify(auth=token)
+            sp.trace = self.verbose
+        self.__sp = self.cassette.wrap(sp) if self.cassette is not None else sp
+
     def __get_artist(self, artist_name):
         results = self.__sp.search(q='artist:' + artist_name, type='artist', limit=50)
         items = results['artists']['items']
@@ -187,8 +193,7 @@ class Database():
         url = ''
         sentence = ''
         
-        token = spotipy.util.prompt_for_user_token(self.spotify_id, SCOPE)
-        self.__sp = spotipy.Spotify(auth=token)
+        self.__connect()
 
         playlist_name_db = self.__playlist_name2dbname(username, playlist_name)
         playlists = self.__sp.user_playlist_create(self.spotify_id, playlist_name_db, public=False)
@@ -202,8 +207,7 @@ class Database():
         sentence = ''
         url = ''
 
-        token = spotipy.util.prompt_for_user_token(self.spotify_id, SCOPE)
-        self.__sp = spotipy.Spotify(auth=token)
+        self.__connect()
         playlist_id = self.__get_playlist_id(username, playlist_name)
 
         # handle no track slot bulshit
@@ -230,8 +234,7 @@ class Database():
     def playlistPlay(self, username, playlist_name):
         url = ''
         sentence = ''
-        token = spotipy.util.prompt_for_user_token(self.spotify_id, SCOPE)
-        self.__sp = spotipy.Spotify(auth=token)
+        self.__connect()
         playlist_id = self.__get_playlist_id(username, playlist_name)
         if len(playlist_id) > 0: # if found this playlist
             sentence = u'為您播放清單 ' + playlist_name
@@ -273,8 +276,7 @@ class Database():
         sentence = ''
         url = ''
 
-        token = spotipy.util.prompt_for_user_token(self.spotify_id, SCOPE)
-        self.__sp = spotipy.Spotify(auth=token)
+        self.__connect()
 
         playlist_id = self.__get_playlist_id(username, playlist_name)
         if len(playlist_id) > 0: # if playlist found
@@ -300,8 +302,7 @@ class Database():
         offset = 0
         playlists = []
         if self.__check_user_exist(username):
-            token = spotipy.util.prompt_for_user_token(self.spotify_id, SCOPE)
-            self.__sp = spotipy.Spotify(auth=token)
+            self.__connect()
             while True:
                 playlists_cur = self.__sp.user_playlists(self.spotify_id,
                                 offset=offset, limit=50)['items']
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+'''
+Offline stand-in for databaseAPI.Database, answering from the artist-album-track
+catalog the user simulator draws its goals from (data/chinese_artist.json).
+
+Same methods and return values as Database, without spotipy, network or
+tokens, so simulations can run many dialogues in parallel processes.
+Recommendations are drawn with a random.Random seeded by the caller, user
+playlists live in memory.
+'''
+import json
+import random
+
+LOCAL_URI_PREFIX = 'local:'
+
+
+def _norm(name):
+    return name.replace(' ','').lower()
+
+
+class LocalDatabase():
+    def __init__(self, data_path, genre_map_path, spotify_playlist_map_path=None, seed=None):
+        with open(data_path,'r') as f:
+            data_artist = json.load(f)
+        with open(genre_map_path,'r') as f:
+            self.genre_map = json.load(f)
+        self.spotifyPL2uri = {}
+        if spotify_playlist_map_path is not None:
+            with open(spotify_playlist_map_path) as f:
+                self.spotifyPL2uri = json.load(f)
+        self.rng = random.Random(seed)
+
+        self.tracks = [] # track items, in catalog order
+        self.track_index = {} # normalized track name -> track items
+        self.artist_index = {} # normalized artist name -> (artist, {album: [track items]})
+        for artist in sorted(data_artist):
+            albums = {}
+            for album in sorted(data_artist[artist]):
+                albums[album] = []
+                for track in data_artist[artist][album]:
+                    item = {'name':track, 'artists':[{'name':artist}], 'album':{'name':album},
+                            'id':str(len(self.tracks)),
+                            'uri':LOCAL_URI_PREFIX + 'track:' + str(len(self.tracks))}
+                    self.tracks.append(item)
+                    albums[album].append(item)
+                    self.track_index.setdefault(_norm(track),[]).append(item)
+            self.artist_index[_norm(artist)] = (artist, albums)
+        self.playlists = {} # username -> {playlist_name: [track items]}
+
+    def __artist_tracks(self, artist_name):
+        if _norm(artist_name) not in self.artist_index:
+            return []
+        _, albums = self.artist_index[_norm(artist_name)]
+        return [t for album in sorted(albums) for t in albums[album]]
+
+    def check_track(self, track_name):
+        ''' Return number of track search results '''
+        return len(self.track_index.get(_norm(track_name),[]))
+
+    def check_artist(self, artist_name):
+        ''' Return number of artist search results '''
+        return 1 if _norm(artist_name) in self.artist_index else 0
+
+    def search(self, slots):
+        url = ''
+        if 'track' in slots:
+            items = self.track_index.get(_norm(slots['track']),[])
+            if 'artist' in slots:
+                items = [t for t in items if _norm(t['artists'][0]['name']) == _norm(slots['artist'])] or items
+            if len(items) > 0:
+                sentence = (u'幫你播 ' + items[0]['artists'][0]['name'] + u' 的 ' + items[0]['name'])
+                url = items[0]['uri']
+            else:
+                sentence = (u'Sorry Not Found...')
+        elif 'artist' in slots:
+            items = self.__artist_tracks(slots['artist'])
+            if len(items) > 0:
+                sentence = (u'幫你播 ' + items[0]['artists'][0]['name'] + u' 的歌')
+                url = LOCAL_URI_PREFIX + 'artist:' + items[0]['artists'][0]['name']
+            else:
+                sentence = (u'Sorry Not Found...')
+        else:
+            items = []
+            sentence = u'No search query'
+        return items, sentence, url
+
+    def info(self, slots):
+        infos = {}
+        sentence = (u'Sorry Not Found...')
+        if 'track' in slots:
+            items = self.track_index.get(_norm(slots['track']),[])
+            if len(items) > 0:
+                track = items[0]
+                infos = {'artist':track['artists'][0]['name'],
+                         'album':track['album']['name'], 'track':track['name']}
+                sentence = (u'這是'+infos['artist']+u'的歌曲 專輯:'+ infos['album']+u' 歌曲:'+infos['track'])
+        elif 'artist' in slots and _norm(slots['artist']) in self.artist_index:
+            artist, albums = self.artist_index[_norm(slots['artist'])]
+            album = sorted(albums)[-1]
+            infos = {'artist':artist, 'genre':[], 'album':album,
+                     'track':[t['name'] for t in albums[album]]}
+            sentence = u'' + artist + u' 最熱門的歌曲:'
+            for t in infos['track'][:3]:
+                sentence += u' ' + t
+        return infos, sentence
+
+    def recommend(self, slots):
+        seeds = []
+        if 'artist' in slots:
+            seeds = self.__artist_tracks(slots['artist'])
+        if not seeds and 'track' in slots:
+            items = self.track_index.get(_norm(slots['track']),[])
+            if items:
+                seeds = self.__artist_tracks(items[0]['artists'][0]['name'])
+        if not seeds and 'genre' in slots and slots['genre'] in self.genre_map:
+            seeds = self.tracks
+        items = self.rng.sample(seeds,min(4,len(seeds)))
+
+        urls = []
+        tracks = []
+        if len(items) > 0:
+            sentence = u'為你推薦 '
+            for track in items:
+                sentence += u'' + track['artists'][0]['name'] + u'的' + track['name'] + u','
+                urls.append(track['uri'])
+                tracks.append(track['name'])
+            sentence = sentence[:-1]
+        else:
+            sentence = (u'No recommended songs...')
+        return tracks, sentence, urls
+
+    def __playlist_url(self, username, playlist_name):
+        return LOCAL_URI_PREFIX + 'playlist:' + username + ':' + playlist_name
+
+    def playlistCreate(self, username, playlist_name):
+        self.playlists.setdefault(username,{})[playlist_name] = []
+        return u'為您新增播放清單 ' + playlist_name, self.__playlist_url(username,playlist_name)
+
+    def playlistAdd(self, username, playlist_name, slots):
+        if 'track' not in slots:
+            return u'請填入歌曲名稱', ''
+        sentence = ''
+        url = ''
+        items, _, _ = self.search(slots)
+        playlist = self.playlists.get(username,{}).get(playlist_name)
+        if len(items) > 0 and playlist is not None:
+            playlist.append(items[0])
+            sentence = u'為您將 ' + items[0]['artists'][0]['name']+ u' 的 ' + items[0]['name'] + u' 加入清單 ' + playlist_name
+            url = self.__playlist_url(username,playlist_name)
+        if len(items) == 0:
+            sentence += u'很抱歉找不到此歌曲 '
+        if playlist is None:
+            sentence += u'沒有播放清單 ' + playlist_name
+        return sentence, url
+
+    def playlistPlay(self, username, playlist_name):
+        if playlist_name in self.playlists.get(username,{}):
+            return u'為您播放清單 ' + playlist_name, self.__playlist_url(username,playlist_name)
+        return u'沒有播放清單 ' + playlist_name, ''
+
+    def playlistSpotify(self, playlist_name):
+        url = ''
+        sentence = ''
+        if playlist_name in self.spotifyPL2uri:
+            url = self.rng.choice(self.spotifyPL2uri[playlist_name])
+            sentence = u'為您播放Spotify播放清單 ' + playlist_name
+        return sentence, url
+
+    def playlistShow(self, username):
+        names = sorted(self.playlists.get(username,{}))
+        if len(names) > 0:
+            return u'您的播放清單有: ' + u', '.join(names), names
+        return u'您目前沒有任何播放清單', names
+
+    def playlistTrack(self, username, playlist_name):
+        playlist = self.playlists.get(username,{}).get(playlist_name)
+        if playlist is None:
+            return u'沒有播放清單 ' + playlist_name, ''
+        if len(playlist) == 0:
+            sentence = u'播放清單 ' + playlist_name + u' 目前沒有任何歌曲'
+        else:
+            sentence = u'播放清單 ' + playlist_name + u' 有歌曲: ' + u', '.join(t['name'] for t in playlist)
+        return sentence, self.__playlist_url(username,playlist_name)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+'''
+Recorded responses of the Database methods.
+
+RecordingDatabase wraps a Database (or LocalDatabase) and keeps the results of
+every call in call order, keyed by method and json encoded arguments; save()
+writes them to a json file. RecordedDatabase serves such a file from memory
+without computing anything: the n-th call with some arguments gets the n-th
+recorded result (the last one once they are exhausted), so a run repeating
+the recorded one replays it exactly, random recommendations included.
+'''
+import json
+
+
+def call_key(name, args):
+    return name + json.dumps(args, sort_keys=True)
+
+
+class RecordingDatabase(object):
+    def __init__(self, db):
+        self.__db = db
+        self.responses = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self.__db, name)
+        if not callable(attr):
+            return attr
+        responses = self.responses
+        def call(*args):
+            result = attr(*args)
+            responses.setdefault(call_key(name, list(args)), []).append(result)
+            return result
+        return call
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.responses, f, sort_keys=True)
+
+
+class RecordedDatabase(object):
+    ''' Raises KeyError on a call missing from the recording '''
+    def __init__(self, path):
+        with open(path, 'r') as f:
+            self.responses = json.load(f)
+        self.calls = {}
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        responses, calls = self.responses, self.calls
+        def call(*args):
+            key = call_key(name, list(args))
+            results = responses[key]
+            n = calls.get(key, 0)
+            calls[key] = n + 1
+            return results[min(n, len(results) - 1)]
+        return call
@@ -1,15 +1,18 @@
 import tensorflow as tf
-import random
 import os
 import numpy as np
+from utils.checkpoint import AsyncSaver
+from utils.replay_buffer import ReplayBuffer
 
 class policy_network():
 
-    def __init__(self,model_dir,action_num=10):
-        self.memory = []
-        self.memory_size = 1000
+    def __init__(self,model_dir,action_num=10,memory_size=1000,prioritized=False):
+        ''' prioritized: replay the samples with a large |reward| more often '''
+        self.state_dim = 10
+        self.memory_size = memory_size
         self.batch_size = 64
         self.action_num = action_num
+        self.memory = ReplayBuffer(memory_size,self.state_dim,action_num,alpha=0.6 if prioritized else 0.)
         self.model_dir = model_dir
         self.load_model = False
         if not os.path.exists(self.model_dir):
@@ -23,7 +26,7 @@ class policy_network():
         self.graph = tf.Graph()
         with self.graph.as_default() as g:
             with g.name_scope( "policy_graph" ) as scope:
-                self.input_vec = tf.placeholder(dtype=tf.float32, shape=(None,10))
+                self.input_vec = tf.placeholder(dtype=tf.float32, shape=(None,self.state_dim))
                 self.reward = tf.placeholder(dtype=tf.float32,shape=(None))
                 self.sampled_action = tf.placeholder(dtype=tf.float32,shape=(None,self.action_num))
                 with tf.variable_scope("policy_linear0") as scope:
@@ -34,7 +37,12 @@ class policy_network():
 
                 self.loss = tf.reduce_mean(-self.reward*tf.log(tf.reduce_max(self.sampled_action*output,axis=-1)))
                 self.train_op = self.train_generator_op = tf.train.RMSPropOptimizer(0.001).minimize(self.loss)
+                # weights copied between processes by get_weights/set_weights
+                self.weights = tf.trainable_variables()
+                self.weight_inputs = [tf.placeholder(v.dtype.base_dtype, shape=v.get_shape()) for v in self.weights]
+                self.assign_weights = [v.assign(p) for v, p in zip(self.weights, self.weight_inputs)]
             self.saver = tf.train.Saver(max_to_keep=2)
+            self.async_saver = AsyncSaver(tf.global_variables(), max_to_keep=2)
             self.sess = tf.Session(graph = self.graph)
             if self.load_model:
                 self.saver.restore(self.sess, tf.train.latest_checkpoint(self.model_dir))
@@ -44,20 +52,21 @@ class policy_network():
 
 
     def update(self,num_batch=10):
+        ''' Train on num_batch minibatches sampled from the memory, return the mean loss '''
+        if len(self.memory) == 0:
+            return 0.0
         self.step += 1
         total_loss = 0.0
-        random.shuffle(self.memory)
-        input_vec = [self.memory[i][0] for i in range(self.batch_size)]
-        sampled_action = [self.memory[i][1] for i in range(self.batch_size)]
-        reward = [self.memory[i][2] for i in range(self.batch_size)]
-        feed_dict = {
-            self.input_vec:np.array(input_vec),
-            self.sampled_action:np.array(sampled_action),
-            self.reward:np.array(reward)
-        }
-        loss,_ = self.sess.run([self.loss,self.train_op],feed_dict=feed_dict)
-        total_loss += loss
-        self.memory = []
+        for _ in range(num_batch):
+            input_vec,sampled_action,reward,weights,_ = self.memory.sample(self.batch_size)
+            feed_dict = {
+                self.input_vec:input_vec,
+                self.sampled_action:sampled_action,
+                # the importance weights scale the reward, the loss is linear in it
+                self.reward:reward*weights
+            }
+            loss,_ = self.sess.run([self.loss,self.train_op],feed_dict=feed_dict)
+            total_loss += loss
         return total_loss/num_batch
 
 
@@ -66,15 +75,32 @@ class policy_network():
         return self.sess.run([self.action_distribution],feed_dict=feed_dict)[0]
 
 
+    def get_weights(self):
+        return self.sess.run(self.weights)
+
+
+    def set_weights(self,values):
+        self.sess.run(self.assign_weights,feed_dict=dict(zip(self.weight_inputs,values)))
+
+
     def add_memory(self,one_data):
-        self.memory.append(one_data)
+        ''' one_data: (state, action one-hot or index, reward) '''
+        state,action,reward = one_data
+        priority = abs(reward) + 1e-3 if self.memory.prioritized else None
+        self.memory.add(state,action,reward,priority)
 
 
 
     def save_model(self):
         path = self.model_dir + 'ckeckpoint'
-        self.saver.save(self.sess, path, global_step=self.step)
+        self.async_saver.save(self.sess, path, global_step=self.step)
 
 
     def load_model(self):
         self.saver.restore(self.sess, tf.train.latest_checkpoint(self.model_dir))
+
+
+    def close(self):
+        ''' Write the queued checkpoint and release the session '''
+        self.async_saver.close()
+        self.sess.close()
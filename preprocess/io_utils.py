@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 import sys
+import hashlib
 from random import shuffle
 
 def naive_seg(sentence):
@@ -75,6 +76,15 @@ def dump_to_file(X,POS,Intent,prefix, mode='w'):
     f_POS.close()
     f_Intent.close()
 
+def file_hash(path):
+    ''' md5 hex digest of the content of a file
+    '''
+    md5 = hashlib.md5()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
 
 if __name__ == '__main__':
     naive_seg('我想聽[s]的')
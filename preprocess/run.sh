@@ -6,21 +6,16 @@ DATA_DIR="../data/"
 TEMPLATE_DIR="../data/template/"
 OUT_PATH="../data/nlu_data/"
 NB_PER_TEMP=1000
+SEED=0
 
-mkdir $OUT_PATH
-if [ $? -ne 0 ];then
-	echo "Please make sure there's no Train* files in $OUT_PATH!"
-	sleep 5
-	echo "continue..."
-fi
+# Train* files are rebuilt from the per intent cache in $OUT_PATH/Train.cache,
+# only intents whose template or the catalog changed are generated again.
+mkdir -p $OUT_PATH
 
 echo "make dataset ..."
-for i in ${TEMPLATES[@]}
-do
-	python2 sentence_generate.py ${TEMPLATE_DIR}$i ${DATA_DIR}/chinese_artist.json ${DATA_DIR}/english_artist.json\
-		${DATA_DIR}/genre_map.json ${DATA_DIR}/playlistNames.csv --nb_per_template $NB_PER_TEMP\
-		-o $OUT_PATH/Train
-done
+python2 sentence_generate.py ${TEMPLATES[@]/#/${TEMPLATE_DIR}} ${DATA_DIR}/chinese_artist.json ${DATA_DIR}/english_artist.json\
+	${DATA_DIR}/genre_map.json ${DATA_DIR}/playlistNames.csv --nb_per_template $NB_PER_TEMP\
+	--seed $SEED --mode w -o $OUT_PATH/Train
 
 echo "make train, valid, test sets..."
 python2 split_data.py $OUT_PATH -o $OUT_PATH
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 import pandas as pd
 import sys
+import io
 import json
+import zlib
+import random
+import shutil
+import hashlib
 import argparse
 import numpy as np
-from os.path import splitext, basename
-from random import randrange, shuffle
+from itertools import izip
+from multiprocessing import Pool, cpu_count
+from os import makedirs
+from os.path import splitext, basename, exists, join
 
 import io_utils
 
@@ -13,16 +20,32 @@ import io_utils
 '''
 Sentence generation based on sentence template from google form
 and the artists, tracks, albums, genres data crawled from Spotify
+
+Templates of every given intent are cut into shards which are filled by a
+process pool. Each shard owns a random.Random seeded from (--seed, intent,
+shard index), so the output is identical for the same seed whatever the
+number of workers. Shards are streamed back in order and appended through
+buffered writers.
+
+The sentences of every intent are cached under --cache_dir, next to a
+manifest holding the content hash of the intent's template, of the catalog
+files and the generation options. Only intents whose hash changed are
+generated again; the output files are then assembled from the cache.
 '''
 
 
 INTENTS = ['search', 'recommend','info','neutral', 'playlistCreate', 'playlistAdd', 'playlistPlay',
            'playlistShow', 'playlistTrack','playlistSpotify']
+WRITE_BUFFER_SIZE = 1 << 20
+SUFFIXES = ['.seq.in', '.seq.out', '.label']
+
+# slot data shared by the pool workers, set by _init_worker
+_slot_data = {}
 
 def opt_parse():
     parser = argparse.ArgumentParser(description=\
             'Slot & intent data generate')
-    parser.add_argument('template',help='sentence template')
+    parser.add_argument('template',nargs='+',help='sentence template(s), one csv per intent')
     parser.add_argument('data',help='artist-album-track json data')
     parser.add_argument('data_english', help='english artist-album-track json data')
     parser.add_argument('genre',help='genres')
@@ -30,6 +53,13 @@ def opt_parse():
     parser.add_argument('-output',default='Train',help='output filename prefix')
     parser.add_argument('--nb_per_template',default=100,type=int,\
             help='use 1 template sentences generate n times')
+    parser.add_argument('--seed',default=0,type=int,help='random seed')
+    parser.add_argument('--workers',default=cpu_count(),type=int,help='number of processes')
+    parser.add_argument('--templates_per_shard',default=8,type=int,\
+            help='number of templates filled by one task')
+    parser.add_argument('--mode',default='w',help='output file mode, w|a (a appends to an existing corpus)')
+    parser.add_argument('--cache_dir',default=None,\
+            help='per intent sentence cache, default <output>.cache')
     args = parser.parse_args()
     return args
 
@@ -39,9 +69,12 @@ def slot_sample(s=None,a=None,t=None,g=None,p=None):
     return slot
 
 
-def fill_slot(X,POS,Intent,intent,template,s=None,a=None,t=None,g=None,p=None):
+def fill_slot(template,s=None,a=None,t=None,g=None,p=None):
+    ''' Fill the [..] slots of a segmented template
+        Return (tokens, pos)
+    '''
     slot_map = slot_sample(s,a,t,g,p)
-    new_temp = io_utils.naive_seg(template)
+    new_temp = list(template)
     pos = [0 for i in range(len(new_temp))]
 
     for key in slot_map:
@@ -52,54 +85,152 @@ def fill_slot(X,POS,Intent,intent,template,s=None,a=None,t=None,g=None,p=None):
             pos = pos[:offset] + [key[1]]*len(slot_content) + pos[offset+1:]
             new_temp = new_temp[:offset] + slot_content + new_temp[offset+1:]
 
+    return new_temp, pos
+
 
-    X.append(new_temp)
-    POS.append(pos)
-    Intent.append(intent)
-    return
+def _init_worker(slot_data):
+    _slot_data.update(slot_data)
 
 
-def fill_template(data_artist,data_sent,genres, playlist_names, args_output, intent,nb_per_template=100):
+def _shard_seed(seed, intent, shard_id):
+    return (seed * 1000003 + zlib.crc32(intent.encode('utf-8')) * 8191 + shard_id) & 0xffffffff
+
+
+def fill_shard(job):
+    ''' Fill one shard of templates of an intent
+        job: (intent, shard_id, templates, nb_per_template, seed)
+        Return (seq_in, seq_out, label) encoded utf-8 chunks
+    '''
+    intent, shard_id, templates, nb_per_template, seed = job
+    rng = random.Random(_shard_seed(seed, intent, shard_id))
+    tracks = _slot_data['tracks']
+    artists = _slot_data['artists']
+    genres = _slot_data['genres']
+    playlist_names = _slot_data['playlist_names']
+
+    X, POS = [], []
+    for template in templates:
+        template_seg = io_utils.naive_seg(template)
+        for _ in range(nb_per_template):
+            t = tracks[rng.randrange(0,len(tracks))] if '[t]' in template else None
+            s = artists[rng.randrange(0,len(artists))] if '[s]' in template else None
+            g = genres[rng.randrange(0,len(genres))] if '[g]' in template else None
+            p = playlist_names[rng.randrange(0,len(playlist_names))] if '[p]' in template else None
+            x, pos = fill_slot(template_seg,t=t,s=s,g=g,p=p)
+            X.append(u''.join(u'{} '.format(i) for i in x) + u'\n')
+            POS.append(u''.join(u'{} '.format(i) for i in pos) + u'\n')
+    label = (u'{}\n'.format(intent)) * len(X)
+    return (u''.join(X).encode('utf-8'), u''.join(POS).encode('utf-8'), label.encode('utf-8'))
+
+
+def make_jobs(intent_templates, nb_per_template, seed, templates_per_shard):
+    ''' Cut the templates of each intent into shards, in a stable order '''
+    jobs = []
+    for intent, templates in intent_templates:
+        if intent not in INTENTS:
+            continue
+        for shard_id, start in enumerate(range(0, len(templates), templates_per_shard)):
+            jobs.append((intent, shard_id, templates[start:start+templates_per_shard],
+                         nb_per_template, seed))
+    return jobs
+
+
+def fill_template(slot_data, intent_templates, args_output, nb_per_template=100,
+                  seed=0, workers=1, templates_per_shard=8, mode='w', split_intents=False):
     '''
         fill the given [...] slot of template sentences
-        then store to file with prefix of args_output
+        then stream to file with prefix of args_output
+        intent_templates: [(intent, [template, ...]), ...]
+        split_intents: args_output is a directory, each intent is written
+                       to its own <args_output>/<intent> files
     '''
-    ### init
-    data_sent = data_sent[data_sent.columns[0]].unique()
-    playlist_names = playlist_names[playlist_names.columns[0]].unique()
-    X = [] # [[],[],...]
-    POS = [] # [[],[],...]
-    Intent = [] # []
-    
-    artists = [s for s in data_artist]
-    tracks = []
-    for s in data_artist:
-        for a in data_artist[s]:
-            for t in data_artist[s][a]:
-                tracks.append(t)
+    jobs = make_jobs(intent_templates, nb_per_template, seed, templates_per_shard)
+    if workers > 1:
+        pool = Pool(workers, initializer=_init_worker, initargs=(slot_data,))
+        results = pool.imap(fill_shard, jobs)
+    else:
+        pool = None
+        _init_worker(slot_data)
+        results = (fill_shard(job) for job in jobs)
+    writers, prefix = [], None
+    try:
+        for job, chunks in izip(jobs, results):
+            job_prefix = join(args_output, job[0]) if split_intents else args_output
+            if job_prefix != prefix:
+                for f in writers:
+                    f.close()
+                prefix = job_prefix
+                writers = [io.open(prefix+suffix, mode+'b', buffering=WRITE_BUFFER_SIZE)
+                           for suffix in SUFFIXES]
+            for f, chunk in zip(writers, chunks):
+                f.write(chunk)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for f in writers:
+            f.close()
 
-    genres = [key for key in genres]
 
-    for n,sent in enumerate(data_sent):
-        #intent = sent[0].decode('utf-8')
-        template = sent.decode('utf-8')
-        #print n,intent,template
-        if intent in INTENTS:
-            for _ in range(nb_per_template):
-                t = tracks[randrange(0,len(tracks))] if '[t]' in template else None
-                s = artists[randrange(0,len(artists))] if '[s]' in template else None
-                g = genres[randrange(0,len(genres))] if '[g]' in template else None
-                p = playlist_names[randrange(0,len(playlist_names))] if '[p]' in template else None
-                fill_slot(X,POS,Intent,intent, template,t=t,s=s,g=g, p=p)
+def generation_key(template_path, catalog_hash, args):
+    ''' Hash of everything the sentences of one intent depend on '''
+    key = json.dumps([io_utils.file_hash(template_path), catalog_hash, args.nb_per_template,
+                      args.seed, args.templates_per_shard])
+    return hashlib.md5(key).hexdigest()
 
 
+def cached_generate(args):
+    ''' Generate the stale intents into the cache, then assemble the output
+        from the cached intents in template order
+    '''
+    cache_dir = args.cache_dir or args.output+'.cache'
+    if not exists(cache_dir):
+        makedirs(cache_dir)
+    manifest_path = join(cache_dir, 'manifest.json')
+    manifest = {}
+    if exists(manifest_path):
+        with open(manifest_path,'r') as f:
+            manifest = json.load(f)
 
-        #elif 'List' not in intent and 'list' not in intent:
-        #    fill_slot(X,POS,Intent,intent,template)
-    io_utils.dump_to_file(X,POS,Intent,args_output, mode='a')
+    catalog_hash = hashlib.md5(' '.join(io_utils.file_hash(path) for path in
+        [args.data, args.data_english, args.genre, args.playlist_names])).hexdigest()
+    intents, stale, keys = [], [], {}
+    for path in args.template:
+        intent = splitext(basename(path))[0]
+        if intent not in INTENTS:
+            continue
+        intents.append(intent)
+        keys[intent] = generation_key(path, catalog_hash, args)
+        cached = all(exists(join(cache_dir, intent+suffix)) for suffix in SUFFIXES)
+        if manifest.get(intent) != keys[intent] or not cached:
+            stale.append(path)
+        else:
+            print 'cached', intent
 
+    if stale:
+        for path in stale:
+            intent = splitext(basename(path))[0]
+            manifest.pop(intent, None)
+            for suffix in SUFFIXES:
+                io.open(join(cache_dir, intent+suffix), 'wb').close()
+        slot_data = load_slot_data(args)
+        intent_templates = load_templates(stale)
+        fill_template(slot_data, intent_templates, cache_dir, nb_per_template=args.nb_per_template,
+                      seed=args.seed, workers=args.workers, templates_per_shard=args.templates_per_shard,
+                      mode='w', split_intents=True)
+        for intent, _ in intent_templates:
+            manifest[intent] = keys[intent]
+        with open(manifest_path,'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
 
-def sent_gen(args):
+    for suffix in SUFFIXES:
+        with io.open(args.output+suffix, args.mode+'b', buffering=WRITE_BUFFER_SIZE) as f_out:
+            for intent in intents:
+                with io.open(join(cache_dir, intent+suffix), 'rb') as f_in:
+                    shutil.copyfileobj(f_in, f_out, WRITE_BUFFER_SIZE)
+
+
+def load_slot_data(args):
     with open(args.data,'r') as f:
         data_artist = json.load(f)
     with open(args.data_english,'r') as f:
@@ -110,18 +241,35 @@ def sent_gen(args):
 
     with open(args.genre,'r') as f:
         genre_list=json.load(f)
-    data_sent = pd.read_csv(args.template)
-    intent = splitext(basename(args.template))[0]
-
     playlist_names = pd.read_csv(args.playlist_names)
-    print intent
-    
-    #data_sent = data_sent[data_sent.columns[0]] # remove timestamp column
-    #print data_sent
+    playlist_names = playlist_names[playlist_names.columns[0]].unique()
 
+    artists = [s for s in data_artist]
+    tracks = []
+    for s in data_artist:
+        for a in data_artist[s]:
+            for t in data_artist[s][a]:
+                tracks.append(t)
+
+    return {'artists':artists, 'tracks':tracks, 'genres':[key for key in genre_list],
+            'playlist_names':list(playlist_names)}
+
+
+def load_templates(template_paths):
+    intent_templates = []
+    for path in template_paths:
+        intent = splitext(basename(path))[0]
+        data_sent = pd.read_csv(path)
+        data_sent = data_sent[data_sent.columns[0]].unique()
+        intent_templates.append((intent, [sent.decode('utf-8') for sent in data_sent]))
+        print intent
+    return intent_templates
+
+
+def sent_gen(args):
     ### select Intent: Given [singer | album | date | track | genre ] find songs
     ### given_row =  data_sent[data_sent.columns[0]] == 'Given'
-    fill_template(data_artist,data_sent,genre_list, playlist_names, args.output, intent,nb_per_template=args.nb_per_template)
+    cached_generate(args)
 
 if __name__ == '__main__':
     args = opt_parse()
@@ -2,11 +2,30 @@
 import sys
 import json
 import argparse
-import random
+import hashlib
+import struct
 import os
-import pandas as pd
-import numpy as np
-import io_utils
+from collections import OrderedDict
+from itertools import izip
+
+'''
+Split Train.seq.in/.seq.out/.label into train, valid and test sets.
+
+The three aligned files are streamed in one pass. Each example is assigned
+to a split by a stable hash of its (tokens, tags, label) content, so an
+example always lands in the same split across regenerations of the corpus,
+and identical examples can never leak between splits.
+
+Identical (tokens, tags, label) triples are collapsed into one weighted
+example: each split gets a <split>.weight file holding, line by line, how
+many times the example occurred. The NLU batch sampler draws examples in
+proportion to these weights, so the effective distribution is unchanged.
+Only the last --dedup_window unique examples are remembered, so memory
+stays bounded: a duplicate further apart is written again as its own
+weighted line, in the same split, and the weights still sum to its count.
+'''
+
+SPLITS = ['train', 'valid', 'test']
 
 def opt_parse():
     parser = argparse.ArgumentParser(description=\
@@ -16,46 +35,76 @@ def opt_parse():
     parser.add_argument('-v',default=0.05,type=float,help='valid proportion')
     parser.add_argument('-t',default=0.05,type=float,help='test proportion')
     parser.add_argument('-o','--output',default='./',help='output dir')
+    parser.add_argument('--salt',default='',help='salt of the split hash, change it to draw other splits')
+    parser.add_argument('--dedup_window',default=1000000,type=int,\
+            help='number of recent unique examples duplicates are collapsed into')
+    parser.add_argument('--keep_duplicates',default=False,action='store_true',\
+            help='write every example instead of weighted unique examples')
     args = parser.parse_args()
     return args
 
-def split_data(args):
-    X = io_utils.load_X(args.data_dir+'Train.seq.in')
-    POS = io_utils.load_POS(args.data_dir+'Train.seq.out')
-    Intent = io_utils.load_Intent(args.data_dir+'Train.label')
-    data_len = len(X)
-
-    ### shuffle data
-    index_shuff = range(data_len)
-    random.shuffle(index_shuff)
-
-    X_shuff = [ X[index_shuff[i]] for i in index_shuff]
-    POS_shuff = [ POS[index_shuff[i]] for i in index_shuff]
-    Intent_shuff = [ Intent[index_shuff[i]] for i in index_shuff]
+def example_hash(x, pos, intent, salt=''):
+    ''' Stable 64-bit hash of one example, whitespace insensitive '''
+    key = '\t'.join([salt, ' '.join(x.split()), ' '.join(pos.split()), intent.strip()])
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
 
+def assign_split(h, valid_ratio, test_ratio):
+    ''' Map the hash to [0,1) and pick a split '''
+    r = h / float(1 << 64)
+    if r < test_ratio:
+        return 'test'
+    if r < test_ratio + valid_ratio:
+        return 'valid'
+    return 'train'
 
-    ### dump train
-    directory = os.path.join(args.output,'train')
-    if not os.path.exists(directory):
+def split_data(args):
+    outputs = {}
+    for name in SPLITS:
+        directory = os.path.join(args.output,name)
+        if not os.path.exists(directory):
             os.makedirs(directory)
-    amount = int(data_len*(1. - args.v - args.t))
-    io_utils.dump_to_file(X_shuff[:amount],POS_shuff[:amount],Intent_shuff[:amount],\
-            directory+'/train' )
+        prefix = os.path.join(directory, name)
+        outputs[name] = [open(prefix+'.seq.in','w'), open(prefix+'.seq.out','w'),
+                         open(prefix+'.label','w')]
+        weight_path = prefix+'.weight'
+        if args.keep_duplicates:
+            if os.path.exists(weight_path):
+                os.remove(weight_path)
+        else:
+            outputs[name].append(open(weight_path,'w'))
 
-    ### dump valid
-    directory = os.path.join(args.output,'valid')
-    if not os.path.exists(directory):
-            os.makedirs(directory)
-    amount_v = int(data_len*(1. - args.t))
-    io_utils.dump_to_file(X_shuff[amount:amount_v],POS_shuff[amount:amount_v],\
-            Intent_shuff[amount:amount_v],directory+'/valid' )
+    # hash -> [split, weight] of the recent unique examples, in line order;
+    # the weight of an example is final and written once it leaves the window
+    seen = OrderedDict()
+    def write_weight(name, weight):
+        outputs[name][3].write('%d\n' % weight)
+    counts = dict((name, 0) for name in SPLITS)
+    nb_duplicates = 0
+    with open(args.data_dir+'Train.seq.in','r') as f_X, \
+            open(args.data_dir+'Train.seq.out','r') as f_POS, \
+            open(args.data_dir+'Train.label','r') as f_Intent:
+        for x, pos, intent in izip(f_X, f_POS, f_Intent):
+            h = example_hash(x, pos, intent, args.salt)
+            if not args.keep_duplicates:
+                if h in seen:
+                    seen[h][1] += 1
+                    nb_duplicates += 1
+                    continue
+            name = assign_split(h, args.v, args.t)
+            for f, line in zip(outputs[name], (x, pos, intent)):
+                f.write(line)
+            if not args.keep_duplicates:
+                seen[h] = [name, 1]
+                if len(seen) > args.dedup_window:
+                    write_weight(*seen.popitem(last=False)[1])
+            counts[name] += 1
 
-    ### dump test
-    directory = os.path.join(args.output,'test')
-    if not os.path.exists(directory):
-            os.makedirs(directory)
-    io_utils.dump_to_file(X_shuff[amount_v:],POS_shuff[amount_v:],Intent_shuff[amount_v:]\
-            ,directory+'/test' )
+    while seen:
+        write_weight(*seen.popitem(last=False)[1])
+    for name in SPLITS:
+        for f in outputs[name]:
+            f.close()
+    print json.dumps({'split':counts, 'duplicates':nb_duplicates})
 
 if __name__ == '__main__':
     args = opt_parse()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+'''
+Replay logged conversations through the dialogue manager.
+
+The user turns of every session of the transcript logs (see transcript.py)
+are fed to Manager.get_input with the given model and thresholds, the DB
+checks answered from the log. Sessions are replayed in parallel worker
+processes, each loading the models once. Reports the turns whose action
+diverges from the logged one and the turn latency percentiles.
+
+e.g.
+    python replay_transcripts.py chat.log --model ./model_new/ \\
+        --set intent_upper_threshold=0.9 --output divergence.jsonl
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+
+from Dialogue_Manager import Manager, DialogueServices, DialogueState
+from transcript import ReplayDatabase, read_sessions
+
+
+def optParser():
+    parser = argparse.ArgumentParser(description='Replay transcript logs through the dialogue manager')
+    parser.add_argument('transcripts',nargs='+',help='transcript log files')
+    parser.add_argument('--nlu_data', default='./data/nlu_data/',type=str, help='data dir')
+    parser.add_argument('--model',default='./model_tmp/',type=str,help='model dir')
+    parser.add_argument('--set',dest='overrides',default=[],action='append',\
+            help='override a Manager threshold, e.g. intent_upper_threshold=0.9, repeatable')
+    parser.add_argument('--workers',default=4,type=int,help='replay processes, 1 replays in this process')
+    parser.add_argument('--output',default='',type=str,help='write the diverging turns to this json lines file')
+    args = parser.parse_args()
+    return args
+
+
+def parse_overrides(overrides):
+    values = {}
+    for override in overrides:
+        name, _, value = override.partition('=')
+        if not hasattr(Manager,name):
+            raise ValueError('Manager has no attribute %s' % name)
+        values[name] = type(getattr(Manager,name))(value)
+    return values
+
+
+# per process DialogueServices, set by init_worker
+_services = None
+
+def init_worker(nlu_data,model,overrides):
+    global _services
+    for name, value in overrides.items():
+        setattr(Manager,name,value)
+    _services = DialogueServices(nlu_data,model,None,None,None,DB=ReplayDatabase())
+
+
+def replay_session(events):
+    ''' Replay the turns of one session, return one result per turn '''
+    db = _services.DB
+    state = DialogueState(events[0].get('user') or 'default_user')
+    results = []
+    for event in events:
+        if event['event'] == 'reset':
+            state = DialogueState(event.get('user') or state.user_name)
+            continue
+        db.load(event['db'])
+        misses = db.misses
+        DM = Manager(services=_services,session=state)
+        start_time = time.time()
+        action = DM.get_input(event['sent'])
+        seconds = time.time()-start_time
+        action = json.loads(json.dumps(action))
+        results.append({'session':event['session'],'sent':event['sent'],
+                        'logged':event['action'],'replayed':action,
+                        'match':action == event['action'],
+                        'seconds':seconds,'logged_seconds':event.get('seconds'),
+                        'db_misses':db.misses-misses})
+        if DM.dialogue_end:
+            DM.state_init(1)
+    return results
+
+
+def percentiles(seconds):
+    if not seconds:
+        return 'n/a'
+    p50, p90, p99 = np.percentile(seconds,[50,90,99])
+    return 'p50 %.1fms p90 %.1fms p99 %.1fms max %.1fms' % (p50*1000,p90*1000,p99*1000,max(seconds)*1000)
+
+
+def replay(args):
+    sessions = read_sessions(args.transcripts)
+    overrides = parse_overrides(args.overrides)
+    print('Replaying %d sessions on %d workers' % (len(sessions),args.workers))
+    sys.stdout.flush()
+    start_time = time.time()
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers,init_worker,(args.nlu_data,args.model,overrides))
+        session_results = pool.imap_unordered(replay_session,sessions)
+    else:
+        pool = None
+        init_worker(args.nlu_data,args.model,overrides)
+        session_results = (replay_session(events) for events in sessions)
+
+    turns = []
+    diverged_sessions = 0
+    output = open(args.output,'w') if args.output else None
+    for results in session_results:
+        turns.extend(results)
+        if not all(r['match'] for r in results):
+            diverged_sessions += 1
+        if output is not None:
+            for r in results:
+                if not r['match']:
+                    output.write(json.dumps(r,sort_keys=True) + '\n')
+    if output is not None:
+        output.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = time.time()-start_time
+
+    diverged = sum(1 for r in turns if not r['match'])
+    print('turns: %d in %.1fs (%.1f turns/s)' % (len(turns),elapsed,len(turns)/elapsed if elapsed > 0 else 0.0))
+    print('diverged turns: %d (%.2f%%), diverged sessions: %d/%d' %
+          (diverged,100.0*diverged/max(1,len(turns)),diverged_sessions,len(sessions)))
+    print('DB checks missing from the log: %d' % sum(r['db_misses'] for r in turns))
+    print('replay latency:',percentiles([r['seconds'] for r in turns]))
+    print('logged latency:',percentiles([r['logged_seconds'] for r in turns if r['logged_seconds'] is not None]))
+
+
+if __name__ == '__main__':
+    replay(optParser())
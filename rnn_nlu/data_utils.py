@@ -11,6 +11,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
+import json
 import os
 import re
 
@@ -228,52 +230,145 @@ def create_label_vocab(vocabulary_path, data_path):
         for k in label_list:
           vocab_file.write(k + "\n")
 
+def file_hash(path):
+  """md5 hex digest of the content of a file."""
+  md5 = hashlib.md5()
+  with gfile.GFile(path, mode="rb") as f:
+    while True:
+      chunk = f.read(1 << 20)
+      if not chunk:
+        break
+      md5.update(chunk)
+  return md5.hexdigest()
+
+
+class BuildManifest(object):
+  """Records, for every generated file, the content hashes of its inputs.
+
+  build() only reruns the builder of a target when one of its inputs or
+  parameters changed, or when the target itself is missing or was modified,
+  so a changed template or catalog rebuilds exactly the files depending on
+  it. The manifest is a json file kept next to the data.
+  """
+  def __init__(self, path):
+    self.path = path
+    self.root = os.path.dirname(path)
+    self.entries = {}
+    self._hashes = {}
+    if gfile.Exists(path):
+      with gfile.GFile(path, mode="r") as f:
+        self.entries = json.load(f)
+
+  def _name(self, path):
+    return os.path.relpath(path, self.root)
+
+  def _hash(self, path):
+    if path not in self._hashes:
+      self._hashes[path] = file_hash(path)
+    return self._hashes[path]
+
+  def build(self, target, inputs, params, builder):
+    """Run builder() unless target is up to date. Return True if it was rebuilt."""
+    key = {'inputs': dict((self._name(p), self._hash(p)) for p in inputs),
+           'params': params}
+    name = self._name(target)
+    entry = self.entries.get(name)
+    if (entry is not None and entry['key'] == key and gfile.Exists(target)
+        and self._hash(target) == entry['output']):
+      return False
+    if gfile.Exists(target):
+      gfile.Remove(target)
+    builder()
+    self._hashes.pop(target, None)
+    self.entries[name] = {'key': key, 'output': self._hash(target)}
+    self.save()
+    return True
+
+  def save(self):
+    tmp_path = self.path + '.tmp'
+    with gfile.GFile(tmp_path, mode="w") as f:
+      json.dump(self.entries, f, indent=1, sort_keys=True)
+    gfile.Rename(tmp_path, self.path, overwrite=True)
+
+
 def prepare_multi_task_data(data_dir, in_vocab_size, out_vocab_size):
     train_path = data_dir + 'train/train'
     dev_path = data_dir + 'valid/valid'
     test_path = data_dir + 'test/test'
+    # Vocabularies and id files are rebuilt when the text they come from
+    # changed, see BuildManifest.
+    manifest = BuildManifest(os.path.join(data_dir, "manifest.json"))
 
     # Create vocabularies of the appropriate sizes.
     in_vocab_path = os.path.join(data_dir, "in_vocab_%d.txt" % in_vocab_size)
     out_vocab_path = os.path.join(data_dir, "out_vocab_%d.txt" % out_vocab_size)
     label_path = os.path.join(data_dir, "label.txt")
 
-    create_vocabulary(in_vocab_path, train_path + ".seq.in", in_vocab_size, tokenizer=naive_tokenizer)
-    create_vocabulary(out_vocab_path, train_path + ".seq.out", out_vocab_size, tokenizer=naive_tokenizer)
-    create_label_vocab(label_path, train_path + ".label")
+    manifest.build(in_vocab_path, [train_path + ".seq.in"], {'size': in_vocab_size},
+        lambda: create_vocabulary(in_vocab_path, train_path + ".seq.in", in_vocab_size, tokenizer=naive_tokenizer))
+    manifest.build(out_vocab_path, [train_path + ".seq.out"], {'size': out_vocab_size},
+        lambda: create_vocabulary(out_vocab_path, train_path + ".seq.out", out_vocab_size, tokenizer=naive_tokenizer))
+    manifest.build(label_path, [train_path + ".label"], {},
+        lambda: create_label_vocab(label_path, train_path + ".label"))
+
+    def token_ids(data_path, ids_path, vocab_path, tokenizer=naive_tokenizer, **kwargs):
+      manifest.build(ids_path, [data_path, vocab_path], kwargs,
+          lambda: data_to_token_ids(data_path, ids_path, vocab_path, tokenizer=tokenizer, **kwargs))
 
     # Create token ids for the training data.
     in_seq_train_ids_path = train_path + (".ids%d.seq.in" % in_vocab_size)
     out_seq_train_ids_path = train_path + (".ids%d.seq.out" % out_vocab_size)
     label_train_ids_path = train_path + (".ids.label")
 
-    data_to_token_ids(train_path + ".seq.in", in_seq_train_ids_path, in_vocab_path, tokenizer=naive_tokenizer)
-    data_to_token_ids(train_path + ".seq.out", out_seq_train_ids_path, out_vocab_path, tokenizer=naive_tokenizer)
-    data_to_token_ids(train_path + ".label", label_train_ids_path, label_path, normalize_digits=False, use_padding=False)
+    token_ids(train_path + ".seq.in", in_seq_train_ids_path, in_vocab_path)
+    token_ids(train_path + ".seq.out", out_seq_train_ids_path, out_vocab_path)
+    token_ids(train_path + ".label", label_train_ids_path, label_path, tokenizer=None, normalize_digits=False, use_padding=False)
 
     # Create token ids for the development data.
     in_seq_dev_ids_path = dev_path + (".ids%d.seq.in" % in_vocab_size)
     out_seq_dev_ids_path = dev_path + (".ids%d.seq.out" % out_vocab_size)
     label_dev_ids_path = dev_path + (".ids.label")
 
-    data_to_token_ids(dev_path + ".seq.in", in_seq_dev_ids_path, in_vocab_path, tokenizer=naive_tokenizer)
-    data_to_token_ids(dev_path + ".seq.out", out_seq_dev_ids_path, out_vocab_path, tokenizer=naive_tokenizer)
-    data_to_token_ids(dev_path + ".label", label_dev_ids_path, label_path, normalize_digits=False, use_padding=False)
+    token_ids(dev_path + ".seq.in", in_seq_dev_ids_path, in_vocab_path)
+    token_ids(dev_path + ".seq.out", out_seq_dev_ids_path, out_vocab_path)
+    token_ids(dev_path + ".label", label_dev_ids_path, label_path, tokenizer=None, normalize_digits=False, use_padding=False)
 
     # Create token ids for the test data.
     in_seq_test_ids_path = test_path + (".ids%d.seq.in" % in_vocab_size)
     out_seq_test_ids_path = test_path + (".ids%d.seq.out" % out_vocab_size)
     label_test_ids_path = test_path + (".ids.label")
 
-    data_to_token_ids(test_path + ".seq.in", in_seq_test_ids_path, in_vocab_path, tokenizer=naive_tokenizer)
-    data_to_token_ids(test_path + ".seq.out", out_seq_test_ids_path, out_vocab_path, tokenizer=naive_tokenizer)
-    data_to_token_ids(test_path + ".label", label_test_ids_path, label_path, normalize_digits=False, use_padding=False)
+    token_ids(test_path + ".seq.in", in_seq_test_ids_path, in_vocab_path)
+    token_ids(test_path + ".seq.out", out_seq_test_ids_path, out_vocab_path)
+    token_ids(test_path + ".label", label_test_ids_path, label_path, tokenizer=None, normalize_digits=False, use_padding=False)
 
     return (in_seq_train_ids_path, out_seq_train_ids_path, label_train_ids_path,
           in_seq_dev_ids_path, out_seq_dev_ids_path, label_dev_ids_path,
           in_seq_test_ids_path, out_seq_test_ids_path, label_test_ids_path,
           in_vocab_path, out_vocab_path, label_path)
 
+def load_multi_task_vocabularies(data_dir, in_vocab_size, out_vocab_size):
+  """Return (in_vocab_path, out_vocab_path, label_path) written by
+  prepare_multi_task_data, for inference. Nothing is hashed or rebuilt: the
+  vocabularies belong to the trained checkpoint, so a missing one is an
+  error rather than something to regenerate from the current corpus."""
+  paths = (os.path.join(data_dir, "in_vocab_%d.txt" % in_vocab_size),
+           os.path.join(data_dir, "out_vocab_%d.txt" % out_vocab_size),
+           os.path.join(data_dir, "label.txt"))
+  for path in paths:
+    if not gfile.Exists(path):
+      raise ValueError("Vocabulary file %s not found, run the training or "
+                       "preprocessing to build it." % path)
+  return paths
+
+def get_weight_path(data_dir, split='train'):
+  """Return the example weight file of a split written by split_data.py,
+  or None if the split was written without weights."""
+  weight_path = data_dir + '%s/%s.weight' % (split, split)
+  if gfile.Exists(weight_path):
+    return weight_path
+  return None
+
 def prepare_one_data(sentence, vocab):
     UNK_ID = UNK_ID_dict['with_padding']
     token_ids = sentence_to_token_ids(sentence, vocab, UNK_ID, naive_seg, False)
@@ -13,6 +13,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
 import random
 
 import numpy as np
@@ -26,12 +27,57 @@ from . import seq_labeling
 from . import seq_classification
 from . import generate_encoder_output
 
+@contextlib.contextmanager
+def _optional_device(device):
+  """tf.device(device), or no device scope at all if device is None."""
+  if device is None:
+    yield
+  else:
+    with tf.device(device):
+      yield
+
+def _average_gradients(tower_gradients):
+  """Average the per-tower gradients of each parameter.
+
+  Args:
+    tower_gradients: list (one per tower) of lists of gradients, aligned
+      with the parameter list; entries may be None or IndexedSlices.
+
+  Returns:
+    list of averaged gradients, aligned with the parameter list.
+  """
+  num_towers = len(tower_gradients)
+  if num_towers == 1:
+    return tower_gradients[0]
+  average = []
+  for grads in zip(*tower_gradients):
+    grads = [g for g in grads if g is not None]
+    if not grads:
+      average.append(None)
+    elif isinstance(grads[0], tf.IndexedSlices):
+      # Sparse embedding gradients: concatenate the slices instead of densifying.
+      average.append(tf.IndexedSlices(
+          tf.concat([g.values for g in grads], 0) / num_towers,
+          tf.concat([g.indices for g in grads], 0),
+          grads[0].dense_shape))
+    else:
+      average.append(tf.add_n(grads) / num_towers)
+  return average
+
 class MultiTaskModel(object):
   def __init__(self, source_vocab_size, tag_vocab_size, label_vocab_size, buckets,
                word_embedding_size, size, num_layers, max_gradient_norm, batch_size,
                dropout_keep_prob=1.0, use_lstm=False, bidirectional_rnn=True,
                num_samples=1024, use_attention=False,
-               task=None, forward_only=False):
+               task=None, forward_only=False, tower_devices=None):
+    """Create the model.
+
+    tower_devices: optional list of devices (or device functions). The batch
+      is split evenly across them, each tower computes the loss and the
+      gradients of its shard, and the averaged gradients are applied once to
+      the shared parameters. Variable names do not depend on the number of
+      towers, so checkpoints are interchangeable with the single-tower model.
+    """
     self.source_vocab_size = source_vocab_size
     self.tag_vocab_size = tag_vocab_size
     self.label_vocab_size = label_vocab_size
@@ -72,51 +118,101 @@ class MultiTaskModel(object):
                                                 name="weight{0}".format(i)))
     self.labels.append(tf.placeholder(tf.float32, shape=[None], name="label"))
 
-    base_rnn_output = generate_encoder_output.generate_embedding_RNN_output(self.encoder_inputs,
-                                                                            cell,
-                                                                            self.source_vocab_size,
-                                                                            word_embedding_size,
-                                                                            dtype=dtypes.float32,
-                                                                            scope=None,
-                                                                            sequence_length=self.sequence_length,
-                                                                            bidirectional_rnn=bidirectional_rnn)
-    encoder_outputs, encoder_state, attention_states = base_rnn_output
+    tower_devices = tower_devices or [None]
+    num_towers = len(tower_devices)
+    if batch_size % num_towers != 0:
+      raise ValueError("Batch size %d must be divisible by the number of towers %d."
+                       % (batch_size, num_towers))
+
+    def split(t):
+      return tf.split(t, num_towers, 0) if num_towers > 1 else [t]
+    encoder_inputs = zip(*[split(x) for x in self.encoder_inputs])
+    tags = zip(*[split(x) for x in self.tags])
+    tag_weights = zip(*[split(x) for x in self.tag_weights])
+    labels = zip(*[split(x) for x in self.labels])
+    sequence_length = split(self.sequence_length)
+
+    # Gradients and SGD update operation for training the model.
+    tower_outputs = []
+    tower_gradients = []
+    for i, device in enumerate(tower_devices):
+      with _optional_device(device), tf.variable_scope(tf.get_variable_scope(),
+                                                       reuse=True if i > 0 else None):
+        outputs = self._build_tower(list(encoder_inputs[i]), list(tags[i]), list(tag_weights[i]),
+                                    list(labels[i]), sequence_length[i], cell, word_embedding_size,
+                                    bidirectional_rnn, use_attention, softmax_loss_function, task)
+        tower_outputs.append(outputs)
+        params = tf.trainable_variables()
+        if not forward_only:
+          if task['joint'] == 1:
+            # backpropagate the intent and tagging loss, one may further adjust
+            # the weights for the two costs.
+            gradients = tf.gradients([outputs['tagging_loss'], outputs['classification_loss']], params)
+          elif task['tagging'] == 1:
+            gradients = tf.gradients(outputs['tagging_loss'], params)
+          elif task['intent'] == 1:
+            gradients = tf.gradients(outputs['classification_loss'], params)
+          tower_gradients.append(gradients)
+
+    def merge(key):
+      if num_towers == 1:
+        return tower_outputs[0][key]
+      return tf.add_n([o[key] for o in tower_outputs]) / num_towers
+    def concat(key):
+      if num_towers == 1:
+        return tower_outputs[0][key]
+      return [tf.concat(list(step_outputs), 0)
+              for step_outputs in zip(*[o[key] for o in tower_outputs])]
 
     if task['tagging'] == 1:
-      self.tagging_output, self.tagging_loss = seq_labeling.generate_sequence_output(
-          self.source_vocab_size,
-          encoder_outputs, encoder_state, self.tags, self.sequence_length, self.tag_vocab_size, self.tag_weights,
-          buckets, softmax_loss_function=softmax_loss_function, use_attention=use_attention)
+      self.tagging_output = concat('tagging_output')
+      self.tagging_loss = merge('tagging_loss')
     if task['intent'] == 1:
-      self.classification_output, self.classification_loss = seq_classification.generate_single_output(
-          encoder_state, attention_states, self.sequence_length, self.labels, self.label_vocab_size,
-          buckets, softmax_loss_function=softmax_loss_function, use_attention=use_attention)
+      self.classification_output = concat('classification_output')
+      self.classification_loss = merge('classification_loss')
 
     if task['tagging'] == 1:
       self.loss = self.tagging_loss
     elif task['intent'] == 1:
       self.loss = self.classification_loss
 
-    # Gradients and SGD update operation for training the model.
-    params = tf.trainable_variables()
     if not forward_only:
       opt = tf.train.AdamOptimizer()
-      if task['joint'] == 1:
-        # backpropagate the intent and tagging loss, one may further adjust
-        # the weights for the two costs.
-        gradients = tf.gradients([self.tagging_loss, self.classification_loss], params)
-      elif task['tagging'] == 1:
-        gradients = tf.gradients(self.tagging_loss, params)
-      elif task['intent'] == 1:
-        gradients = tf.gradients(self.classification_loss, params)
-
+      gradients = _average_gradients(tower_gradients)
       clipped_gradients, norm = tf.clip_by_global_norm(gradients,
                                                        max_gradient_norm)
       self.gradient_norm = norm
       self.update = opt.apply_gradients(
           zip(clipped_gradients, params), global_step=self.global_step)
 
-    self.saver = tf.train.Saver(tf.global_variables())
+    # Variables of this model only (the forward-only twin adds its own global_step).
+    self.checkpoint_variables = tf.global_variables()
+    self.saver = tf.train.Saver(self.checkpoint_variables)
+
+  def _build_tower(self, encoder_inputs, tags, tag_weights, labels, sequence_length, cell,
+                   word_embedding_size, bidirectional_rnn, use_attention, softmax_loss_function, task):
+    """Build the encoder and the task outputs for one shard of the batch."""
+    outputs = {}
+    base_rnn_output = generate_encoder_output.generate_embedding_RNN_output(encoder_inputs,
+                                                                            cell,
+                                                                            self.source_vocab_size,
+                                                                            word_embedding_size,
+                                                                            dtype=dtypes.float32,
+                                                                            scope=None,
+                                                                            sequence_length=sequence_length,
+                                                                            bidirectional_rnn=bidirectional_rnn)
+    encoder_outputs, encoder_state, attention_states = base_rnn_output
+
+    if task['tagging'] == 1:
+      outputs['tagging_output'], outputs['tagging_loss'] = seq_labeling.generate_sequence_output(
+          self.source_vocab_size,
+          encoder_outputs, encoder_state, tags, sequence_length, self.tag_vocab_size, tag_weights,
+          self.buckets, softmax_loss_function=softmax_loss_function, use_attention=use_attention)
+    if task['intent'] == 1:
+      outputs['classification_output'], outputs['classification_loss'] = seq_classification.generate_single_output(
+          encoder_state, attention_states, sequence_length, labels, self.label_vocab_size,
+          self.buckets, softmax_loss_function=softmax_loss_function, use_attention=use_attention)
+    return outputs
 
 
   def joint_step(self, session, encoder_inputs, tags, tag_weights, labels, batch_sequence_length,
@@ -289,7 +385,18 @@ class MultiTaskModel(object):
       return None, outputs[0], outputs[1] # No gradient norm, loss, outputs.
 
 
-  def get_batch(self, data, bucket_id):
+  def sampling_weights(self, bucket_data):
+    """Cumulative example weights of one bucket, to be passed to get_batch.
+
+    Args:
+      bucket_data: list of (source, target, label, weight) units.
+
+    Returns:
+      numpy int64 array of the running sum of the weights.
+    """
+    return np.cumsum([unit[3] for unit in bucket_data], dtype=np.int64)
+
+  def get_batch(self, data, bucket_id, cumulative_weights=None):
     """Get a random batch of data from the specified bucket, prepare for step.
 
     To feed data in step(..) it must be a list of batch-major vectors, while
@@ -300,6 +407,9 @@ class MultiTaskModel(object):
       data: a tuple of size len(self.buckets) in which each element contains
         lists of pairs of input and output data that we use to create a batch.
       bucket_id: integer, which bucket to get the batch for.
+      cumulative_weights: optional output of sampling_weights for this bucket;
+        if given, samples are drawn in proportion to their weights instead
+        of uniformly.
 
     Returns:
       The triple (encoder_inputs, decoder_inputs, target_weights) for
@@ -308,11 +418,17 @@ class MultiTaskModel(object):
     encoder_size, decoder_size = self.buckets[bucket_id]
     encoder_inputs, decoder_inputs, labels = [], [], []
 
+    if cumulative_weights is not None:
+      draws = np.random.randint(cumulative_weights[-1], size=self.batch_size)
+      samples = [data[bucket_id][i] for i in np.searchsorted(cumulative_weights, draws, side='right')]
+    else:
+      samples = [random.choice(data[bucket_id]) for _ in xrange(self.batch_size)]
+
     # Get a random batch of encoder and decoder inputs from data,
     # pad them if needed, reverse encoder inputs and add GO to decoder.
     batch_sequence_length_list= list()
-    for _ in xrange(self.batch_size):
-      encoder_input, decoder_input, label = random.choice(data[bucket_id])
+    for sample in samples:
+      encoder_input, decoder_input, label = sample[:3]
       batch_sequence_length_list.append(len(encoder_input))
 
       # Encoder inputs are padded and then reversed.
@@ -383,7 +499,7 @@ class MultiTaskModel(object):
     # pad them if needed, reverse encoder inputs and add GO to decoder.
     batch_sequence_length_list= list()
     #for _ in xrange(self.batch_size):
-    encoder_input, decoder_input, label = data[bucket_id][sample_id]
+    encoder_input, decoder_input, label = data[bucket_id][sample_id][:3]
     batch_sequence_length_list.append(len(encoder_input))
 
       # Encoder inputs are padded and then reversed.
@@ -430,3 +546,41 @@ class MultiTaskModel(object):
 
     batch_sequence_length = np.array(batch_sequence_length_list, dtype=np.int32)
     return batch_encoder_inputs, batch_decoder_inputs, batch_weights, batch_sequence_length, batch_labels
+
+
+  def get_batch_by_ids(self, data, bucket_id, sample_ids):
+    """Get the given samples from the specified bucket, prepare for step.
+
+    Unlike get_batch, the samples are picked deterministically and the batch
+    size is len(sample_ids), so a whole data set can be walked sequentially
+    at any inference batch size.
+
+    Args:
+      data: a tuple of size len(self.buckets) in which each element contains
+        lists of pairs of input and output data that we use to create a batch.
+      bucket_id: integer, which bucket to get the batch for.
+      sample_ids: list of sample indices within data[bucket_id].
+
+    Returns:
+      The same tuple as get_batch, with batch size len(sample_ids).
+    """
+    encoder_size, decoder_size = self.buckets[bucket_id]
+    batch_size = len(sample_ids)
+    encoder_inputs = np.full((batch_size, encoder_size), data_utils.PAD_ID, dtype=np.int32)
+    decoder_inputs = np.full((batch_size, decoder_size), data_utils.PAD_ID, dtype=np.int32)
+    labels = np.zeros(batch_size, dtype=np.int32)
+    batch_sequence_length = np.zeros(batch_size, dtype=np.int32)
+
+    for batch_idx, sample_id in enumerate(sample_ids):
+      encoder_input, decoder_input, label = data[bucket_id][sample_id][:3]
+      encoder_inputs[batch_idx, :len(encoder_input)] = encoder_input
+      decoder_inputs[batch_idx, :len(decoder_input)] = decoder_input
+      labels[batch_idx] = label[0]
+      batch_sequence_length[batch_idx] = len(encoder_input)
+
+    # Re-index to length-major vectors; padding targets get zero weight.
+    batch_weights = (decoder_inputs != data_utils.PAD_ID).astype(np.float32)
+    batch_encoder_inputs = list(encoder_inputs.T)
+    batch_decoder_inputs = list(decoder_inputs.T)
+    batch_weights = list(batch_weights.T)
+    return batch_encoder_inputs, batch_decoder_inputs, batch_weights, batch_sequence_length, [labels]
@@ -9,8 +9,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
 import math
+import multiprocessing
 import os
+import resource
+import shutil
+import socket
 import sys
 import time
 
@@ -20,6 +25,7 @@ import tensorflow as tf
 
 from . import data_utils
 from . import multi_task_model
+from utils.checkpoint import AsyncSaver
 
 import subprocess
 import stat
@@ -57,7 +63,21 @@ tf.app.flags.DEFINE_boolean("bidirectional_rnn", True,
                             "Use birectional RNN")
 tf.app.flags.DEFINE_string("task", "joint", "Options: joint; intent; tagging")
 tf.app.flags.DEFINE_string("mode", "train", "Options: train; test(default: train)")
-tf.app.flags.DEFINE_boolean("test_while_train", False,"Test while train(not recommended, fucking slow)")
+tf.app.flags.DEFINE_boolean("test_while_train", True,
+                            "Evaluate on the full valid/test sets at each checkpoint")
+tf.app.flags.DEFINE_integer("eval_batch_size", 512,
+                            "Batch size used for the full-set evaluation.")
+tf.app.flags.DEFINE_integer("num_workers", 0,
+                            "Local worker processes for synchronous data-parallel training; "
+                            "batch_size is split evenly across them (0: single process).")
+tf.app.flags.DEFINE_string("warm_start_dir", "",
+                           "Train dir of an old model to warm start from when train_dir has no checkpoint.")
+tf.app.flags.DEFINE_string("warm_start_vocab", "",
+                           "In vocab file the warm start model was trained with "
+                           "(default: the copy saved in warm_start_dir).")
+tf.app.flags.DEFINE_string("telemetry_file", "telemetry.jsonl",
+                           "JSONL file in train_dir receiving one record per checkpoint interval; "
+                           "a fresh run overwrites it, a resumed one appends to it.")
 FLAGS = tf.app.flags.FLAGS
 
 if FLAGS.max_sequence_length == 0:
@@ -133,7 +153,7 @@ def get_perf(filename):
     return {'p': precision, 'r': recall, 'f1': f1score}
 
 
-def read_data(source_path, target_path, label_path, max_size=None):
+def read_data(source_path, target_path, label_path, max_size=None, weight_path=None):
   """Read data from source and target files and put into buckets.
 
   Args:
@@ -144,14 +164,18 @@ def read_data(source_path, target_path, label_path, max_size=None):
     label_path: path to the file with token-ids for the sequence classification label
     max_size: maximum number of lines to read, all other will be ignored;
       if 0 or None, data files will be read completely (no limit).
+    weight_path: optional file with the number of occurrences of each
+      example, as written by preprocess/split_data.py.
 
   Returns:
     data_set: a list of length len(_buckets); data_set[n] contains a list of
       (source, target, label) tuple read from the provided data files that fit
       into the n-th bucket, i.e., such that len(source) < _buckets[n][0] and
       len(target) < _buckets[n][1]; source,  target, and label are lists of token-ids.
+      If weight_path is given, the weight is appended as a 4th element.
   """
   data_set = [[] for _ in _buckets]
+  weight_file = tf.gfile.GFile(weight_path, mode="r") if weight_path else None
   with tf.gfile.GFile(source_path, mode="r") as source_file:
     with tf.gfile.GFile(target_path, mode="r") as target_file:
       with tf.gfile.GFile(label_path, mode="r") as label_file:
@@ -165,15 +189,164 @@ def read_data(source_path, target_path, label_path, max_size=None):
           source_ids = [int(x) for x in source.split()]
           target_ids = [int(x) for x in target.split()]
           label_ids = [int(x) for x in label.split()]
+          unit = [source_ids, target_ids, label_ids]
+          if weight_file:
+            unit.append(int(weight_file.readline()))
 #          target_ids.append(data_utils.EOS_ID)
           for bucket_id, (source_size, target_size) in enumerate(_buckets):
             if len(source_ids) < source_size and len(target_ids) < target_size:
-              data_set[bucket_id].append([source_ids, target_ids, label_ids])
+              data_set[bucket_id].append(unit)
               break
           source, target, label = source_file.readline(), target_file.readline(), label_file.readline()
-  return data_set # 3 outputs in each unit: source_ids, target_ids, label_ids
+  if weight_file:
+    weight_file.close()
+  return data_set # 3 outputs in each unit: source_ids, target_ids, label_ids (, weight)
+
+# Copies of the input, tag and label vocabularies that the checkpoints of a
+# train dir were trained with, read back by warm_start.
+TRAIN_DIR_VOCABS = ('in_vocab.txt', 'tag_vocab.txt', 'label_vocab.txt')
+
+def save_vocabularies(train_dir, vocab_paths):
+  """Copy the (input, tag, label) vocabulary files into train_dir."""
+  for vocab_path, name in zip(vocab_paths, TRAIN_DIR_VOCABS):
+    tmp_path = os.path.join(train_dir, '.tmp-' + name)
+    shutil.copyfile(vocab_path, tmp_path)
+    os.rename(tmp_path, os.path.join(train_dir, name))
+
+def _vocab_axis(name):
+  """(vocabulary index, axis) of a parameter indexed by a vocabulary, or None.
+
+  The vocabulary index is the position in TRAIN_DIR_VOCABS: the word
+  embedding rows follow the input vocabulary, the last axis of the tagging
+  output projection the tag vocabulary and the one of the intent output
+  layer the label vocabulary.
+  """
+  if name.endswith('embedding'):
+    return 0, 0
+  if '/AttnRnnOutputProjection/' in name or '/non-attention_RNN/' in name:
+    return 1, -1
+  if name.endswith('Out_Matrix') or name.endswith('Out_Bias'):
+    return 2, -1
+  return None
+
+def warm_start(session, model, vocabs, warm_start_dir, old_vocab_path=''):
+  """Initialize model parameters from a model trained on older vocabularies.
+
+  Parameters indexed by a vocabulary (the word embedding, the tagging and
+  the intent output layers) are always remapped by token, even when their
+  shape did not change: the vocabularies are sorted by frequency, so a new
+  corpus reorders them. Tokens kept in the new vocabularies keep their
+  trained weights and only new tokens keep their fresh initialization.
+  Other parameters are copied as is when their shape did not change. The
+  global step and the optimizer slots are not copied, so training restarts
+  from step 0 as a fine-tuning run.
+
+  Args:
+    session: tensorflow session, with the model freshly initialized.
+    model: the training MultiTaskModel.
+    vocabs: the new (input, tag, label) vocabularies, token -> id.
+    warm_start_dir: train dir of the old model, with its TRAIN_DIR_VOCABS.
+    old_vocab_path: input vocabulary file of the old model, overrides the
+      one of warm_start_dir.
+
+  Raises:
+    ValueError: warm_start_dir has no checkpoint or misses a vocabulary.
+  """
+  ckpt = tf.train.get_checkpoint_state(warm_start_dir)
+  if not ckpt:
+    raise ValueError("No checkpoint found in %s." % warm_start_dir)
+  old_vocab_paths = [os.path.join(warm_start_dir, name) for name in TRAIN_DIR_VOCABS]
+  if old_vocab_path:
+    old_vocab_paths[0] = old_vocab_path
+  for path in old_vocab_paths:
+    if not tf.gfile.Exists(path):
+      raise ValueError("Cannot warm start from %s: vocabulary %s of the old model not found."
+                       % (warm_start_dir, path))
+  old_vocabs = [data_utils.initialize_vocabulary(path)[0] for path in old_vocab_paths]
+  print("Warm starting from %s" % ckpt.model_checkpoint_path)
+  reader = tf.train.NewCheckpointReader(ckpt.model_checkpoint_path)
+  saved_shapes = reader.get_variable_to_shape_map()
+
+  for v in model.checkpoint_variables:
+    name = v.op.name
+    if v is model.global_step or 'Adam' in name or name.endswith('_power'):
+      continue
+    if name not in saved_shapes:
+      print("  %s: not in the old model, fresh initialization" % name)
+      continue
+    value = reader.get_tensor(name)
+    old_shape, new_shape = list(value.shape), v.get_shape().as_list()
+    vocab_axis = _vocab_axis(name)
+    if vocab_axis is not None:
+      index, axis = vocab_axis
+      del old_shape[axis], new_shape[axis]
+    if old_shape != new_shape:
+      print("  %s: shape changed %s -> %s, fresh initialization"
+            % (name, value.shape, v.get_shape()))
+      continue
+    if vocab_axis is not None:
+      new_ids, old_ids = [], []
+      for w, new_id in vocabs[index].items():
+        old_id = old_vocabs[index].get(w)
+        if old_id is not None and old_id < value.shape[axis]:
+          new_ids.append(new_id)
+          old_ids.append(old_id)
+      new_value = session.run(v)
+      # swapaxes returns views, the assignment writes into new_value
+      np.swapaxes(new_value, 0, axis)[new_ids] = np.swapaxes(value, 0, axis)[old_ids]
+      size = new_value.shape[axis]
+      print("  %s: remapped %d of %d %s, %d new tokens"
+            % (name, len(new_ids), size, TRAIN_DIR_VOCABS[index], size - len(new_ids)))
+      value = new_value
+    placeholder = tf.placeholder(v.dtype.base_dtype, shape=v.get_shape())
+    session.run(v.assign(placeholder), feed_dict={placeholder: value})
+
+def _free_port():
+  sock = socket.socket()
+  sock.bind(('localhost', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+def _run_worker_server(cluster_def, task_index, num_threads):
+  config = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                          inter_op_parallelism_threads=num_threads)
+  server = tf.train.Server(tf.train.ClusterSpec(cluster_def), job_name='worker',
+                           task_index=task_index, config=config)
+  server.join()
+
+def start_local_cluster(num_workers):
+  """Start num_workers worker processes and an in-process parameter server.
+
+  The parameters live in this process (job 'ps'); each worker process runs
+  one model tower on its share of the batch. The worker processes must be
+  started before any session is created in this process.
 
-def create_model(session, source_vocab_size, target_vocab_size, label_vocab_size):
+  Returns:
+    (server, workers): the parameter server to create the session on, and
+    the worker processes.
+  """
+  cluster_def = {'ps': ['localhost:%d' % _free_port()],
+                 'worker': ['localhost:%d' % _free_port() for _ in xrange(num_workers)]}
+  num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+  workers = []
+  for i in xrange(num_workers):
+    worker = multiprocessing.Process(target=_run_worker_server, args=(cluster_def, i, num_threads))
+    worker.daemon = True
+    worker.start()
+    workers.append(worker)
+  server = tf.train.Server(tf.train.ClusterSpec(cluster_def), job_name='ps', task_index=0)
+  return server, workers
+
+def get_tower_devices(num_workers):
+  """Devices of the model towers: variables on the ps, compute on each worker."""
+  if not num_workers:
+    return None
+  return [tf.train.replica_device_setter(ps_tasks=1, ps_device='/job:ps/task:0',
+                                         worker_device='/job:worker/task:%d' % i)
+          for i in xrange(num_workers)]
+
+def create_model(session, source_vocab_size, target_vocab_size, label_vocab_size, vocabs=None):
   """Create model and initialize or load parameters in session."""
   with tf.variable_scope("model", reuse=None):
     model_train = multi_task_model.MultiTaskModel(
@@ -183,7 +356,8 @@ def create_model(session, source_vocab_size, target_vocab_size, label_vocab_size
           forward_only=False,
           use_attention=FLAGS.use_attention,
           bidirectional_rnn=FLAGS.bidirectional_rnn,
-          task=task)
+          task=task,
+          tower_devices=get_tower_devices(FLAGS.num_workers))
   with tf.variable_scope("model", reuse=True):
     model_test = multi_task_model.MultiTaskModel(
           source_vocab_size, target_vocab_size, label_vocab_size, _buckets,
@@ -201,8 +375,99 @@ def create_model(session, source_vocab_size, target_vocab_size, label_vocab_size
   else:
     print("Created model with fresh parameters.")
     session.run(tf.global_variables_initializer())
+    if FLAGS.warm_start_dir and vocabs is not None:
+      warm_start(session, model_train, vocabs, FLAGS.warm_start_dir, FLAGS.warm_start_vocab)
   return model_train, model_test
 
+def run_batched_eval(sess, model_test, data_set, mode, rev_vocab, rev_tag_vocab,
+                     rev_label_vocab, taging_out_file, batch_size=None):
+  """Evaluate on a whole data set, sequentially and in batches.
+
+  Every sample is visited exactly once in file order, so the reported metrics
+  are deterministic for a given checkpoint.
+
+  Args:
+    sess: tensorflow session to use.
+    model_test: the forward-only MultiTaskModel.
+    data_set: bucketed data as returned by read_data.
+    mode: 'Eval' or 'Test', only used for printing.
+    rev_vocab, rev_tag_vocab, rev_label_vocab: reversed vocabularies.
+    taging_out_file: file the tagging hypotheses are written to for conlleval.
+    batch_size: inference batch size; defaults to FLAGS.eval_batch_size.
+
+  Returns:
+    A triple of the average loss, the intent accuracy (in percent) and the
+    conlleval tagging result dict ({} if tagging is not evaluated).
+  """
+  batch_size = batch_size or FLAGS.eval_batch_size
+  word_list = list()
+  ref_tag_list = list()
+  hyp_tag_list = list()
+  correct_count = 0
+  count = 0
+  eval_loss = 0.0
+  tagging_eval_result = dict()
+  for bucket_id in xrange(len(_buckets)):
+    bucket_size = len(data_set[bucket_id])
+    for start in xrange(0, bucket_size, batch_size):
+      sample_ids = range(start, min(start + batch_size, bucket_size))
+      encoder_inputs, tags, tag_weights, sequence_length, labels = model_test.get_batch_by_ids(
+        data_set, bucket_id, sample_ids)
+      tagging_logits = []
+      classification_logits = []
+      if task['joint'] == 1:
+        _, step_loss, tagging_logits, classification_logits = model_test.joint_step(sess, encoder_inputs, tags, tag_weights, labels,
+                                   sequence_length, bucket_id, True)
+      elif task['tagging'] == 1:
+        _, step_loss, tagging_logits = model_test.tagging_step(sess, encoder_inputs, tags, tag_weights,
+                                   sequence_length, bucket_id, True)
+      elif task['intent'] == 1:
+        _, step_loss, classification_logits = model_test.classification_step(sess, encoder_inputs, labels,
+                                   sequence_length, bucket_id, True)
+      count += len(sample_ids)
+      eval_loss += step_loss * len(sample_ids)
+      if task['intent'] == 1:
+        hyp_labels = np.argmax(classification_logits, axis=1)
+        correct_count += int(np.sum(hyp_labels == labels[0]))
+      if task['tagging'] == 1:
+        # [time, batch, tag_vocab] -> [batch, time]
+        hyp_tags = np.argmax(np.array(tagging_logits), axis=2).T
+        ref_tags = np.array(tags).T
+        words = np.array(encoder_inputs).T
+        for batch_idx, length in enumerate(sequence_length):
+          word_list.append([rev_vocab[x] for x in words[batch_idx][:length]])
+          ref_tag_list.append([rev_tag_vocab[x] for x in ref_tags[batch_idx][:length]])
+          hyp_tag_list.append([rev_tag_vocab[x] for x in hyp_tags[batch_idx][:length]])
+
+  count = max(count, 1)
+  eval_loss /= count
+  accuracy = float(correct_count)*100/count
+  eval_ppx = math.exp(eval_loss) if eval_loss < 300 else float('inf')
+  print("  %s perplexity: %.2f" % (mode, eval_ppx))
+  if task['intent'] == 1:
+    print("  %s accuracy: %.2f %d/%d" % (mode, accuracy, correct_count, count))
+  if task['tagging'] == 1:
+    tagging_eval_result = conlleval(hyp_tag_list, ref_tag_list, word_list, taging_out_file)
+    print("  %s f1-score: %.2f" % (mode, tagging_eval_result['f1']))
+  sys.stdout.flush()
+  return eval_loss, accuracy, tagging_eval_result
+
+def current_rss_mb():
+  """Resident set size of this process in MB (peak RSS if /proc is unavailable)."""
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) / 1024.0
+  except IOError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def write_telemetry(telemetry_file, record):
+  """Append one JSON record to the telemetry stream."""
+  telemetry_file.write(json.dumps(record, sort_keys=True) + '\n')
+  telemetry_file.flush()
+
 def train():
   print ('Applying Parameters:')
   for k,v in FLAGS.__dict__['__flags'].items():
@@ -225,12 +490,21 @@ def train():
   tag_vocab, rev_tag_vocab = data_utils.initialize_vocabulary(tag_vocab_path)
   label_vocab, rev_label_vocab = data_utils.initialize_vocabulary(label_vocab_path)
 
-  with tf.Session() as sess:
+  target = ''
+  workers = []
+  if FLAGS.num_workers > 0:
+    print("Starting %d worker processes." % FLAGS.num_workers)
+    server, workers = start_local_cluster(FLAGS.num_workers)
+    target = server.target
+
+  with tf.Session(target) as sess:
     # Create model.
     print("Max sequence length: %d." % _buckets[0][0])
     print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
 
-    model, model_test = create_model(sess, len(vocab), len(tag_vocab), len(label_vocab))
+    resumed = tf.train.get_checkpoint_state(FLAGS.train_dir) is not None
+    model, model_test = create_model(sess, len(vocab), len(tag_vocab), len(label_vocab),
+                                     vocabs=(vocab, tag_vocab, label_vocab))
     print ("Creating model with source_vocab_size=%d, target_vocab_size=%d, and label_vocab_size=%d." % (len(vocab), len(tag_vocab), len(label_vocab)))
 
     # Read data into buckets and compute their sizes.
@@ -238,142 +512,133 @@ def train():
            % FLAGS.max_train_data_size)
     dev_set = read_data(in_seq_dev, out_seq_dev, label_dev)
     test_set = read_data(in_seq_test, out_seq_test, label_test)
-    train_set = read_data(in_seq_train, out_seq_train, label_train)
-    train_bucket_sizes = [len(train_set[b]) for b in xrange(len(_buckets))]
+    weight_train = data_utils.get_weight_path(FLAGS.data_dir, 'train')
+    train_set = read_data(in_seq_train, out_seq_train, label_train, weight_path=weight_train)
+    train_weights = None
+    if weight_train:
+      # Sample each unique example in proportion to its number of occurrences.
+      train_weights = [model.sampling_weights(train_set[b]) for b in xrange(len(_buckets))]
+      train_bucket_sizes = [train_weights[b][-1] if len(train_weights[b]) else 0
+                            for b in xrange(len(_buckets))]
+      print("Read %d unique training examples with total weight %d."
+            % (sum(len(b) for b in train_set), sum(train_bucket_sizes)))
+    else:
+      train_bucket_sizes = [len(train_set[b]) for b in xrange(len(_buckets))]
     train_total_size = float(sum(train_bucket_sizes))
 
     train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
                            for i in xrange(len(train_bucket_sizes))]
 
+    # Kept next to the checkpoints for a later warm start.
+    save_vocabularies(FLAGS.train_dir, (vocab_path, tag_vocab_path, label_vocab_path))
+
     # This is the training loop.
     step_time, loss = 0.0, 0.0
     current_step = 0
+    # a fresh run starts a new file, a resumed one appends to it
+    telemetry_file = open(os.path.join(FLAGS.train_dir, FLAGS.telemetry_file), 'a' if resumed else 'w')
+    # Checkpoints are written by a background thread; the step loop only
+    # waits for the in-memory snapshot.
+    saver = AsyncSaver(model.checkpoint_variables)
+    data_wait_time, compute_time = 0.0, 0.0
+    interval_examples, interval_tokens = 0, 0
+    interval_start_time = time.time()
 
     best_valid_score = 0
     best_test_score = 0
-    while model.global_step.eval() < FLAGS.max_training_steps:
-      random_number_01 = np.random.random_sample()
-      bucket_id = min([i for i in xrange(len(train_buckets_scale))
-                       if train_buckets_scale[i] > random_number_01])
-
-      # Get a batch and make a step.
-      start_time = time.time()
-      encoder_inputs, tags, tag_weights, batch_sequence_length, labels = model.get_batch(train_set, bucket_id)
-      if task['joint'] == 1:
-        _, step_loss, tagging_logits, classification_logits = model.joint_step(sess, encoder_inputs, tags, tag_weights, labels,
-                                   batch_sequence_length, bucket_id, False)
-      elif task['tagging'] == 1:
-        _, step_loss, tagging_logits = model.tagging_step(sess, encoder_inputs, tags, tag_weights,
-                                   batch_sequence_length, bucket_id, False)
-      elif task['intent'] == 1:
-        _, step_loss, classification_logits = model.classification_step(sess, encoder_inputs, labels,
-                                   batch_sequence_length, bucket_id, False)
-
-      step_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
-      loss += step_loss / FLAGS.steps_per_checkpoint
-      current_step += 1
-
-      # Once in a while, we save checkpoint, print statistics, and run evals.
-      if current_step % FLAGS.steps_per_checkpoint == 0:
-        perplexity = math.exp(loss) if loss < 300 else float('inf')
-        print ("global step %d step-time %.2f. Training perplexity %.2f"
-            % (model.global_step.eval(), step_time, perplexity))
-        sys.stdout.flush()
-        # Save checkpoint and zero timer and loss.
-        checkpoint_path = os.path.join(FLAGS.train_dir, "model.ckpt")
-        model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-        step_time, loss = 0.0, 0.0
-        for bucket_id in range(len(_buckets)):
-            eval_loss = 0.0
-            encoder_inputs, tags, tag_weights, batch_sequence_length, labels = model_test.get_batch(
-                dev_set, bucket_id)
-            tagging_logits = []
-            classification_logits = []
-            if task['joint'] == 1:
-                _, step_loss, tagging_logits, classification_logits = model_test.joint_step(
-                    sess, encoder_inputs, tags, tag_weights, labels,
-                    batch_sequence_length, bucket_id, True)
-            elif task['tagging'] == 1:
-                _, step_loss, tagging_logits = model_test.tagging_step(
-                    sess, encoder_inputs, tags, tag_weights,
-                    batch_sequence_length, bucket_id, True)
-            elif task['intent'] == 1:
-                _, step_loss, classification_logits = model_test.classification_step(
-                    sess, encoder_inputs, labels,
-                    batch_sequence_length, bucket_id, True)
-            eval_ppx = math.exp(step_loss) if step_loss < 300 else float('inf')
-            print("validation perplexity %.2f" % eval_ppx)
-        sys.stdout.flush()
-
-        if FLAGS.test_while_train:
-            def run_valid_test(data_set, mode): # mode: Eval, Test
-            # Run evals on development/test set and print the accuracy.
-                word_list = list()
-                ref_tag_list = list()
-                hyp_tag_list = list()
-                ref_label_list = list()
-                hyp_label_list = list()
-                correct_count = 0
-                accuracy = 0.0
-                tagging_eval_result = dict()
-                for bucket_id in xrange(len(_buckets)):
-                  eval_loss = 0.0
-                  count = 0
-                  for i in xrange(len(data_set[bucket_id])):
-                    count += 1
-                    encoder_inputs, tags, tag_weights, sequence_length, labels = model_test.get_one(
-                      data_set, bucket_id, i)
-                    tagging_logits = []
-                    classification_logits = []
-                    if task['joint'] == 1:
-                      _, step_loss, tagging_logits, classification_logits = model_test.joint_step(sess, encoder_inputs, tags, tag_weights, labels,
-                                                 sequence_length, bucket_id, True)
-                    elif task['tagging'] == 1:
-                      _, step_loss, tagging_logits = model_test.tagging_step(sess, encoder_inputs, tags, tag_weights,
-                                                 sequence_length, bucket_id, True)
-                    elif task['intent'] == 1:
-                      _, step_loss, classification_logits = model_test.classification_step(sess, encoder_inputs, labels,
-                                                 sequence_length, bucket_id, True)
-                    eval_loss += step_loss / len(data_set[bucket_id])
-                    hyp_label = None
-                    if task['intent'] == 1:
-                      ref_label_list.append(rev_label_vocab[labels[0][0]])
-                      hyp_label = np.argmax(classification_logits[0],0)
-                      hyp_label_list.append(rev_label_vocab[hyp_label])
-                      if labels[0] == hyp_label:
-                        correct_count += 1
-                    if task['tagging'] == 1:
-                      word_list.append([rev_vocab[x[0]] for x in encoder_inputs[:sequence_length[0]]])
-                      ref_tag_list.append([rev_tag_vocab[x[0]] for x in tags[:sequence_length[0]]])
-                      hyp_tag_list.append([rev_tag_vocab[np.argmax(x)] for x in tagging_logits[:sequence_length[0]]])
-
-                accuracy = float(correct_count)*100/count
-                if task['intent'] == 1:
-                  print("  %s accuracy: %.2f %d/%d" % (mode, accuracy, correct_count, count))
-                  sys.stdout.flush()
-                if task['tagging'] == 1:
-                  if mode == 'Eval':
-                      taging_out_file = current_taging_valid_out_file
-                  elif mode == 'Test':
-                      taging_out_file = current_taging_test_out_file
-                  tagging_eval_result = conlleval(hyp_tag_list, ref_tag_list, word_list, taging_out_file)
-                  print("  %s f1-score: %.2f" % (mode, tagging_eval_result['f1']))
-                  sys.stdout.flush()
-                return accuracy, tagging_eval_result
-
-            # valid
-            valid_accuracy, valid_tagging_result = run_valid_test(dev_set, 'Eval')
-            if task['tagging'] == 1 and valid_tagging_result['f1'] > best_valid_score:
-              best_valid_score = valid_tagging_result['f1']
-              # save the best output file
-              subprocess.call(['mv', current_taging_valid_out_file, current_taging_valid_out_file + '.best_f1_%.2f' % best_valid_score])
-            # test, run test after each validation for development purpose.
-            test_accuracy, test_tagging_result = run_valid_test(test_set, 'Test')
-            if task['tagging'] == 1 and test_tagging_result['f1'] > best_test_score:
-              best_test_score = test_tagging_result['f1']
-              # save the best output file
-              subprocess.call(['mv', current_taging_test_out_file, current_taging_test_out_file + '.best_f1_%.2f' % best_test_score])
+    try:
+      while model.global_step.eval() < FLAGS.max_training_steps:
+        random_number_01 = np.random.random_sample()
+        bucket_id = min([i for i in xrange(len(train_buckets_scale))
+                         if train_buckets_scale[i] > random_number_01])
+
+        # Get a batch and make a step.
+        start_time = time.time()
+        encoder_inputs, tags, tag_weights, batch_sequence_length, labels = model.get_batch(
+            train_set, bucket_id, train_weights[bucket_id] if train_weights else None)
+        compute_start_time = time.time()
+        data_wait_time += compute_start_time - start_time
+        if task['joint'] == 1:
+          _, step_loss, tagging_logits, classification_logits = model.joint_step(sess, encoder_inputs, tags, tag_weights, labels,
+                                     batch_sequence_length, bucket_id, False)
+        elif task['tagging'] == 1:
+          _, step_loss, tagging_logits = model.tagging_step(sess, encoder_inputs, tags, tag_weights,
+                                     batch_sequence_length, bucket_id, False)
+        elif task['intent'] == 1:
+          _, step_loss, classification_logits = model.classification_step(sess, encoder_inputs, labels,
+                                     batch_sequence_length, bucket_id, False)
+
+        compute_time += time.time() - compute_start_time
+        step_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
+        loss += step_loss / FLAGS.steps_per_checkpoint
+        current_step += 1
+        interval_examples += len(batch_sequence_length)
+        interval_tokens += int(np.sum(batch_sequence_length))
+
+        # Once in a while, we save checkpoint, print statistics, and run evals.
+        if current_step % FLAGS.steps_per_checkpoint == 0:
+          perplexity = math.exp(loss) if loss < 300 else float('inf')
+          print ("global step %d step-time %.2f. Training perplexity %.2f"
+              % (model.global_step.eval(), step_time, perplexity))
+          sys.stdout.flush()
+          interval_time = time.time() - interval_start_time
+          record = {'global_step': int(model.global_step.eval()),
+                    'time': time.time(),
+                    'steps': FLAGS.steps_per_checkpoint,
+                    'interval_sec': interval_time,
+                    'step_time': step_time,
+                    'examples_per_sec': interval_examples / interval_time,
+                    'tokens_per_sec': interval_tokens / interval_time,
+                    'data_wait_sec': data_wait_time,
+                    'compute_sec': compute_time,
+                    'train_perplexity': perplexity}
+          # Save checkpoint and zero timer and loss.
+          checkpoint_start_time = time.time()
+          checkpoint_path = os.path.join(FLAGS.train_dir, "model.ckpt")
+          saver.save(sess, checkpoint_path, global_step=model.global_step)
+          record['checkpoint_sec'] = time.time() - checkpoint_start_time
+          if saver.last_write:
+            # the write of this checkpoint is still running, report the previous one
+            record['prev_checkpoint_step'], record['prev_checkpoint_write_sec'] = saver.last_write
+          step_time, loss = 0.0, 0.0
+
+          eval_start_time = time.time()
+          if FLAGS.test_while_train:
+              # valid
+              valid_loss, valid_accuracy, valid_tagging_result = run_batched_eval(
+                  sess, model_test, dev_set, 'Eval', rev_vocab, rev_tag_vocab, rev_label_vocab,
+                  current_taging_valid_out_file)
+              if task['tagging'] == 1 and valid_tagging_result['f1'] > best_valid_score:
+                best_valid_score = valid_tagging_result['f1']
+                # save the best output file
+                subprocess.call(['mv', current_taging_valid_out_file, current_taging_valid_out_file + '.best_f1_%.2f' % best_valid_score])
+              # test, run test after each validation for development purpose.
+              test_loss, test_accuracy, test_tagging_result = run_batched_eval(
+                  sess, model_test, test_set, 'Test', rev_vocab, rev_tag_vocab, rev_label_vocab,
+                  current_taging_test_out_file)
+              if task['tagging'] == 1 and test_tagging_result['f1'] > best_test_score:
+                best_test_score = test_tagging_result['f1']
+                # save the best output file
+                subprocess.call(['mv', current_taging_test_out_file, current_taging_test_out_file + '.best_f1_%.2f' % best_test_score])
+              record.update({'valid_perplexity': math.exp(valid_loss) if valid_loss < 300 else None,
+                             'valid_accuracy': valid_accuracy,
+                             'valid_f1': valid_tagging_result.get('f1'),
+                             'test_accuracy': test_accuracy,
+                             'test_f1': test_tagging_result.get('f1')})
+          record['eval_sec'] = time.time() - eval_start_time
+          record['rss_mb'] = current_rss_mb()
+          write_telemetry(telemetry_file, record)
+          data_wait_time, compute_time = 0.0, 0.0
+          interval_examples, interval_tokens = 0, 0
+          interval_start_time = time.time()
+    finally:
+      # write the checkpoint still queued, e.g. on Ctrl-C
+      saver.close()
+      telemetry_file.close()
+  for worker in workers:
+    worker.terminate()
         
+
 def test():
   print ('Applying Parameters:')
   for k,v in FLAGS.__dict__['__flags'].items():
@@ -382,7 +647,7 @@ def test():
   vocab_path = ''
   tag_vocab_path = ''
   label_vocab_path = ''
-  in_seq_train, out_seq_train, label_train, in_seq_dev, out_seq_dev, label_dev, in_seq_test, out_seq_test, label_test, vocab_path, tag_vocab_path, label_vocab_path = data_utils.prepare_multi_task_data(
+  vocab_path, tag_vocab_path, label_vocab_path = data_utils.load_multi_task_vocabularies(
     FLAGS.data_dir, FLAGS.in_vocab_size, FLAGS.out_vocab_size)
 
   vocab, rev_vocab = data_utils.initialize_vocabulary(vocab_path)
@@ -447,7 +712,8 @@ class NLU_test(object):
         vocab_path = ''
         tag_vocab_path = ''
         label_vocab_path = ''
-        in_seq_train, out_seq_train, label_train, in_seq_dev, out_seq_dev, label_dev, in_seq_test, out_seq_test, label_test, vocab_path, tag_vocab_path, label_vocab_path = data_utils.prepare_multi_task_data(FLAGS.data_dir, FLAGS.in_vocab_size, FLAGS.out_vocab_size)
+        vocab_path, tag_vocab_path, label_vocab_path = data_utils.load_multi_task_vocabularies(
+          FLAGS.data_dir, FLAGS.in_vocab_size, FLAGS.out_vocab_size)
 
         self.vocab, self.rev_vocab = data_utils.initialize_vocabulary(vocab_path)
         self.tag_vocab, self.rev_tag_vocab = data_utils.initialize_vocabulary(tag_vocab_path)
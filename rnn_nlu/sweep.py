@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Hyperparameter sweep for the multi-task RNN model.
+
+The token-id data is read and packed once into shared memory; every trial
+runs in its own forked process, pinned to a set of CPUs no other running
+trial uses, builds the model with the trial's hyperparameters, trains it
+from scratch for max_training_steps and evaluates it on the full valid and
+test sets. One row per trial, with its error if it failed, is collected
+into a results table in train_dir.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+import tensorflow as tf
+
+tf.app.flags.DEFINE_string("sweep_grid",
+                           '{"size": [64, 128], "word_embedding_size": [64, 128], '
+                           '"dropout_keep_prob": [0.5, 0.8]}',
+                           "JSON dict of flag name -> list of values to sweep.")
+tf.app.flags.DEFINE_integer("sweep_trials", 0,
+                            "Number of configurations drawn at random from the grid (0: full grid).")
+tf.app.flags.DEFINE_integer("sweep_workers", 0,
+                            "Trials run in parallel (0: one per 2 CPUs).")
+tf.app.flags.DEFINE_integer("sweep_seed", 0, "Seed of the random search and of every trial.")
+
+from . import data_utils
+from . import run_multi_task_rnn
+from .run_multi_task_rnn import FLAGS, task
+
+SWEEP_FLAGS = ['size', 'word_embedding_size', 'num_layers', 'dropout_keep_prob',
+               'use_attention', 'bidirectional_rnn', 'batch_size', 'max_gradient_norm']
+RESULT_COLUMNS = ['trial', 'config', 'valid_accuracy', 'valid_f1', 'test_accuracy', 'test_f1',
+                  'train_sec', 'eval_sec', 'steps_per_sec', 'error']
+
+
+class PackedBucket(object):
+  """Read-only list of (source, target, label[, weight]) units backed by flat arrays.
+
+  Works as a bucket of the data_set given to MultiTaskModel.get_batch and
+  get_batch_by_ids; units are rebuilt on access, so forked processes share
+  the arrays instead of each holding a copy of the python lists.
+  """
+  def __init__(self, units):
+    self.size = len(units)
+    source_lengths = [len(u[0]) for u in units]
+    target_lengths = [len(u[1]) for u in units]
+    self.source_offsets = self._offsets(source_lengths)
+    self.target_offsets = self._offsets(target_lengths)
+    self.sources = self._shared('i', [x for u in units for x in u[0]])
+    self.targets = self._shared('i', [x for u in units for x in u[1]])
+    self.labels = self._shared('i', [u[2][0] for u in units])
+    self.weights = None
+    if units and len(units[0]) > 3:
+      self.weights = self._shared('l', [u[3] for u in units])
+
+  def _offsets(self, lengths):
+    return self._shared('l', np.concatenate([[0], np.cumsum(lengths)]))
+
+  def _shared(self, typecode, values):
+    array = RawArray(typecode, len(values))
+    if len(values):
+      array[:] = [int(v) for v in values]
+    return array
+
+  def __len__(self):
+    return self.size
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += self.size
+    if not 0 <= i < self.size:
+      raise IndexError(i)
+    unit = [list(self.sources[self.source_offsets[i]:self.source_offsets[i + 1]]),
+            list(self.targets[self.target_offsets[i]:self.target_offsets[i + 1]]),
+            [self.labels[i]]]
+    if self.weights is not None:
+      unit.append(self.weights[i])
+    return unit
+
+
+def load_shared_data():
+  """Prepare and read the token-id data once, packed into shared arrays."""
+  (in_seq_train, out_seq_train, label_train, in_seq_dev, out_seq_dev, label_dev,
+   in_seq_test, out_seq_test, label_test, vocab_path, tag_vocab_path,
+   label_vocab_path) = data_utils.prepare_multi_task_data(
+       FLAGS.data_dir, FLAGS.in_vocab_size, FLAGS.out_vocab_size)
+  read_data = run_multi_task_rnn.read_data
+  data = {
+      'train': read_data(in_seq_train, out_seq_train, label_train,
+                         weight_path=data_utils.get_weight_path(FLAGS.data_dir, 'train')),
+      'valid': read_data(in_seq_dev, out_seq_dev, label_dev),
+      'test': read_data(in_seq_test, out_seq_test, label_test)}
+  for name in data:
+    data[name] = [PackedBucket(bucket) for bucket in data[name]]
+  data['vocab'] = data_utils.initialize_vocabulary(vocab_path)
+  data['tag_vocab'] = data_utils.initialize_vocabulary(tag_vocab_path)
+  data['label_vocab'] = data_utils.initialize_vocabulary(label_vocab_path)
+  return data
+
+
+def sweep_configs(grid, nb_trials, seed):
+  """Full grid, or nb_trials distinct configurations drawn from it."""
+  for name in grid:
+    if name not in SWEEP_FLAGS:
+      raise ValueError("Cannot sweep %s, options: %s" % (name, ', '.join(SWEEP_FLAGS)))
+  names = sorted(grid)
+  configs = [dict(zip(names, values)) for values in itertools.product(*[grid[n] for n in names])]
+  if nb_trials > 0 and nb_trials < len(configs):
+    configs = random.Random(seed).sample(configs, nb_trials)
+  return configs
+
+
+def pin_cpus(cpus):
+  """Pin this process to the given CPUs, where the platform allows it."""
+  if hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, cpus)
+    return
+  try:
+    with open(os.devnull, 'w') as devnull:
+      subprocess.call(['taskset', '-p', '-c', ','.join(str(c) for c in cpus), str(os.getpid())],
+                      stdout=devnull, stderr=devnull)
+  except OSError:
+    pass
+
+
+# dataset shared with the forked trial processes, set by run_sweep
+_shared_data = {}
+# queue of the free CPU sets, set in every trial process by init_trial_process
+_cpu_sets = []
+
+def init_trial_process(cpu_sets):
+  _cpu_sets[:] = [cpu_sets]
+
+def run_trial(job):
+  """Train and evaluate one configuration on a free CPU set, returned when
+  the trial ends. Runs in its own process, a failed trial returns its error."""
+  trial_id, config = job
+  cpu_sets = _cpu_sets[0]
+  cpus = cpu_sets.get()
+  try:
+    pin_cpus(cpus)
+    return _train_and_eval(trial_id, config, cpus)
+  except Exception:
+    return {'trial': trial_id, 'config': config, 'error': traceback.format_exc()}
+  finally:
+    cpu_sets.put(cpus)
+
+def _train_and_eval(trial_id, config, cpus):
+  for name, value in config.items():
+    setattr(FLAGS, name, value)
+  FLAGS.train_dir = os.path.join(FLAGS.train_dir, 'trial_%03d' % trial_id)
+  # never restore the checkpoint of another configuration from an earlier sweep
+  if os.path.isdir(FLAGS.train_dir):
+    shutil.rmtree(FLAGS.train_dir)
+  os.makedirs(FLAGS.train_dir)
+  random.seed(FLAGS.sweep_seed + trial_id)
+  np.random.seed(FLAGS.sweep_seed + trial_id)
+
+  data = _shared_data
+  vocab, rev_vocab = data['vocab']
+  tag_vocab, rev_tag_vocab = data['tag_vocab']
+  label_vocab, rev_label_vocab = data['label_vocab']
+  train_set = data['train']
+  config_proto = tf.ConfigProto(intra_op_parallelism_threads=len(cpus),
+                                inter_op_parallelism_threads=len(cpus))
+  with tf.Graph().as_default(), tf.Session(config=config_proto) as sess:
+    tf.set_random_seed(FLAGS.sweep_seed + trial_id)
+    model, model_test = run_multi_task_rnn.create_model(
+        sess, len(vocab), len(tag_vocab), len(label_vocab))
+    train_weights = None
+    if train_set[0].weights is not None:
+      train_weights = [model.sampling_weights(b) for b in train_set]
+    bucket_sizes = [len(b) for b in train_set]
+    buckets_scale = np.cumsum(bucket_sizes) / float(sum(bucket_sizes))
+
+    start_time = time.time()
+    steps = 0
+    while model.global_step.eval() < FLAGS.max_training_steps:
+      bucket_id = int(np.searchsorted(buckets_scale, np.random.random_sample(), side='right'))
+      encoder_inputs, tags, tag_weights, batch_sequence_length, labels = model.get_batch(
+          train_set, bucket_id, train_weights[bucket_id] if train_weights else None)
+      if task['joint'] == 1:
+        model.joint_step(sess, encoder_inputs, tags, tag_weights, labels,
+                         batch_sequence_length, bucket_id, False)
+      elif task['tagging'] == 1:
+        model.tagging_step(sess, encoder_inputs, tags, tag_weights,
+                           batch_sequence_length, bucket_id, False)
+      elif task['intent'] == 1:
+        model.classification_step(sess, encoder_inputs, labels,
+                                  batch_sequence_length, bucket_id, False)
+      steps += 1
+    train_time = time.time() - start_time
+    model.saver.save(sess, os.path.join(FLAGS.train_dir, "model.ckpt"), global_step=model.global_step)
+
+    start_time = time.time()
+    results = {}
+    for name, mode in [('valid', 'Eval'), ('test', 'Test')]:
+      _, accuracy, tagging_result = run_multi_task_rnn.run_batched_eval(
+          sess, model_test, data[name], mode, rev_vocab, rev_tag_vocab, rev_label_vocab,
+          os.path.join(FLAGS.train_dir, 'tagging.%s.hyp.txt' % name))
+      results[name + '_accuracy'] = accuracy
+      results[name + '_f1'] = tagging_result.get('f1')
+    results.update({'trial': trial_id, 'config': config,
+                    'train_sec': train_time, 'eval_sec': time.time() - start_time,
+                    'steps_per_sec': steps / train_time if train_time > 0 else None,
+                    'error': None})
+  return results
+
+
+def run_sweep():
+  configs = sweep_configs(json.loads(FLAGS.sweep_grid), FLAGS.sweep_trials, FLAGS.sweep_seed)
+  cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+      else range(multiprocessing.cpu_count())
+  nb_workers = FLAGS.sweep_workers or max(1, len(cpus) // 2)
+  nb_workers = min(nb_workers, len(configs))
+  cpu_sets = [cpus[i::nb_workers] for i in xrange(nb_workers)]
+  print("Running %d trials on %d workers." % (len(configs), nb_workers))
+  sys.stdout.flush()
+
+  _shared_data.update(load_shared_data())
+  if not os.path.isdir(FLAGS.train_dir):
+    os.makedirs(FLAGS.train_dir)
+  # Trials are forked after the data is loaded; maxtasksperchild gives each
+  # trial a fresh process and graph. The pool hands a job to whichever worker
+  # is free, so the CPU sets go through a queue: a trial takes a free set
+  # when it starts and puts it back when it ends.
+  free_cpu_sets = multiprocessing.Queue()
+  for cpu_set in cpu_sets:
+    free_cpu_sets.put(cpu_set)
+  jobs = list(enumerate(configs))
+  pool = multiprocessing.Pool(nb_workers, init_trial_process, (free_cpu_sets,), maxtasksperchild=1)
+  results = []
+  result_path = os.path.join(FLAGS.train_dir, 'sweep_results.tsv')
+  with open(result_path, 'w') as f:
+    f.write('\t'.join(RESULT_COLUMNS) + '\n')
+    for result in pool.imap_unordered(run_trial, jobs):
+      results.append(result)
+      row = [json.dumps(result[c], sort_keys=True) if c in ('config', 'error') else str(result.get(c))
+             for c in RESULT_COLUMNS]
+      f.write('\t'.join(row) + '\n')
+      f.flush()
+      if result.get('error'):
+        print('trial %d failed: %s' % (result['trial'], result['error']))
+      else:
+        print('trial %d done: %s' % (result['trial'], json.dumps(result, sort_keys=True)))
+      sys.stdout.flush()
+  pool.close()
+  pool.join()
+
+  results.sort(key=lambda r: (r.get('valid_f1') or 0, r.get('valid_accuracy') or 0), reverse=True)
+  print('\t'.join(RESULT_COLUMNS[:-1]))
+  for result in results:
+    if not result.get('error'):
+      print('\t'.join(json.dumps(result[c], sort_keys=True) if c == 'config' else str(result[c])
+                      for c in RESULT_COLUMNS[:-1]))
+  failed = [r['trial'] for r in results if r.get('error')]
+  if failed:
+    print('Failed trials: %s' % ', '.join(str(t) for t in sorted(failed)))
+  print('Results written to %s' % result_path)
+
+
+def main(_):
+  run_sweep()
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -223,7 +223,7 @@ class test_model():
     vocab_path = ''
     tag_vocab_path = ''
     label_vocab_path = ''
-    in_seq_train, out_seq_train, label_train, in_seq_dev, out_seq_dev, label_dev, in_seq_test, out_seq_test, label_test, vocab_path, tag_vocab_path, label_vocab_path = data_utils.prepare_multi_task_data(
+    vocab_path, tag_vocab_path, label_vocab_path = data_utils.load_multi_task_vocabularies(
       FLAGS.data_dir, FLAGS.in_vocab_size, FLAGS.out_vocab_size)
 
     vocab, rev_vocab = data_utils.initialize_vocabulary(vocab_path)
@@ -243,15 +243,19 @@ class test_model():
     return np.exp(x) / np.sum(np.exp(x), axis=0)
 
   def feed_sentence(self,sentence):
-    data_set = [[]]
-    sentence_seg = data_utils.naive_seg(sentence)
-    token_ids = data_utils.prepare_one_data(sentence, self.vocab)
-    # print(token_ids) # NOTE debug
+    return self.feed_sentences([sentence])[0]
 
-    slot_ids = [0 for i in range(len(token_ids))]
-    data_set[0].append([token_ids, slot_ids, [0]])
-    encoder_inputs, tags, tag_weights, sequence_length, labels = self.model_test.get_one(
-        data_set, 0, 0)
+  def feed_sentences(self,sentences):
+    """NLU results of several sentences, computed in one batched step."""
+    if not sentences:
+      return []
+    data_set = [[]]
+    for sentence in sentences:
+      token_ids = data_utils.prepare_one_data(sentence, self.vocab)
+      slot_ids = [0 for i in range(len(token_ids))]
+      data_set[0].append([token_ids, slot_ids, [0]])
+    encoder_inputs, tags, tag_weights, sequence_length, labels = self.model_test.get_batch_by_ids(
+        data_set, 0, range(len(sentences)))
     if task['joint'] == 1:
       _, step_loss, tagging_logits, classification_logits = self.model_test.joint_step(
           self.sess, encoder_inputs, tags, tag_weights, labels,
@@ -265,10 +269,17 @@ class test_model():
           self.sess, encoder_inputs, labels,
           sequence_length, 0, True)
 
+    return [self.decode_result(sentence, [logit[b] for logit in tagging_logits[:sequence_length[b]]],
+                               classification_logits[b])
+            for b, sentence in enumerate(sentences)]
+
+  def decode_result(self,sentence,tagging_logits,classification_logit):
+    """{'intent':{label:prob}, 'slot':{words:tag probs}} of one sentence."""
+    sentence_seg = data_utils.naive_seg(sentence)
     tagging_probs = [self.softmax(tagging_logit.flatten())
-                     for tagging_logit in tagging_logits[:sequence_length[0]]]
+                     for tagging_logit in tagging_logits]
     tagging = [np.argmax(tagging_prob) for tagging_prob in tagging_probs]
-    classification_probs = self.softmax(classification_logits[0])
+    classification_probs = self.softmax(classification_logit)
     classification_dict = {}
     for i, c in enumerate(classification_probs):
         classification_dict[self.rev_label_vocab[i]] = c
@@ -0,0 +1 @@
+python sweep_nlu.py --data_dir data/nlu_data/ --train_dir model_sweep --max_sequence_length 130 --task joint --max_training_steps 3000 --sweep_grid '{"size": [64, 128], "word_embedding_size": [64, 128], "dropout_keep_prob": [0.5, 0.8], "use_attention": [true, false], "bidirectional_rnn": [true, false]}' --sweep_trials 8
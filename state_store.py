@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+'''
+Local stores of serialized dialogue states, the SessionStore backends.
+
+A store maps a session key to the json-able snapshot of
+DialogueState.to_dict(). Keys are json encoded, so tuples such as
+(room, user) can be used. DictStateStore keeps the snapshots in process,
+FileStateStore writes one file per session and SqliteStateStore one row per
+session; the last two survive restarts and can be shared by the workers of
+one host. SqliteStateStore also keeps a revision per session: saving with
+the revision a state was loaded at fails with StaleStateError when another
+worker saved the session since.
+'''
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+# SqliteStateStore.save revision overwriting whatever is stored
+ANY_REVISION = -1
+
+
+class StaleStateError(Exception):
+    ''' The session was saved by someone else since it was loaded '''
+
+
+def _key(key):
+    return json.dumps(key, sort_keys=True)
+
+def _encode(snapshot):
+    return json.dumps(snapshot, separators=(',', ':'), sort_keys=True)
+
+
+class DictStateStore(object):
+    def __init__(self):
+        self.__states = {}
+        self.__lock = threading.Lock()
+
+    def load(self, key):
+        with self.__lock:
+            data = self.__states.get(_key(key))
+        return json.loads(data) if data is not None else None
+
+    def save(self, key, snapshot):
+        data = _encode(snapshot)
+        with self.__lock:
+            self.__states[_key(key)] = data
+
+    def delete(self, key):
+        with self.__lock:
+            self.__states.pop(_key(key), None)
+
+
+class FileStateStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __path(self, key):
+        return os.path.join(self.directory, hashlib.md5(_key(key).encode('utf-8')).hexdigest() + '.json')
+
+    def load(self, key):
+        try:
+            with open(self.__path(key), 'r') as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    def save(self, key, snapshot):
+        ''' Written to a temporary file renamed into place, never half written '''
+        path = self.__path(key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'w') as f:
+            f.write(_encode(snapshot))
+        os.rename(tmp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self.__path(key))
+        except OSError:
+            pass
+
+
+class SqliteStateStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.__lock, self.__conn:
+            self.__conn.execute('CREATE TABLE IF NOT EXISTS dialogue_state '
+                                '(key TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL, '
+                                'revision INTEGER NOT NULL DEFAULT 0)')
+            columns = [row[1] for row in self.__conn.execute('PRAGMA table_info(dialogue_state)')]
+            if 'revision' not in columns:
+                self.__conn.execute('ALTER TABLE dialogue_state ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+
+    def load(self, key):
+        return self.load_revision(key)[0]
+
+    def load_revision(self, key):
+        ''' (snapshot, revision), (None, None) for an unknown session '''
+        with self.__lock:
+            row = self.__conn.execute('SELECT data, revision FROM dialogue_state WHERE key=?',
+                                      (_key(key),)).fetchone()
+        return (json.loads(row[0]), row[1]) if row is not None else (None, None)
+
+    def save(self, key, snapshot, revision=ANY_REVISION):
+        ''' Save over revision, None for a session that must not exist yet,
+            raising StaleStateError when the stored one differs.
+            Return the new revision.
+        '''
+        data = _encode(snapshot)
+        with self.__lock, self.__conn:
+            if revision is None or revision == ANY_REVISION:
+                cursor = self.__conn.execute('INSERT OR IGNORE INTO dialogue_state (key, data, updated) VALUES (?,?,?)',
+                                             (_key(key), data, time.time()))
+                if cursor.rowcount == 1:
+                    return 0
+                if revision is None:
+                    raise StaleStateError(key)
+                cursor = self.__conn.execute('UPDATE dialogue_state SET data=?, updated=?, revision=revision+1 '
+                                             'WHERE key=?', (data, time.time(), _key(key)))
+            else:
+                cursor = self.__conn.execute('UPDATE dialogue_state SET data=?, updated=?, revision=revision+1 '
+                                             'WHERE key=? AND revision=?', (data, time.time(), _key(key), revision))
+            if cursor.rowcount == 0:
+                raise StaleStateError(key)
+            return self.__conn.execute('SELECT revision FROM dialogue_state WHERE key=?',
+                                       (_key(key),)).fetchone()[0]
+
+    def delete(self, key):
+        with self.__lock, self.__conn:
+            self.__conn.execute('DELETE FROM dialogue_state WHERE key=?', (_key(key),))
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()
+
+
+def open_state_store(spec):
+    ''' 'memory' -> DictStateStore, *.db|*.sqlite -> SqliteStateStore,
+        any other path -> FileStateStore directory
+    '''
+    if spec == 'memory':
+        return DictStateStore()
+    if spec.endswith('.db') or spec.endswith('.sqlite'):
+        return SqliteStateStore(spec)
+    return FileStateStore(spec)
@@ -0,0 +1,9 @@
+from rnn_nlu import sweep
+
+
+def main():
+    sweep.main(None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+'''
+Parallel actor-learner training of the dialogue policy.
+
+Every actor process runs Simulator episodes against its own Manager, with a
+LocalDatabase and a PolicyAgent on a copy of the policy network, turns each
+episode into (state, action one-hot, return) samples and puts them on a
+queue shared by all actors. The learner (the main process) adds the samples
+to the replay memory of policy_network, runs an update every update_every
+episodes and broadcasts its weights to the actors every sync_every updates.
+The learning curve is written in the draw_learning_curve.py format.
+
+e.g.
+    python2 train_policy.py --actors 8 --episodes 20000 --policy_dir ./policy_model/
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from six.moves import queue
+
+import numpy as np
+
+from Dialogue_Manager import Manager, DialogueServices
+from dialogue_policy import PolicyAgent, POLICY_ACTIONS
+from ontology.localDatabase import LocalDatabase
+from policy_network import policy_network
+from userSimulator import Simulator, intents, SUCCESS_REWARD, TURN_REWARD
+
+# seconds the learner waits for an episode before checking the actors are alive
+ACTOR_POLL_SEC = 5
+
+
+def optParser():
+    parser = argparse.ArgumentParser(description='Actor-learner training of the dialogue policy')
+    parser.add_argument('--template_dir',default='./data/template/',help='sentence template directory')
+    parser.add_argument('--data',default='./data/chinese_artist.json',help='artist-album-track json data')
+    parser.add_argument('--genre',default='./data/genres.json',help='genres')
+    parser.add_argument('--genre_map',default='./data/genre_map.json',type=str,help='genre_map.json path')
+    parser.add_argument('--spotify_playlist',default='./data/spotify_playlist.json',\
+            type=str,help='spotify_playlist.json path')
+    parser.add_argument('--nlu_data', default='./data/nlu_data/',type=str, help='data dir')
+    parser.add_argument('--model',default='./model_tmp/',type=str,help='NLU model dir')
+    parser.add_argument('--policy_dir',default='./policy_model/',type=str,help='policy checkpoint dir')
+    parser.add_argument('--actors',default=0,type=int,help='actor processes, 0: one per CPU but one')
+    parser.add_argument('--episodes',default=10000,type=int,help='episodes to train on')
+    parser.add_argument('--update_every',default=8,type=int,help='episodes received between two updates')
+    parser.add_argument('--num_batch',default=4,type=int,help='minibatches per update')
+    parser.add_argument('--sync_every',default=10,type=int,help='updates between two weight broadcasts')
+    parser.add_argument('--gamma',default=0.95,type=float,help='discount of the returns')
+    parser.add_argument('--memory_size',default=10000,type=int,help='replay memory capacity')
+    parser.add_argument('--prioritized',default=False,action='store_true',help='prioritized replay')
+    parser.add_argument('--seed',default=0,type=int,help='actor i draws its goals with seed+i')
+    parser.add_argument('--log_every',default=500,type=int,help='episodes between two learning curve points')
+    parser.add_argument('--performance',default='',type=str,help='write the learning curve to this json file')
+    args = parser.parse_args()
+    return args
+
+
+def run_episode(DM, US, agent, gamma):
+    ''' One episode with a random goal, return its samples and statistics '''
+    DM.state_init()
+    US.set_user_goal(random_init=True)
+    user_sent = US.user_response(start=True)
+    turns = 0
+    while True:
+        action = DM.get_input(user_sent)
+        turns += 1
+        user_sent = US.user_response(action)
+        if DM.dialogue_end:
+            break
+    rewards = [TURN_REWARD]*len(agent.trajectory)
+    if rewards and US.cur_success:
+        rewards[-1] += SUCCESS_REWARD
+    samples = agent.finish(rewards, gamma)
+    return samples, {'success':US.cur_success, 'reward':US.cur_reward, 'turns':turns}
+
+
+def actor(actor_id, args, experience, weights, stop):
+    ''' Run episodes until stop is set, with the latest weights received '''
+    seed = args.seed + actor_id
+    random.seed(seed)
+    np.random.seed(seed)
+    DB = LocalDatabase(args.data, args.genre_map, args.spotify_playlist, seed=seed)
+    services = DialogueServices(args.nlu_data, args.model, None, None, None, DB=DB)
+    network = policy_network(args.policy_dir, action_num=len(POLICY_ACTIONS), memory_size=1)
+    agent = PolicyAgent(network, seed=seed)
+    DM = Manager(services=services, policy=agent)
+    US = Simulator(args.template_dir, args.data, args.genre, args.genre_map, intents)
+    version = -1
+    while not stop.is_set():
+        try:
+            while True:
+                version, values = weights.get_nowait()
+                network.set_weights(values)
+        except queue.Empty:
+            pass
+        samples, stats = run_episode(DM, US, agent, args.gamma)
+        stats['version'] = version
+        while not stop.is_set():
+            try:
+                experience.put((actor_id, samples, stats), timeout=1)
+                break
+            except queue.Full:
+                pass
+    services.close()
+    network.close()
+
+
+def train(args):
+    nb_actors = args.actors or max(1, multiprocessing.cpu_count()-1)
+    experience = multiprocessing.Queue(maxsize=64*nb_actors)
+    weights = [multiprocessing.Queue() for _ in range(nb_actors)]
+    stop = multiprocessing.Event()
+    # created once here, the actors would race on it
+    if not os.path.exists(args.policy_dir):
+        os.makedirs(args.policy_dir)
+    # the actors are forked before the learner creates its tensorflow session
+    actors = [multiprocessing.Process(target=actor, args=(i, args, experience, weights[i], stop))
+              for i in range(nb_actors)]
+    for p in actors:
+        p.daemon = True
+        p.start()
+
+    learner = policy_network(args.policy_dir, action_num=len(POLICY_ACTIONS),
+                             memory_size=args.memory_size, prioritized=args.prioritized)
+    version = 0
+    def broadcast():
+        values = learner.get_weights()
+        for q in weights:
+            q.put((version, values))
+    broadcast()
+
+    print('Training on {} episodes with {} actors'.format(args.episodes, nb_actors))
+    performance = {'success_rate':{}, 'ave_turns':{}, 'ave_reward':{}}
+    window = {'episodes':0, 'success':0, 'turns':0, 'reward':0., 'loss':0., 'updates':0, 'lag':0}
+    start_time = time.time()
+    episodes = 0
+    updates = 0
+    nb_alive = nb_actors
+    try:
+        while episodes < args.episodes:
+            try:
+                actor_id, samples, stats = experience.get(timeout=ACTOR_POLL_SEC)
+            except queue.Empty:
+                alive = sum(1 for p in actors if p.is_alive())
+                if alive == 0:
+                    stop.set()
+                    raise RuntimeError('All the actors died, see their errors above')
+                if alive < nb_alive:
+                    print('{} of {} actors died'.format(nb_actors-alive, nb_actors))
+                    sys.stdout.flush()
+                    nb_alive = alive
+                continue
+            for sample in samples:
+                learner.add_memory(sample)
+            episodes += 1
+            window['episodes'] += 1
+            window['success'] += int(stats['success'])
+            window['turns'] += stats['turns']
+            window['reward'] += stats['reward']
+            window['lag'] += version - stats['version']
+
+            if episodes % args.update_every == 0:
+                window['loss'] += learner.update(args.num_batch)
+                window['updates'] += 1
+                updates += 1
+                if updates % args.sync_every == 0:
+                    version += 1
+                    broadcast()
+                    learner.save_model()
+
+            if episodes % args.log_every == 0 or episodes == args.episodes:
+                n = float(window['episodes'])
+                performance['success_rate'][episodes] = window['success']/n
+                performance['ave_turns'][episodes] = window['turns']/n
+                performance['ave_reward'][episodes] = window['reward']/n
+                print('{} episodes, {:.1f} episodes/sec, success {:.3f}, turns {:.2f}, reward {:.2f}, '
+                      'loss {:.4f}, weight lag {:.2f}'.format(episodes, episodes/(time.time()-start_time),
+                      window['success']/n, window['turns']/n, window['reward']/n,
+                      window['loss']/max(1, window['updates']), window['lag']/n))
+                sys.stdout.flush()
+                window = dict((key, 0) for key in window)
+
+        stop.set()
+        # unblock the actors waiting on a full queue
+        try:
+            while True:
+                experience.get_nowait()
+        except queue.Empty:
+            pass
+        for p in actors:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+        learner.save_model()
+    finally:
+        # write the checkpoint still queued, also on Ctrl-C or when the actors died
+        learner.close()
+    if args.performance:
+        with open(args.performance, 'w') as f:
+            json.dump(performance, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    train(optParser())
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+'''
+Transcript log of the dialogue turns, read back by replay_transcripts.py.
+
+One json line per event of a session. A 'turn' holds the user sentence, the
+action the manager answered with, whether it ended the dialogue, the turn
+latency and the results of the DB checks made by the state tracking, so a
+replay can answer them without the music service. A 'reset' marks a fresh
+dialogue state for the session (the user joined again).
+'''
+import json
+import time
+import functools
+import threading
+
+# DB calls whose results steer the state tracking, recorded in the turns
+RECORDED_CALLS = ('check_track','check_artist')
+
+
+class RecordingCalls(object):
+    ''' Proxy appending [method, args, result] of the calls of methods to calls '''
+    def __init__(self, obj, calls, methods=RECORDED_CALLS):
+        self.__obj = obj
+        self.__calls = calls
+        self.__methods = methods
+
+    def __getattr__(self, name):
+        attr = getattr(self.__obj, name)
+        if name not in self.__methods:
+            return attr
+        calls = self.__calls
+        @functools.wraps(attr)
+        def call(*args):
+            result = attr(*args)
+            calls.append([name, list(args), result])
+            return result
+        return call
+
+
+class TranscriptWriter(object):
+    ''' Appends the events of every session to one json lines file '''
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__file = open(path, 'a')
+
+    def __write(self, event):
+        line = json.dumps(event, sort_keys=True)
+        with self.__lock:
+            self.__file.write(line + '\n')
+            self.__file.flush()
+
+    def record(self, key, DM, sentence, action, seconds):
+        ''' Log the turn DM just answered with action in seconds '''
+        self.__write({'event': 'turn', 'session': key, 'user': DM.user_name, 'time': time.time(),
+                      'sent': sentence, 'action': action, 'dialogue_end': DM.dialogue_end,
+                      'end_type': DM.dialogue_end_type if DM.dialogue_end else None,
+                      'seconds': seconds, 'db': list(DM.db_calls)})
+
+    def reset(self, key, user_name=None):
+        self.__write({'event': 'reset', 'session': key, 'user': user_name, 'time': time.time()})
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
+def read_sessions(paths):
+    ''' Events of the transcript files grouped by session, in log order '''
+    sessions = {}
+    order = []
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                key = json.dumps(event['session'], sort_keys=True)
+                if key not in sessions:
+                    sessions[key] = []
+                    order.append(key)
+                sessions[key].append(event)
+    return [sessions[key] for key in order]
+
+
+class ReplayDatabase(object):
+    ''' Stand-in for databaseAPI.Database answering the recorded checks of a turn.
+        Checks missing from the log answer default_check and are counted in
+        misses; the final queries return empty answers.
+    '''
+    def __init__(self, default_check=1):
+        self.default_check = default_check
+        self.misses = 0
+        self.__calls = {}
+
+    def load(self, calls):
+        ''' Answers of the next turn, from the 'db' field of its log '''
+        self.__calls = {}
+        for name, args, result in calls:
+            self.__calls.setdefault((name, json.dumps(args)), []).append(result)
+
+    def __check(self, name, args):
+        results = self.__calls.get((name, json.dumps(list(args))))
+        if not results:
+            self.misses += 1
+            return self.default_check
+        return results.pop(0)
+
+    def check_track(self, track_name):
+        return self.__check('check_track', [track_name])
+
+    def check_artist(self, artist_name):
+        return self.__check('check_artist', [artist_name])
+
+    def search(self, slots):
+        return [], u'', ''
+
+    def info(self, slots):
+        return {}, u''
+
+    def recommend(self, slots):
+        return [], u'', []
+
+    def __getattr__(self, name):
+        if name.startswith('playlist'):
+            return lambda *args: (u'', '')
+        raise AttributeError(name)
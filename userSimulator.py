@@ -3,14 +3,18 @@ from __future__ import print_function
 import numpy as np
 import pandas as pd
 import argparse
+import copy
+import itertools
 import json
+import multiprocessing
 import sys
 import re
 import string
 import random
+import time
 
 from utils import io_utils
-from random import randrange, shuffle
+from random import randrange
 from os.path import join
 
 
@@ -21,6 +25,8 @@ slot_token_map = {'artist':'[s]', 'track':'[t]', 'genre':'[g]'}
 token_slot_map = {'[s]':'artist', '[t]':'track', '[g]':'genre'}
 SUCCESS_REWARD = 10.
 TURN_REWARD = -0.1
+# every subset of slots, the slot signatures a template can have
+SLOT_SUBSETS = [frozenset(c) for n in range(len(slots)+1) for c in itertools.combinations(slots, n)]
 
 def opt_parse():
     parser = argparse.ArgumentParser(description=\
@@ -35,7 +41,16 @@ def opt_parse():
             type=str,help='genre_map.json path')
     parser.add_argument('--nlu_data', default='./data/nlu_data/',type=str, help='data dir')
     parser.add_argument('--model',default='./model_tmp/',type=str,help='model dir')
+    parser.add_argument('--spotify_playlist',default='./data/spotify_playlist.json',\
+            type=str,help='spotify_playlist.json path')
     parser.add_argument('--mode',default='test_dst', type=str, help='stdin|test_dst')
+    parser.add_argument('--nb_dialogue',default=10000,type=int,help='test_dst: number of simulated dialogues')
+    parser.add_argument('--workers',default=0,type=int,help='test_dst: simulation processes, 0: one per CPU')
+    parser.add_argument('--shard_size',default=250,type=int,help='test_dst: dialogues per shard')
+    parser.add_argument('--seed',default=0,type=int,help='test_dst: shard i draws its goals with seed+i')
+    parser.add_argument('--report',default='',type=str,help='test_dst: write the statistics to this json file')
+    parser.add_argument('--lockstep',default=0,type=int,\
+            help='test_dst: step this many dialogues per worker in lockstep with a batched NLU, 0: one at a time')
     parser.add_argument('-v',dest='verbose',default=False,action='store_true',help='verbose')
     args = parser.parse_args()
     return args
@@ -86,7 +101,7 @@ class Simulator():
 
         ### all the possible slots set based on current intent
         self.cur_slots_all = set([s for s in self.cur_slot if self.cur_slot[s] is not None]) 
-        self.cur_templates = self.data['intent_template_map'][self.cur_intent] # use the current intent template
+        self.cur_templates = self.data['intent_template_index'][self.cur_intent] # use the current intent template
         self.cur_set_goal = True
 
     def user_response(self, dst_msg=None, start=False):
@@ -118,7 +133,9 @@ class Simulator():
             ### NOTE: should not happen
             print ('[ERROR] Need DST message...')
         
-        if dst_msg['action'] == 'confirm':
+        if 'action' not in dst_msg: # DST gave up, e.g. after too many turns
+            self.dialogue_end = True
+        elif dst_msg['action'] == 'confirm':
             sent = self.__confirm(dst_msg, slots_asked, intent_asked)
         elif dst_msg['action'] == 'question':
             sent = self.__question(dst_msg, slots_asked, intent_asked)
@@ -135,30 +152,14 @@ class Simulator():
 
     def sentence_generate(self, slots_asked=set([]), strict=True):
         '''strict: use the template contain all the slots_asked
+            A random template among the ones matching, '' if none does
         '''
-        #intent_asked = intent_asked if len(intent_asked) > 0 else self.cur_intent
-        shuffle(self.cur_templates)
-        slots_all = set(slots)
-        for t in self.cur_templates:
-            t = t.decode('utf-8')
-            ### if no slots asked, use the any template which contains any currrent slot and 
-            ### doesn't contain any other slots
-            if len(slots_asked) is 0 and any(slot_token_map[s] in t for s in self.cur_slots_all)\
-                    and all(slot_token_map[s] not in t for s in slots_all - self.cur_slots_all):
-                sent = self.__fill_slot(t)
-                break
-            ### else if the template contains the slot asked and doesn't contain any other slots
-            if strict:
-                if all(slot_token_map[s] in t for s in slots_asked) and\
-                        all(slot_token_map[s] not in t for s in slots_all - slots_asked):
-                    sent = self.__fill_slot(t)
-                    break
-            else:
-                if any(slot_token_map[s] in t for s in slots_asked) and\
-                        all(slot_token_map[s] not in t for s in slots_all - slots_asked):
-                    sent = self.__fill_slot(t)
-                    break
-        return sent
+        slots_asked = frozenset(slots_asked)
+        goal = frozenset(self.cur_slots_all) if len(slots_asked) == 0 else frozenset()
+        templates = self.cur_templates.get((slots_asked, strict, goal))
+        if not templates:
+            return ''
+        return self.__fill_slot(self.__rand(templates))
 
 
     def get_reward(self):
@@ -198,7 +199,6 @@ class Simulator():
 
     def dst_cur_state_check(self, dst_confirmed_state):
         ''' Check if DST current state is correct'''
-        print(dst_confirmed_state)
         for key in self.cur_slot:
             if type(dst_confirmed_state['slot'][key]) is float:
                 dst_confirmed_state['slot'][key] = None
@@ -340,15 +340,48 @@ class Simulator():
                     tracks.append(t)
         # load intent templates
         intent_template_map = {}
+        intent_template_index = {}
         for i in intents:
             intent_template_map[i] = []
             f = join(template_dir, i+'.csv')
             data_sent = pd.read_csv(f)
             data_sent = data_sent[data_sent.columns[0]].unique()
             intent_template_map[i] = data_sent
+            intent_template_index[i] = index_templates(data_sent)
 
         return {'artist':artists, 'tracks':tracks, 'track_artist_map':track_artist_map,\
-                'genres':genres, 'intent_template_map':intent_template_map}
+                'genres':genres, 'intent_template_map':intent_template_map,\
+                'intent_template_index':intent_template_index}
+
+def template_signature(template):
+    ''' Set of the slots whose token is in the template '''
+    return frozenset(token_slot_map[k] for k in tokens if k in template)
+
+def index_templates(templates):
+    ''' Decode the templates and list the ones matching each query of sentence_generate
+        Return: {(slots_asked, strict, goal): [template]}, goal being the slots of
+            the user goal when no slot is asked, frozenset() otherwise
+    '''
+    by_signature = dict((sig, []) for sig in SLOT_SUBSETS)
+    for t in templates:
+        t = t.decode('utf-8')
+        by_signature[template_signature(t)].append(t)
+
+    index = {}
+    for asked in SLOT_SUBSETS:
+        if len(asked) > 0:
+            ### strict: exactly the slots asked, else any slot asked and no other slot
+            index[(asked, True, frozenset())] = by_signature[asked]
+            index[(asked, False, frozenset())] = [t for sig in SLOT_SUBSETS if sig & asked and sig <= asked
+                                                  for t in by_signature[sig]]
+        else:
+            ### no slots asked: any current slot of the goal and no other slot,
+            ### strict also allows templates without any slot
+            for goal in SLOT_SUBSETS:
+                in_goal = [t for sig in SLOT_SUBSETS if sig & goal and sig <= goal for t in by_signature[sig]]
+                index[(asked, False, goal)] = in_goal
+                index[(asked, True, goal)] = in_goal + by_signature[asked]
+    return index
 
 def main(args):
     simulator = Simulator(args.template_dir, args.data, args.genre, intents)
@@ -391,49 +424,123 @@ def main(args):
             print ('Dialogue finished!!!')
             simulator.print_cur_user_goal()
 
-def test_DST(args):
+# simulator and dialogue manager of a simulation process, set by init_simulation
+_simulation = {}
+
+def init_simulation(args):
     import Dialogue_Manager
-    US = Simulator(args.template_dir, args.data, args.genre, args.genre_map, intents)
-    US.set_user_goal(random_init=True)
-    US.print_cur_user_goal()
-    user_sent = US.user_response(start=True)
-    
-    DM = Dialogue_Manager.Manager(args.nlu_data , args.model, args.genre, verbose=args.verbose)
-    c_each_turn =  0.
-    nb_turn = 0.
-    c_final_turn = 0.
-    nb_final_turn = 0.
-    count = 0
-    while True:
-        nb_turn += 1
-        action = DM.get_input(user_sent)
-        print ('?????',DM.confirmed_state)
-        if US.dst_cur_state_check(DM.confirmed_state):
-            c_each_turn += 1
-        DM.print_current_state()
-        user_sent = US.user_response(action)
-        print (user_sent)
-        print (US.get_reward())
-        if DM.dialogue_end:
-            count += 1
-            US.print_cur_user_goal()
-            nb_final_turn += 1
-            if US.cur_success:
-                c_final_turn += 1
-            print("Dialogue System final response:",end=' ')
-            print(DM.dialogue_end_sentence)
-            print('\nCongratulation!!! You have ended one dialogue successfully\n')
-            
-            print ('ACC turn:[{:f}]  ACC final:[{}] AVG turns:[{}]'.format(c_each_turn/nb_turn,
-                c_final_turn/nb_final_turn, nb_turn/nb_final_turn))
-            if count > 10000:
+    from ontology.localDatabase import LocalDatabase
+    DB = LocalDatabase(args.data, args.genre_map, args.spotify_playlist)
+    services = Dialogue_Manager.DialogueServices(args.nlu_data, args.model, None, None, None,
+                                                 verbose=args.verbose, DB=DB)
+    _simulation['US'] = Simulator(args.template_dir, args.data, args.genre, args.genre_map, intents)
+    _simulation['DM'] = Dialogue_Manager.Manager(services=services)
+    _simulation['verbose'] = args.verbose
+    _simulation['env'] = None
+    if args.lockstep > 0:
+        from dialogue_env import LockstepEnv
+        _simulation['env'] = LockstepEnv(services, _simulation['US'], args.lockstep)
+
+def new_stats():
+    return {'dialogues':0, 'turns':0, 'correct_turns':0, 'success':0, 'reward':0.,
+            'intents':dict((i, {'dialogues':0, 'success':0}) for i in intents[:3])}
+
+def merge_stats(stats, other):
+    for key in ['dialogues', 'turns', 'correct_turns', 'success', 'reward']:
+        stats[key] += other[key]
+    for i in stats['intents']:
+        for key in stats['intents'][i]:
+            stats['intents'][i][key] += other['intents'][i][key]
+    return stats
+
+def add_episode(stats, episode):
+    stats['dialogues'] += 1
+    stats['turns'] += episode['turns']
+    stats['correct_turns'] += episode['correct_turns']
+    stats['reward'] += episode['reward']
+    stats['intents'][episode['intent']]['dialogues'] += 1
+    if episode['success']:
+        stats['success'] += 1
+        stats['intents'][episode['intent']]['success'] += 1
+
+def simulate_shard(job):
+    ''' Run nb_dialogue dialogues on random goals drawn with seed, return their statistics '''
+    shard_id, nb_dialogue, seed = job
+    US, DM, verbose = _simulation['US'], _simulation['DM'], _simulation['verbose']
+    random.seed(seed)
+    np.random.seed(seed)
+    DM.services.DB.rng.seed(seed)
+    stats = new_stats()
+    if _simulation['env'] is not None:
+        for episode in _simulation['env'].run(nb_dialogue):
+            add_episode(stats, episode)
+        return stats
+    for _ in range(nb_dialogue):
+        DM.state_init()
+        US.set_user_goal(random_init=True)
+        user_sent = US.user_response(start=True)
+        episode = {'turns':0, 'correct_turns':0}
+        while True:
+            action = DM.get_input(user_sent)
+            episode['turns'] += 1
+            if US.dst_cur_state_check(copy.deepcopy(DM.confirmed_state)):
+                episode['correct_turns'] += 1
+            if verbose:
+                DM.print_current_state()
+            user_sent = US.user_response(action)
+            if verbose:
+                print (user_sent)
+            if DM.dialogue_end:
                 break
-
-            DM.state_init()
-            US.set_user_goal(random_init=True)
+        if verbose:
             US.print_cur_user_goal()
-            user_sent = US.user_response(start=True)
-    
+        episode.update({'intent':US.cur_intent, 'success':US.cur_success, 'reward':US.cur_reward})
+        add_episode(stats, episode)
+    return stats
+
+def test_DST(args):
+    ''' Simulate nb_dialogue dialogues against the DM with the local database.
+        Goals are split in shards of shard_size dialogues, each seeded by its
+        index, so the results do not depend on the number of workers.
+    '''
+    nb_shards = (args.nb_dialogue + args.shard_size - 1) // args.shard_size
+    jobs = [(i, min(args.shard_size, args.nb_dialogue - i*args.shard_size), args.seed + i)
+            for i in range(nb_shards)]
+    workers = min(args.workers or multiprocessing.cpu_count(), nb_shards)
+    print ('Simulating {} dialogues in {} shards on {} workers'.format(args.nb_dialogue, nb_shards, workers))
+    start_time = time.time()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_simulation, (args,))
+        results = pool.imap_unordered(simulate_shard, jobs)
+    else:
+        pool = None
+        init_simulation(args)
+        results = (simulate_shard(job) for job in jobs)
+
+    stats = new_stats()
+    for shard_stats in results:
+        merge_stats(stats, shard_stats)
+        print ('{}/{} dialogues, {:.1f} dialogues/sec'.format(stats['dialogues'], args.nb_dialogue,
+               stats['dialogues']/(time.time()-start_time)))
+        sys.stdout.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    stats['seconds'] = time.time()-start_time
+
+    nb = max(1, stats['dialogues'])
+    stats['acc_turn'] = stats['correct_turns']/float(max(1, stats['turns']))
+    stats['acc_final'] = stats['success']/float(nb)
+    stats['avg_turns'] = stats['turns']/float(nb)
+    stats['avg_reward'] = stats['reward']/nb
+    print ('ACC turn:[{:f}]  ACC final:[{}] AVG turns:[{}] AVG reward:[{}]'.format(stats['acc_turn'],
+           stats['acc_final'], stats['avg_turns'], stats['avg_reward']))
+    for i in sorted(stats['intents']):
+        n = stats['intents'][i]
+        print ('  {}: ACC final:[{}] dialogues:[{}]'.format(i, n['success']/float(max(1, n['dialogues'])), n['dialogues']))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(stats, f, indent=1, sort_keys=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+'''
+Asynchronous checkpoint saving.
+
+AsyncSaver.save only copies the variable values out of the session (one
+sess.run); a background thread rebuilds them in a private graph and writes a
+regular tf.train.Saver checkpoint, so the files can be restored by the
+model's own saver as before. Files are written under a temporary prefix and
+renamed into place before the `checkpoint` state file is updated, so an
+interrupted write never leaves a half-written latest checkpoint. Only the
+newest max_to_keep checkpoints are kept, counting the ones already listed
+in the `checkpoint` state file of the directory.
+'''
+import os
+import glob
+import time
+import numbers
+import threading
+from six.moves import queue
+
+import tensorflow as tf
+
+
+class AsyncSaver(object):
+    def __init__(self, var_list, max_to_keep=5, max_pending=1):
+        '''
+            var_list: variables to save, e.g. the ones given to the model saver
+            max_to_keep: number of checkpoints kept on disk
+            max_pending: number of snapshots waiting to be written; save blocks
+                         when the writer falls this far behind
+        '''
+        self.var_list = list(var_list)
+        self.max_to_keep = max_to_keep
+        # (global_step, seconds) of the latest checkpoint on disk
+        self.last_write = None
+        self.__queue = queue.Queue(maxsize=max_pending)
+        self.__error = None
+        self.__kept = []
+        self.__kept_dir = None
+        self.__build_writer()
+        self.__thread = threading.Thread(target=self.__write_loop)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __build_writer(self):
+        ''' Mirror the variables in a private graph fed from the snapshots '''
+        self.__graph = tf.Graph()
+        with self.__graph.as_default():
+            self.__placeholders = []
+            self.__initializers = []
+            writer_vars = {}
+            for v in self.var_list:
+                dtype = v.dtype.base_dtype
+                shape = v.get_shape()
+                p = tf.placeholder(dtype, shape=shape)
+                wv = tf.Variable(p, trainable=False, collections=[], validate_shape=shape.is_fully_defined())
+                writer_vars[v.op.name] = wv
+                self.__placeholders.append(p)
+                self.__initializers.append(wv.initializer)
+            self.__saver = tf.train.Saver(writer_vars, max_to_keep=None, sharded=False)
+        self.__sess = tf.Session(graph=self.__graph)
+
+    def save(self, sess, save_path, global_step=None):
+        ''' Snapshot the variables and queue them for writing.
+            Return the checkpoint path that will be written.
+        '''
+        self.__raise_error()
+        values = sess.run(self.var_list)
+        if global_step is not None:
+            if not isinstance(global_step, numbers.Integral):
+                global_step = int(sess.run(global_step))
+            save_path = '%s-%d' % (save_path, global_step)
+        self.__queue.put((values, save_path, global_step))
+        return save_path
+
+    def wait(self):
+        ''' Block until every queued snapshot is on disk '''
+        self.__queue.join()
+        self.__raise_error()
+
+    def close(self):
+        self.wait()
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__sess.close()
+
+    def __raise_error(self):
+        if self.__error is not None:
+            error, self.__error = self.__error, None
+            raise error
+
+    def __write_loop(self):
+        while True:
+            job = self.__queue.get()
+            try:
+                if job is None:
+                    return
+                values, save_path, global_step = job
+                start_time = time.time()
+                self.__write(values, save_path)
+                self.last_write = (global_step, time.time() - start_time)
+            except Exception as e:
+                self.__error = e
+            finally:
+                self.__queue.task_done()
+
+    def __write(self, values, save_path):
+        feed_dict = dict(zip(self.__placeholders, values))
+        self.__sess.run(self.__initializers, feed_dict=feed_dict)
+
+        save_dir = os.path.dirname(save_path) or '.'
+        tmp_path = os.path.join(save_dir, '.tmp-' + os.path.basename(save_path))
+        written = self.__saver.save(self.__sess, tmp_path, write_meta_graph=False,
+                                    write_state=False)
+        for f in glob.glob(written + '.*'):
+            os.rename(f, save_path + f[len(written):])
+
+        if save_dir != self.__kept_dir:
+            # the checkpoints of an earlier run are pruned and stay listed
+            state = tf.train.get_checkpoint_state(save_dir)
+            self.__kept = list(state.all_model_checkpoint_paths) if state else []
+            self.__kept_dir = save_dir
+        self.__kept = [p for p in self.__kept
+                       if os.path.abspath(p) != os.path.abspath(save_path)] + [save_path]
+        while len(self.__kept) > self.max_to_keep:
+            for f in glob.glob(self.__kept.pop(0) + '.*'):
+                os.remove(f)
+        tf.train.update_checkpoint_state(save_dir, save_path,
+                                         all_model_checkpoint_paths=self.__kept)
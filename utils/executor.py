@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+'''
+Bounded thread pool executor returning futures.
+
+BoundedExecutor.submit never blocks: the call runs on a worker thread and
+the returned Future is resolved with its result or exception. At most
+max_pending calls are queued or running; beyond that submit returns a
+Future already failed with ExecutorFull, so callers fall back instead of
+piling up work behind a slow backend.
+'''
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+import six
+
+
+class FutureTimeout(Exception):
+    pass
+
+
+class ExecutorFull(Exception):
+    pass
+
+
+class Future(object):
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__result = None
+        self.__exc_info = None
+
+    def set_result(self, result):
+        self.__result = result
+        self.__done.set()
+
+    def set_exc_info(self, exc_info):
+        self.__exc_info = exc_info
+        self.__done.set()
+
+    def done(self):
+        return self.__done.is_set()
+
+    def failed(self):
+        return self.done() and self.__exc_info is not None
+
+    def result(self, timeout=None):
+        ''' Wait up to timeout seconds, raise FutureTimeout if still running,
+            or the exception raised by the call '''
+        if not self.__done.wait(timeout):
+            raise FutureTimeout()
+        if self.__exc_info is not None:
+            six.reraise(*self.__exc_info)
+        return self.__result
+
+
+def completed(result):
+    ''' A Future already resolved with result '''
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class BoundedExecutor(object):
+    def __init__(self, workers=4, max_pending=64):
+        self.__pool = ThreadPool(workers)
+        self.__slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        if not self.__slots.acquire(False):
+            future.set_exc_info((ExecutorFull, ExecutorFull(), None))
+            return future
+        self.__pool.apply_async(self.__run, (future, fn, args, kwargs))
+        return future
+
+    def __run(self, future, fn, args, kwargs):
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+        finally:
+            self.__slots.release()
+
+    def close(self):
+        self.__pool.close()
+        self.__pool.join()
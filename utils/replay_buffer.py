@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''
+Fixed-capacity experience replay for the policy network.
+
+ReplayBuffer keeps (state, action one-hot, reward) in preallocated numpy
+arrays used as a ring buffer: add is O(1) and overwrites the oldest sample
+once the buffer is full. sample draws a minibatch with replacement by fancy
+indexing, so only the minibatch is copied. With alpha > 0 the samples are
+drawn proportionally to priority**alpha through a sum tree (O(log n) per
+insert and per drawn sample) and come with importance weights.
+'''
+import numpy as np
+
+
+class ReplayBuffer(object):
+    def __init__(self, capacity, state_dim, action_num, alpha=0., seed=None):
+        '''
+            alpha: prioritization exponent, 0 samples uniformly
+        '''
+        self.capacity = capacity
+        self.action_num = action_num
+        self.alpha = alpha
+        self.states = np.zeros((capacity, state_dim), dtype=np.float32)
+        self.actions = np.zeros((capacity, action_num), dtype=np.float32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.rng = np.random.RandomState(seed)
+        self.__next = 0
+        self.__size = 0
+        self.__max_priority = 1.
+        # leaves of the sum tree start at __leaves, node i sums nodes 2i and 2i+1
+        self.__leaves = 1
+        while self.__leaves < capacity:
+            self.__leaves *= 2
+        self.__tree = np.zeros(2 * self.__leaves, dtype=np.float64)
+
+    def __len__(self):
+        return self.__size
+
+    @property
+    def prioritized(self):
+        return self.alpha > 0
+
+    def add(self, state, action, reward, priority=None):
+        ''' action is an index or a one-hot vector, priority defaults to the
+            highest one seen so the new sample is drawn soon '''
+        i = self.__next
+        self.states[i] = state
+        if np.isscalar(action):
+            self.actions[i] = 0.
+            self.actions[i, int(action)] = 1.
+        else:
+            self.actions[i] = action
+        self.rewards[i] = reward
+        if self.prioritized:
+            self.update_priorities([i], [self.__max_priority if priority is None else priority])
+        self.__next = (i + 1) % self.capacity
+        self.__size = min(self.__size + 1, self.capacity)
+        return i
+
+    def sample(self, batch_size, beta=0.4):
+        ''' Return (states, actions, rewards, weights, indices) of batch_size samples.
+            weights are the importance weights (size*P(i))**-beta normalized by
+            their maximum, all 1 when sampling uniformly.
+        '''
+        if self.__size == 0:
+            raise ValueError('sample from an empty ReplayBuffer')
+        if self.prioritized and self.__tree[1] > 0:
+            indices = self.__sample_tree(batch_size)
+            p = self.__tree[self.__leaves + indices] / self.__tree[1]
+            weights = (self.__size * p) ** -beta
+            weights = (weights / weights.max()).astype(np.float32)
+        else:
+            indices = self.rng.randint(0, self.__size, size=batch_size)
+            weights = np.ones(batch_size, dtype=np.float32)
+        return self.states[indices], self.actions[indices], self.rewards[indices], weights, indices
+
+    def update_priorities(self, indices, priorities):
+        ''' Set the priorities of the samples at indices, e.g. from their loss '''
+        priorities = np.asarray(priorities, dtype=np.float64)
+        self.__max_priority = max(self.__max_priority, float(priorities.max()))
+        nodes = np.asarray(indices) + self.__leaves
+        self.__tree[nodes] = priorities ** self.alpha
+        while nodes[0] > 1:
+            nodes = nodes // 2
+            self.__tree[nodes] = self.__tree[2 * nodes] + self.__tree[2 * nodes + 1]
+
+    def __sample_tree(self, batch_size):
+        ''' Descend the sum tree with one uniform draw per sample '''
+        u = self.rng.uniform(0., self.__tree[1], size=batch_size)
+        nodes = np.ones(batch_size, dtype=np.int64)
+        while nodes[0] < self.__leaves:
+            left = 2 * nodes
+            right = u >= self.__tree[left]
+            u -= self.__tree[left] * right
+            nodes = left + right
+        return np.minimum(nodes - self.__leaves, self.__size - 1)
+
+    def clear(self):
+        self.__next = 0
+        self.__size = 0
+        self.__max_priority = 1.
+        self.__tree[:] = 0.
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+'''
+Stage latency tracing of the dialogue turns.
+
+Tracer aggregates the duration of named stages into fixed-bucket latency
+histograms and counts named events; both can be dumped as json or scraped in
+the Prometheus text format. A span can also append (stage, seconds) to a per-turn trace list.
+Tracer.debug gates the per-turn debug prints of the dialogue manager.
+'''
+import json
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+# upper bounds in seconds, the last bucket is unbounded
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        ''' Upper bound of the bucket holding the q quantile '''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n > 0:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts))}
+
+
+class Tracer(object):
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.histograms = {}
+        self.counters = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, stage, seconds, trace=None):
+        with self.__lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = LatencyHistogram()
+            self.histograms[stage].observe(seconds)
+        if trace is not None:
+            trace.append((stage, seconds))
+
+    def count(self, event, n=1):
+        with self.__lock:
+            self.counters[event] = self.counters.get(event, 0) + n
+
+    @contextmanager
+    def span(self, stage, trace=None):
+        ''' Time the body as one run of stage '''
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - start_time, trace)
+
+    def snapshot(self):
+        with self.__lock:
+            return dict((stage, h.to_dict()) for stage, h in self.histograms.items())
+
+    def dump(self, path):
+        with self.__lock:
+            counters = dict(self.counters)
+        with open(path, 'w') as f:
+            json.dump({'stages': self.snapshot(), 'counters': counters}, f, indent=1, sort_keys=True)
+
+    def reset(self):
+        with self.__lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def prometheus(self, metric='dialogue_stage_seconds'):
+        ''' Histograms in the Prometheus text exposition format '''
+        lines = ['# TYPE %s histogram' % metric]
+        with self.__lock:
+            for stage in sorted(self.histograms):
+                h = self.histograms[stage]
+                cumulative = 0
+                for bound, n in zip([repr(b) for b in h.buckets] + ['+Inf'], h.counts):
+                    cumulative += n
+                    lines.append('%s_bucket{stage="%s",le="%s"} %d' % (metric, stage, bound, cumulative))
+                lines.append('%s_sum{stage="%s"} %f' % (metric, stage, h.sum))
+                lines.append('%s_count{stage="%s"} %d' % (metric, stage, h.count))
+            lines.append('# TYPE dialogue_events_total counter')
+            for event in sorted(self.counters):
+                lines.append('dialogue_events_total{event="%s"} %d' % (event, self.counters[event]))
+        return '\n'.join(lines) + '\n'
+
+
+def traced(stage):
+    ''' Decorate a method of an object with `tracer` and `turn_trace` attributes '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(stage, self.turn_trace):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracedCalls(object):
+    ''' Proxy timing every method call of obj as the stage prefix + method name '''
+    def __init__(self, obj, tracer, prefix, trace=None):
+        self.__obj = obj
+        self.__tracer = tracer
+        self.__prefix = prefix
+        self.__trace = trace
+
+    def __getattr__(self, name):
+        attr = getattr(self.__obj, name)
+        if not callable(attr):
+            return attr
+        tracer, stage, trace = self.__tracer, self.__prefix + name, self.__trace
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            with tracer.span(stage, trace):
+                return attr(*args, **kwargs)
+        return call